@@ -0,0 +1,45 @@
+"""
+Module for handlers which run their automation as a coroutine
+"""
+import asyncio
+import functools
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+
+from agent import config
+
+#: Runs the blocking calls of handlers, an agent runs at most max_jobs jobs
+executor = ThreadPoolExecutor(max_workers=config.settings.max_jobs)
+
+
+async def run_in_executor(func, *args, **kwargs):
+    """
+    Runs a blocking function in the executor of the agent
+    """
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(executor,
+                                      functools.partial(func, *args, **kwargs))
+
+
+class AsyncHandler(ABC):
+    """
+    Handler which waits for its automation without blocking a thread, so one
+    agent can supervise many jobs at the same time
+    """
+    @abstractmethod
+    async def handle(self):
+        """
+        Runs the automation, returns a tuple with 0 on success or 1 on failure
+        and an error message
+        """
+
+
+class SyncHandlerAdapter(AsyncHandler):
+    """
+    Runs a handler with a blocking handle method in the executor of the agent
+    """
+    def __init__(self, handler):
+        self.handler = handler
+
+    async def handle(self):
+        return await run_in_executor(self.handler.handle)
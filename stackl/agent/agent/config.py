@@ -25,6 +25,9 @@ class Settings(BaseSettings):
     loglevel: str = "INFO"
     max_jobs: int = 10
     job_timeout: int = 3660
+    client_cache_ttl: int = 5
+    job_results_stream: str = "stackl:job_results"
+    job_results_max_len: int = 10000
 
     # Kubernetes Handler
     stackl_namespace: str = None
@@ -0,0 +1,78 @@
+"""
+Module for the clients shared by all handlers of an agent
+"""
+import copy
+import os
+import threading
+import time
+
+import stackl_client
+from kubernetes import client, config
+
+from agent import config as agent_config
+
+
+class ClientRegistry:
+    """
+    Creates the Kubernetes and Stackl API clients once, their connection pools
+    are shared by all handlers. Functional requirements and stack instances
+    read from Stackl are cached for a few seconds, handlers of the same stack
+    instance created at the same time read them once
+    """
+    def __init__(self):
+        if 'KUBERNETES_SERVICE_HOST' in os.environ:
+            config.load_incluster_config()
+        else:
+            config.load_kube_config()
+        # Every job of the agent can use a connection at the same time, the
+        # watch on the pods of the jobs holds one more
+        configuration = client.Configuration()
+        configuration.connection_pool_maxsize = \
+            agent_config.settings.max_jobs + 1
+        kubernetes_api_client = client.ApiClient(configuration)
+        self.batch_api = client.BatchV1Api(kubernetes_api_client)
+        self.core_api = client.CoreV1Api(kubernetes_api_client)
+
+        configuration = stackl_client.Configuration()
+        configuration.host = agent_config.settings.stackl_host
+        configuration.connection_pool_maxsize = agent_config.settings.max_jobs
+        stackl_api_client = stackl_client.ApiClient(
+            configuration=configuration)
+        self.stack_instance_api = stackl_client.StackInstancesApi(
+            api_client=stackl_api_client)
+        self.functional_requirement_api = stackl_client.FunctionalRequirementsApi(
+            api_client=stackl_api_client)
+
+        self._cache = {}
+        self._lock = threading.Lock()
+
+    def _get_cached(self, key, fetch):
+        with self._lock:
+            cached = self._cache.get(key)
+        if cached is None or cached[0] < time.monotonic():
+            cached = (time.monotonic() + agent_config.settings.client_cache_ttl,
+                      fetch())
+            with self._lock:
+                self._cache[key] = cached
+        # Handlers change the documents they get
+        return copy.deepcopy(cached[1])
+
+    def get_functional_requirement(self, name):
+        """Returns a functional requirement"""
+        return self._get_cached(
+            ("functional_requirement", name), lambda: self.
+            functional_requirement_api.get_functional_requirement_by_name(name))
+
+    def get_stack_instance(self, name):
+        """Returns a stack instance"""
+        return self._get_cached(
+            ("stack_instance", name),
+            lambda: self.stack_instance_api.get_stack_instance(name))
+
+    def forget_stack_instance(self, name):
+        """
+        Drops a cached stack instance, a finished job can have added outputs
+        to it which the next job needs
+        """
+        with self._lock:
+            self._cache.pop(("stack_instance", name), None)
@@ -322,8 +322,8 @@ class Invocation():
         self.tool = "ansible"
         self.action = "create"
 """
-    def __init__(self, invoc):
-        super().__init__(invoc)
+    def __init__(self, invoc, clients):
+        super().__init__(invoc, clients)
         self._secret_handler = get_secret_handler(invoc, self._stack_instance,
                                                   "yaml")
         if self._functional_requirement_obj.outputs:
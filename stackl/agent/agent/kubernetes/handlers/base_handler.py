@@ -1,22 +1,25 @@
 """
 This module contains all methods and classes for creating resources in kubernetes
 """
+import asyncio
 import logging
-import os
 import random
-from abc import ABC
+import time
 from string import ascii_lowercase, digits
-from time import sleep
 from typing import Dict, List
 
-import stackl_client
-from kubernetes import client, config
+from kubernetes import client
 from kubernetes.client.rest import ApiException
 
 from agent import config as agent_config
+from agent.async_handler import AsyncHandler, run_in_executor
+from agent.kubernetes.job_watcher import AGENT_LABEL, job_watcher
 from agent.kubernetes.outputs.output import Output
 from agent.kubernetes.secrets.conjur_secret_handler import ConjurSecretHandler
 
+#: Seconds without events of its pod after which a job is read
+JOB_CHECK_INTERVAL = 60
+
 
 def check_container_status(container_status):
     """
@@ -272,37 +275,26 @@ def create_cm(name: str, namespace: str, data: dict) -> client.V1ConfigMap:
     return cm
 
 
-class Handler(ABC):
+class Handler(AsyncHandler):
     # pylint: disable=too-many-instance-attributes
     """
     Base handler class used by the subclasses of the different automation tools
-    to provision resources through kubernetes
+    to provision resources through kubernetes. Calls to the Kubernetes API run
+    in the executor of the agent, the pods of jobs are followed with the watch
+    shared by all handlers
     """
-    def __init__(self, invoc):
-        if 'KUBERNETES_SERVICE_HOST' in os.environ:
-            config.load_incluster_config()
-        else:
-            config.load_kube_config()
+    def __init__(self, invoc, clients):
         logging.getLogger().setLevel(agent_config.settings.loglevel)
-        self._configuration = client.Configuration()
-        self._api_instance = client.BatchV1Api(
-            client.ApiClient(self._configuration))
-        self._api_instance_core = client.CoreV1Api(
-            client.ApiClient(self._configuration))
-        configuration = stackl_client.Configuration()
-        configuration.host = agent_config.settings.stackl_host
-        api_client = stackl_client.ApiClient(configuration=configuration)
-        self._stack_instance_api = stackl_client.StackInstancesApi(
-            api_client=api_client)
-        self._stack_fr_api = stackl_client.FunctionalRequirementsApi(
-            api_client=api_client)
+        self._clients = clients
+        self._api_instance = clients.batch_api
+        self._api_instance_core = clients.core_api
         self._invoc = invoc
         self._service = self._invoc.service
         self.hosts = self._invoc.hosts
         self._functional_requirement = self._invoc.functional_requirement
-        self._functional_requirement_obj = self._stack_fr_api.get_functional_requirement_by_name(
+        self._functional_requirement_obj = clients.get_functional_requirement(
             self._functional_requirement)
-        self._stack_instance = self._stack_instance_api.get_stack_instance(
+        self._stack_instance = clients.get_stack_instance(
             self._invoc.stack_instance)
         self._output = None
         self._env_from = {}
@@ -313,41 +305,85 @@ class Handler(ABC):
         self.service_account = agent_config.settings.service_account
         self._secret_handler = None
 
-    def wait_for_job(self, job_pod_name: str, namespace: str, job):
+    async def wait_for_job(self, events, namespace: str, job):
         """
-        This method polls every 5 seconds to see if the job is ready
+        Waits for the events of the pod of the job until it is ready or failed.
+        The job is read when its pod sends no events for a while, its pod may
+        never have been created or an event may have been missed while the
+        watch reconnected. Returns whether it succeeded, the error, the name
+        of the failed container and the name of the pod
         """
+        timeout = self._invoc.timeout or agent_config.settings.job_timeout
+        deadline = time.monotonic() + timeout
         while True:
-            sleep(5)
-            job = self._api_instance.read_namespaced_job(
-                job.metadata.name, namespace)
-            error, msg = check_job_status(job)
-            if error:
-                return False, msg, None
-            api_response = self._api_instance_core.read_namespaced_pod_status(
-                job_pod_name, namespace)
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False, f"job did not finish within {timeout} seconds", None, None
+            try:
+                event_type, pod = await asyncio.wait_for(
+                    events.get(), min(JOB_CHECK_INTERVAL, remaining))
+            except asyncio.TimeoutError:
+                result = await self._read_job_result(namespace,
+                                                     job.metadata.name)
+                if result is not None:
+                    return result
+                continue
+            if event_type == "DELETED":
+                # The pod of a job is deleted when its deadline is exceeded
+                job = await run_in_executor(
+                    self._api_instance.read_namespaced_job, job.metadata.name,
+                    namespace)
+                _, msg = check_job_status(job)
+                return False, msg or "pod of the job was deleted", None, pod.metadata.name
             # Check init container statuses
-            for init_cs in api_response.status.init_container_statuses:
+            for init_cs in pod.status.init_container_statuses or []:
                 error, msg = check_container_status(init_cs)
                 if error:
-                    return False, msg, init_cs.name
+                    return False, msg, init_cs.name, pod.metadata.name
             # Check container statuses
-            containers_ready = True
-            for cs in api_response.status.container_statuses:
+            container_statuses = pod.status.container_statuses or []
+            containers_ready = bool(container_statuses)
+            for cs in container_statuses:
                 error, msg = check_container_status(cs)
                 if error:
-                    return False, msg, cs.name
+                    return False, msg, cs.name, pod.metadata.name
                 if cs.state.terminated is None or \
                     cs.state.terminated.reason != 'Completed':
                     containers_ready = False
             if containers_ready:
-                return True, "", None
+                return True, "", None, pod.metadata.name
+            if pod.status.phase == "Failed":
+                return False, f"pod of the job failed: {pod.status.reason}", None, pod.metadata.name
 
+    async def _read_job_result(self, namespace: str, job_name: str):
+        """
+        Reads a job, returns the result of wait_for_job once the job finished
+        or None while it runs
+        """
+        job = await run_in_executor(self._api_instance.read_namespaced_job,
+                                    job_name, namespace)
+        if job.status.succeeded:
+            return True, "", None, None
+        failed, msg = check_job_status(job)
+        if failed:
+            return False, msg, None, None
+        if job.status.failed:
+            return False, "job failed", None, None
+        return None
 
-    def handle(self):
+    async def handle(self):
         """
         Entrypoint for handling
         """
+        try:
+            return await self._handle()
+        finally:
+            self._clients.forget_stack_instance(self._invoc.stack_instance)
+
+    async def _handle(self):
+        """
+        Creates the job and waits for it
+        """
         logging.info(f"Invocation: {self._invoc}")
         logging.info(f"Action: {self._invoc.action}")
 
@@ -358,7 +394,8 @@ class Handler(ABC):
             "stackl.io/stack-instance": self._invoc.stack_instance,
             "stackl.io/service": self._invoc.service,
             "stackl.io/functional-requirement":
-            self._invoc.functional_requirement
+            self._invoc.functional_requirement,
+            AGENT_LABEL: agent_config.settings.agent_name
         }
         body, cms = create_job_object(name=name,
                                       container_image=container_image,
@@ -372,34 +409,37 @@ class Handler(ABC):
                                       output=self._output,
                                       labels=labels)
 
-        try:
-            for cm in cms:
-                self._api_instance_core.create_namespaced_config_map(
-                    self.stackl_namespace, cm)
-            created_job = self._api_instance.create_namespaced_job(
-                self.stackl_namespace, body, pretty=True)
-        except ApiException as e:
-            logging.error(
-                f"Exception when calling BatchV1Api->create_namespaced_job: {e}\n"
-            )
-        logging.debug("job created")
-        sleep(5)
-        job_pods = self._api_instance_core.list_namespaced_pod(
-            self.stackl_namespace,
-            label_selector=f"job-name={created_job.metadata.name}")
-        job_succeeded, job_status, job_container_name = self.wait_for_job(
-            job_pods.items[0].metadata.name, self.stackl_namespace,
-            created_job)
+        with job_watcher.follow(body.metadata.name,
+                                self._api_instance_core) as events:
+            try:
+                for cm in cms:
+                    await run_in_executor(
+                        self._api_instance_core.create_namespaced_config_map,
+                        self.stackl_namespace, cm)
+                created_job = await run_in_executor(
+                    self._api_instance.create_namespaced_job,
+                    self.stackl_namespace,
+                    body,
+                    pretty=True)
+            except ApiException as e:
+                logging.error(
+                    f"Exception when calling BatchV1Api->create_namespaced_job: {e}\n"
+                )
+            logging.debug("job created")
+            job_succeeded, job_status, job_container_name, job_pod_name = await self.wait_for_job(
+                events, self.stackl_namespace, created_job)
 
         if job_succeeded:
             print("job succeeded")
             try:
                 for cm in cms:
-                    self._api_instance_core.delete_namespaced_config_map(
+                    await run_in_executor(
+                        self._api_instance_core.delete_namespaced_config_map,
                         cm.metadata.name, self.stackl_namespace)
-                self._api_instance.delete_namespaced_job(body.metadata.name,
-                                                         self.stackl_namespace,
-                                                         pretty=True)
+                await run_in_executor(self._api_instance.delete_namespaced_job,
+                                      body.metadata.name,
+                                      self.stackl_namespace,
+                                      pretty=True)
 
             except ApiException as e:
                 logging.error(
@@ -409,8 +449,9 @@ class Handler(ABC):
 
         print("job failed")
         if job_status == "failed":
-            error_msg = self._api_instance_core.read_namespaced_pod_log(
-                job_pods.items[0].metadata.name,
+            error_msg = await run_in_executor(
+                self._api_instance_core.read_namespaced_pod_log,
+                job_pod_name,
                 self.stackl_namespace,
                 container=job_container_name)
         else:
@@ -13,8 +13,8 @@ class PackerHandler(Handler):
     """
     Class used for preparing everything for starting packer
     """
-    def __init__(self, invoc):
-        super().__init__(invoc)
+    def __init__(self, invoc, clients):
+        super().__init__(invoc, clients)
         self._secret_handler = get_secret_handler(invoc, self._stack_instance,
                                                   "json")
         if self._functional_requirement_obj.outputs:
@@ -24,8 +24,8 @@ class TerraformHandler(Handler):
             self.tool = "terraform"
             self.action = "create"
     """
-    def __init__(self, invoc):
-        super().__init__(invoc)
+    def __init__(self, invoc, clients):
+        super().__init__(invoc, clients)
         self._secret_handler = get_secret_handler(invoc, self._stack_instance,
                                                   "json")
         self._command = ["/bin/sh", "-c"]
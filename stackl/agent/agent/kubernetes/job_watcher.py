@@ -0,0 +1,83 @@
+"""
+Module for following the pods of automation jobs with a single watch
+"""
+import asyncio
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+from kubernetes import watch
+
+from agent import config as agent_config
+
+#: Label on the pods of the jobs of an agent, the watch selects on it
+AGENT_LABEL = "stackl.io/agent"
+
+#: Seconds after which the API server ends a watch, it is started again
+WATCH_TIMEOUT = 300
+
+
+class JobWatcher:
+    """
+    Watches the pods of all jobs of the agent and hands their events to the
+    handlers waiting for them, instead of every handler polling its own job
+    """
+    def __init__(self):
+        self._waiters = {}
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def _start(self, api_instance_core):
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self._watch,
+                                            args=(api_instance_core, ),
+                                            name="job-watcher",
+                                            daemon=True)
+            self._thread.start()
+
+    def _watch(self, api_instance_core):
+        label_selector = f"{AGENT_LABEL}={agent_config.settings.agent_name}"
+        while True:
+            try:
+                # A new watch starts with the current pods, so the events
+                # missed between two watches are not lost
+                for event in watch.Watch().stream(
+                        api_instance_core.list_namespaced_pod,
+                        agent_config.settings.stackl_namespace,
+                        label_selector=label_selector,
+                        timeout_seconds=WATCH_TIMEOUT):
+                    self._dispatch(event["type"], event["object"])
+            except Exception as e:  # pylint: disable=broad-except
+                logging.error(f"Watch on the pods of jobs failed: {e}")
+                time.sleep(1)
+
+    def _dispatch(self, event_type, pod):
+        job_name = (pod.metadata.labels or {}).get("job-name")
+        with self._lock:
+            waiter = self._waiters.get(job_name)
+        if waiter is not None:
+            loop, events = waiter
+            loop.call_soon_threadsafe(events.put_nowait, (event_type, pod))
+
+    @contextmanager
+    def follow(self, job_name, api_instance_core):
+        """
+        Returns a queue with the events of the pods of a job, follow the job
+        before creating it so no event is missed. The watch uses the core API
+        client of the handlers
+        """
+        events = asyncio.Queue()
+        with self._lock:
+            self._waiters[job_name] = (asyncio.get_event_loop(), events)
+        self._start(api_instance_core)
+        try:
+            yield events
+        finally:
+            with self._lock:
+                del self._waiters[job_name]
+
+
+job_watcher = JobWatcher()
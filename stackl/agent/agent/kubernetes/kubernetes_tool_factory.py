@@ -11,16 +11,19 @@ class KubernetesToolFactory(ToolFactory):
     """
     KubernetesToolFactory Class
     """
+    def __init__(self, clients):
+        self.clients = clients
+
     def get_handler(self, invoc):
         """
         Returns the right handler for the chosen tool
         """
         if invoc.tool == "terraform":
-            return TerraformHandler(invoc)
+            return TerraformHandler(invoc, self.clients)
         if invoc.tool == "ansible":
-            return AnsibleHandler(invoc)
+            return AnsibleHandler(invoc, self.clients)
         if invoc.tool == "packer":
-            return PackerHandler(invoc)
+            return PackerHandler(invoc, self.clients)
         raise ValueError(
             "[ToolFactory] Tool '{}' is not recognized".format(
                 invoc["tool"]))
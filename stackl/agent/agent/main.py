@@ -3,17 +3,21 @@ Entrypoint for Stackl Agent
 """
 
 import asyncio
+import json
 from dataclasses import dataclass
 from typing import List
 
 from arq.connections import RedisSettings
 
 from agent import config
+from agent.async_handler import AsyncHandler, SyncHandlerAdapter, run_in_executor
+from agent.kubernetes.client_registry import ClientRegistry
 from agent.kubernetes.kubernetes_tool_factory import KubernetesToolFactory
 from agent.mock.mock_tool_factory import MockToolFactory
 
 if config.settings.agent_type == "kubernetes":
-    tool_factory = KubernetesToolFactory()
+    # The clients and their connection pools are shared by all handlers
+    tool_factory = KubernetesToolFactory(ClientRegistry())
 elif config.settings.agent_type == "mock":
     tool_factory = MockToolFactory()
 
@@ -36,14 +40,7 @@ class Invocation:
     hosts: List
     playbook_path: str = None
     serial: int = 10
-
-
-async def run_in_executor(func, *args):
-    """
-    Helper function for async automations
-    """
-    loop = asyncio.get_event_loop()
-    return await loop.run_in_executor(None, func, *args)
+    timeout: int = None
 
 
 async def invoke_automation(ctx, invoc):
@@ -52,26 +49,55 @@ async def invoke_automation(ctx, invoc):
     Method that will handle invocations from Stackl Core
     """
     print(invoc)
-    invocation = Invocation(**invoc)
-    handler = tool_factory.get_handler(invocation)
+    automation_result = invoc
+    # Core waits for a result on the stream, so every outcome is published
+    result, error_message = 1, "invoked job was cancelled"
     try:
-        result, error_message = await run_in_executor(handler.handle)
+        result, error_message = await _handle(Invocation(**invoc))
     except asyncio.TimeoutError:
-        result = 1
         error_message = "timeout in invoked job"
-    print(result)
-    print(error_message)
-    automation_result = invoc
-    if result == 0:
-        automation_result['status'] = "READY"
-    else:
-        automation_result['status'] = "FAILED"
-        automation_result['error_message'] = error_message
-
-    print("Handle done")
+    except Exception as err:  # pylint: disable=broad-except
+        error_message = f"invoked job failed: {err}"
+    finally:
+        print(result)
+        print(error_message)
+        if result == 0:
+            automation_result['status'] = "READY"
+        else:
+            automation_result['status'] = "FAILED"
+            automation_result['error_message'] = error_message
+        print("Handle done")
+        await publish_result(ctx, automation_result)
     return automation_result
 
 
+async def _handle(invocation):
+    """Runs the handler of an invocation"""
+    # Handlers can read documents from Stackl Core when they are created
+    handler = await run_in_executor(tool_factory.get_handler, invocation)
+    if not isinstance(handler, AsyncHandler):
+        handler = SyncHandlerAdapter(handler)
+    return await handler.handle()
+
+
+async def publish_result(ctx, automation_result):
+    """
+    Adds the result of a job to the job results stream, Stackl Core waits
+    for it there
+    """
+    try:
+        fields = {
+            "job_id": ctx['job_id'],
+            "result": json.dumps(automation_result)
+        }
+        await ctx['redis'].xadd(config.settings.job_results_stream,
+                                fields,
+                                max_len=config.settings.job_results_max_len)
+    except Exception as err:  # pylint: disable=broad-except
+        # Core still finds the result arq keeps, once its wait times out
+        print(f"Could not publish result of job {ctx['job_id']}: {err}")
+
+
 class AgentSettings:
     """
     Settings used by arq, for more info see: https://arq-docs.helpmanual.io/
@@ -0,0 +1,56 @@
+import asyncio
+from types import SimpleNamespace
+
+from agent.kubernetes.handlers import base_handler
+from agent.kubernetes.handlers.base_handler import Handler
+
+job = SimpleNamespace(metadata=SimpleNamespace(name="stackl-job-test"))
+
+
+class FakeBatchApi:
+    def __init__(self, statuses):
+        self.statuses = statuses
+        self.reads = 0
+
+    def read_namespaced_job(self, name, namespace):
+        self.reads += 1
+        return SimpleNamespace(status=self.statuses.pop(0))
+
+
+def _wait_for_job(monkeypatch, statuses, timeout):
+    monkeypatch.setattr(base_handler, "JOB_CHECK_INTERVAL", 0.01)
+    handler = object.__new__(Handler)
+    handler._invoc = SimpleNamespace(timeout=timeout)  # pylint: disable=protected-access
+    handler._api_instance = FakeBatchApi(statuses)  # pylint: disable=protected-access
+
+    async def wait():
+        # No events of the pod of the job ever come in
+        return await handler.wait_for_job(asyncio.Queue(), "stackl", job)
+
+    return asyncio.run(wait()), handler._api_instance.reads  # pylint: disable=protected-access
+
+
+def _status(succeeded=None, failed=None):
+    return SimpleNamespace(succeeded=succeeded,
+                           failed=failed,
+                           active=None,
+                           conditions=None)
+
+
+def test_a_job_without_pod_events_is_read(monkeypatch):
+    (succeeded, _, _, _), reads = _wait_for_job(
+        monkeypatch, [_status(), _status(succeeded=1)], 10)
+    assert succeeded
+    assert reads == 2
+
+    (succeeded, msg, _, _), _ = _wait_for_job(monkeypatch,
+                                              [_status(failed=1)], 10)
+    assert not succeeded
+    assert msg == "job failed"
+
+
+def test_a_job_fails_when_it_does_not_finish_in_time(monkeypatch):
+    (succeeded, msg, _, _), _ = _wait_for_job(monkeypatch,
+                                              [_status()] * 100, 0.05)
+    assert not succeeded
+    assert msg == "job did not finish within 0.05 seconds"
@@ -0,0 +1,66 @@
+import asyncio
+import json
+
+from agent import main
+
+invocation = {
+    "action": "create",
+    "functional_requirement": "fr",
+    "service": "service",
+    "stack_instance": "instance",
+    "infrastructure_target": "target",
+    "before_command": None,
+    "image": "image",
+    "tool": "terraform",
+    "hosts": None
+}
+
+
+class FakeRedis:
+    def __init__(self):
+        self.added = []
+
+    async def xadd(self, stream, fields, max_len):
+        self.added.append((stream, fields))
+
+
+class FakeHandler:
+    def __init__(self, handle):
+        self.handle = handle
+
+
+def _invoke(monkeypatch, get_handler):
+    monkeypatch.setattr(main.tool_factory, "get_handler", get_handler)
+    redis = FakeRedis()
+    result = asyncio.run(
+        main.invoke_automation({
+            "job_id": "job",
+            "redis": redis
+        }, dict(invocation)))
+    assert [fields["job_id"] for _, fields in redis.added] == ["job"]
+    assert json.loads(redis.added[0][1]["result"]) == result
+    return result
+
+
+def test_the_result_of_a_job_is_published(monkeypatch):
+    result = _invoke(monkeypatch, lambda invoc: FakeHandler(lambda: (0, None)))
+    assert result["status"] == "READY"
+
+
+def test_a_failing_handler_publishes_a_failed_result(monkeypatch):
+    def handle():
+        raise RuntimeError("no cluster")
+
+    result = _invoke(monkeypatch, lambda invoc: FakeHandler(handle))
+    assert result["status"] == "FAILED"
+    assert result["error_message"] == "invoked job failed: no cluster"
+
+
+def test_a_failing_handler_factory_publishes_a_failed_result(monkeypatch):
+    def get_handler(invoc):
+        raise ValueError("Tool 'terraform' is not recognized")
+
+    result = _invoke(monkeypatch, get_handler)
+    assert result["status"] == "FAILED"
+    assert result["error_message"] == \
+        "invoked job failed: Tool 'terraform' is not recognized"
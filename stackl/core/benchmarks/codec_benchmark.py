@@ -0,0 +1,111 @@
+"""
+Benchmark for the datastore codecs
+
+Encodes and decodes stack instance documents with a growing amount of
+replicas with every codec whose packages are installed, and compares them
+with the stdlib json module the stores used before codecs.
+
+Usage (from stackl/core):
+    python -m benchmarks.codec_benchmark
+"""
+import json
+
+from benchmarks.timing import measure
+from core.datastore.codec import Codec
+
+REPLICA_COUNTS = [1, 50, 500]
+SERVICES = 5
+REPEATS = 20
+CODECS = [("json", ""), ("json", "zlib"), ("orjson", ""), ("orjson", "zlib"),
+          ("orjson", "zstd"), ("orjson", "lz4"), ("msgpack", ""),
+          ("msgpack", "zstd"), ("msgpack", "lz4")]
+
+
+def _stack_instance(replicas):
+    """A stack instance like the ones of a SAT with services on many targets"""
+    services = {}
+    statuses = []
+    for service in range(SERVICES):
+        definitions = []
+        for replica in range(replicas):
+            target = f"production.brussels.zone{replica % 3}"
+            hostname = f"service{service}-{replica:03}.example.com"
+            definitions.append({
+                "infrastructure_target": target,
+                "provisioning_parameters": {
+                    **{f"param_{i}": f"value {i}" for i in range(30)},
+                    "machine_names": [hostname],
+                    "cpus": 4,
+                    "memory": 8192
+                },
+                "cloud_provider": "vmware",
+                "secrets": {"password": "secret/data/service/password"},
+                "hosts": [hostname],
+                "resources": None,
+                "service": f"service{service}",
+                "agent": "agent",
+                "opa_outputs": {},
+                "outputs": {"ip": f"10.0.{service}.{replica % 255}"},
+                "packages": None,
+                "tags": {"environment": "production"}
+            })
+            for functional_requirement in ("terraform", "ansible"):
+                statuses.append({
+                    "service": f"service{service}",
+                    "functional_requirement": functional_requirement,
+                    "infrastructure_target": target,
+                    "status": "READY",
+                    "error_message": ""
+                })
+        services[f"service{service}"] = definitions
+    return {
+        "name": f"instance_{replicas}",
+        "type": "stack_instance",
+        "category": "items",
+        "deleted": False,
+        "groups": {},
+        "instance_params": {f"param_{i}": i for i in range(20)},
+        "service_params": {},
+        "service_secrets": {},
+        "instance_secrets": {},
+        "services": services,
+        "stack_infrastructure_template": "production",
+        "stack_application_template": "web",
+        "status": statuses,
+        "stages": None,
+        "version": 3
+    }
+
+
+def main():
+    """Runs the benchmark and prints the results"""
+    print(f"{'replicas':>8} {'codec':>16} {'size (KB)':>10} "
+          f"{'encode (ms)':>12} {'decode (ms)':>12}")
+    for replicas in REPLICA_COUNTS:
+        document = _stack_instance(replicas)
+        value = json.dumps(document).encode()
+        encode = measure(
+            lambda document=document: json.dumps(document).encode(), REPEATS)
+        decode = measure(lambda value=value: json.loads(value), REPEATS)
+        print(f"{replicas:>8} {'stdlib json':>16} {len(value) / 1024:>10.1f} "
+              f"{encode:>12.2f} {decode:>12.2f}")
+        for format_name, compression in CODECS:
+            try:
+                # Every document is compressed to compare the compressions
+                codec = Codec(format_name, compression, compression_min_size=0)
+            except ValueError:
+                continue
+            value = codec.encode(document)
+            assert codec.decode(value) == document
+            encode = measure(
+                lambda codec=codec, document=document: codec.encode(document),
+                REPEATS)
+            decode = measure(lambda codec=codec, value=value: codec.decode(value),
+                             REPEATS)
+            name = f"{format_name}+{compression}" if compression else format_name
+            print(f"{replicas:>8} {name:>16} {len(value) / 1024:>10.1f} "
+                  f"{encode:>12.2f} {decode:>12.2f}")
+
+
+if __name__ == "__main__":
+    main()
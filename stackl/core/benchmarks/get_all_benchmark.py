@@ -0,0 +1,70 @@
+"""
+Benchmark for RedisStore.get_all
+
+Compares the batched index + MGET read path with the previous SCAN + GET per
+key path for a growing amount of stack instance documents.
+
+Usage (from stackl/core, with a Redis reachable through the core settings):
+    python -m benchmarks.get_all_benchmark
+"""
+import json
+
+from loguru import logger
+
+from benchmarks.timing import measure
+from core.datastore.redis_store import RedisStore
+
+DOCUMENT_COUNTS = [100, 1000, 5000]
+REPEATS = 3
+PREFIX = "benchmark_get_all_"
+
+
+def _stack_instance(index):
+    return {
+        "name": f"{PREFIX}{index}",
+        "type": "stack_instance",
+        "category": "items",
+        "stack_infrastructure_template": "benchmark",
+        "stack_application_template": "benchmark",
+        "instance_params": {f"param_{i}": i for i in range(20)},
+        "services": {
+            "service": [{
+                "infrastructure_target": "env.location.zone",
+                "provisioning_parameters": {f"key_{i}": "value" for i in range(20)}
+            }]
+        }
+    }
+
+
+def _get_all_per_key(store, pattern):
+    """The get_all implementation before batching"""
+    return [json.loads(store.redis.get(key)) for key in store.redis.scan_iter(pattern)]
+
+
+def main():
+    """Runs the benchmark and prints the results"""
+    # Logging every StoreResponse would dominate the measurements
+    logger.remove()
+    store = RedisStore()
+    pattern = f"items/stack_instance/{PREFIX}*"
+    print(f"{'documents':>10} {'scan+get (ms)':>15} {'index+mget (ms)':>15}")
+    try:
+        for count in DOCUMENT_COUNTS:
+            for index in range(count):
+                store.put(_stack_instance(index))
+            per_key = measure(lambda: _get_all_per_key(store, pattern),
+                              REPEATS)
+            batched = measure(
+                lambda: store.get_all(
+                    "items", "stack_instance", wildcard_prefix=PREFIX),
+                REPEATS)
+            print(f"{count:>10} {per_key:>15.1f} {batched:>15.1f}")
+    finally:
+        for index in range(max(DOCUMENT_COUNTS)):
+            store.delete(category="items",
+                         type="stack_instance",
+                         name=f"{PREFIX}{index}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+"""
+Load test for the Redis pool used to enqueue automation jobs
+
+Sends concurrent POST requests to /stack_instances and samples the amount of
+clients connected to Redis, once with the shared pool and once with a new
+pool per request like before.
+
+Usage (from stackl/core, with a Redis reachable through the core settings):
+    python -m benchmarks.redis_pool_load_test
+"""
+import asyncio
+
+import httpx
+import redis
+from arq import create_pool
+from arq.connections import RedisSettings
+from loguru import logger
+
+from core import config
+from core.main import app
+from core.manager import stackl_manager
+
+REQUESTS = 200
+CONCURRENCY = 50
+
+
+async def _get_redis_per_request():
+    """The get_redis implementation before the pool was shared"""
+    return await create_pool(
+        RedisSettings(host=config.settings.stackl_redis_host,
+                      port=config.settings.stackl_redis_port,
+                      password=config.settings.stackl_redis_password))
+
+
+def _connected_clients(client):
+    return client.info("clients")["connected_clients"]
+
+
+async def _load(client):
+    """
+    Posts stack instances for a template which does not exist, the request
+    is rejected after the Redis dependency was resolved
+    """
+    stack_instance = {
+        "stack_infrastructure_template": "redis_pool_load_test",
+        "stack_application_template": "redis_pool_load_test",
+        "params": {},
+        "tags": {},
+        "replicas": {},
+        "services": []
+    }
+    limit = asyncio.Semaphore(CONCURRENCY)
+
+    async def post(index):
+        async with limit:
+            await client.post("/stack_instances",
+                              json={
+                                  **stack_instance, "stack_instance_name":
+                                  f"redis_pool_load_test_{index}"
+                              })
+
+    await asyncio.gather(*[post(index) for index in range(REQUESTS)])
+
+
+async def _measure(redis_client):
+    before = _connected_clients(redis_client)
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app),
+                                 base_url="http://stackl") as client:
+        await _load(client)
+    return before, _connected_clients(redis_client)
+
+
+async def main():
+    """Runs the load test and prints the results"""
+    logger.remove()
+    redis_client = redis.Redis(host=config.settings.stackl_redis_host,
+                               port=config.settings.stackl_redis_port,
+                               password=config.settings.stackl_redis_password)
+    print(f"{REQUESTS} requests, {CONCURRENCY} concurrent")
+    print(f"{'get_redis':>12} {'clients before':>15} {'clients after':>14}")
+
+    await stackl_manager.create_redis_pool()
+    try:
+        before, after = await _measure(redis_client)
+        print(f"{'shared':>12} {before:>15} {after:>14}")
+    finally:
+        await stackl_manager.close_redis_pool()
+
+    app.dependency_overrides[
+        stackl_manager.get_redis] = _get_redis_per_request
+    try:
+        before, after = await _measure(redis_client)
+        print(f"{'per request':>12} {before:>15} {after:>14}")
+    finally:
+        app.dependency_overrides = {}
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
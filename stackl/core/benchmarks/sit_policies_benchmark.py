@@ -0,0 +1,145 @@
+"""
+Benchmark for StackHandler.evaluate_sit_policies
+
+Compares evaluating every SIT policy check one after the other with the
+concurrent evaluation, against a local stand-in for OPA which answers every
+request after a fixed latency.
+
+Usage (from stackl/core):
+    python -m benchmarks.sit_policies_benchmark
+"""
+import asyncio
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+
+from loguru import logger
+
+from core.handler.stack_handler import StackHandler
+from core.models.configs.policy_template_model import PolicyTemplate
+from core.opa_broker.opa_broker import OPABroker
+
+SERVICES = 20
+TARGETS = 10
+POLICIES = 3
+LATENCIES = [0.001, 0.005, 0.02]
+
+
+class _OPAStandIn(BaseHTTPRequestHandler):
+    """Answers every query with an empty list of infringements"""
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+    latency = 0
+
+    def _respond(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        time.sleep(self.latency)
+        body = json.dumps({"result": []}).encode()
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_PUT = do_POST = _respond
+
+    def log_message(self, *args):  # pylint: disable=arguments-differ
+        pass
+
+
+def _evaluate_serially(handler, opa_data, service_targets, stack_infr,
+                       item_params):
+    """The evaluate_sit_policies implementation before it was concurrent"""
+    infringment_messages = []
+    for _, service_definition in service_targets['result']['services'].items():
+        for t in service_definition['targets']:
+            policies = stack_infr.infrastructure_capabilities[t].policies
+            for policy_name, policy_attributes in policies.items():
+                policy = handler.context.get_policy_template(policy_name)
+                handler.opa_broker.add_policy(policy.name, policy.policy)
+                policy_input = {
+                    "parameters": policy_attributes,
+                    "stack_instance_params": item_params,
+                    "target": t
+                }
+                opa_result = handler.opa_broker.ask_opa_policy_decision(
+                    policy.name, "infringement", {
+                        **opa_data,
+                        **policy_input
+                    })
+                infringment_messages.extend(opa_result['result'])
+    return infringment_messages
+
+
+def _stack_request():
+    targets = [f"env.location.zone{index}" for index in range(TARGETS)]
+    policy_names = [f"benchmark_policy_{index}" for index in range(POLICIES)]
+    stack_infr = SimpleNamespace(
+        infrastructure_capabilities={
+            target: SimpleNamespace(
+                policies={name: {
+                    "target": target
+                }
+                          for name in policy_names})
+            for target in targets
+        })
+    service_targets = {
+        "result": {
+            "services": {
+                f"service_{index}": {
+                    "targets": targets
+                }
+                for index in range(SERVICES)
+            }
+        }
+    }
+    policy_templates = {
+        name: PolicyTemplate(name=name,
+                             policy=f"package {name}",
+                             inputs=[])
+        for name in policy_names
+    }
+    return stack_infr, service_targets, policy_templates
+
+
+def main():
+    """Runs the benchmark and prints the results"""
+    logger.remove()
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _OPAStandIn)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    stack_infr, service_targets, policy_templates = _stack_request()
+    checks = SERVICES * TARGETS * POLICIES
+    print(f"{checks} policy checks")
+    print(f"{'latency (ms)':>12} {'serial (ms)':>12} {'concurrent (ms)':>16}")
+    try:
+        for latency in LATENCIES:
+            _OPAStandIn.latency = latency
+            opa_broker = OPABroker()
+            opa_broker.connection.host = f"http://127.0.0.1:{server.server_port}"
+            handler = StackHandler(None, opa_broker)
+            handler.context.policy_templates = policy_templates
+
+            start = time.perf_counter()
+            _evaluate_serially(handler, {}, service_targets, stack_infr, {})
+            serial = (time.perf_counter() - start) * 1000
+
+            async def evaluate():
+                try:
+                    await handler.evaluate_sit_policies({}, service_targets,
+                                                        stack_infr, {})
+                finally:
+                    await opa_broker.close()
+
+            start = time.perf_counter()
+            asyncio.run(evaluate())
+            concurrent = (time.perf_counter() - start) * 1000
+            print(f"{latency * 1000:>12.0f} {serial:>12.0f} {concurrent:>16.0f}")
+    finally:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
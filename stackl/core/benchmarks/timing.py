@@ -0,0 +1,17 @@
+"""
+Module for timing the code measured by the benchmarks
+"""
+import time
+
+
+def measure(func, repeats):
+    """
+    Calls func repeats times, returns the fastest call in milliseconds so
+    the noise of the other processes is left out
+    """
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+    return min(timings) * 1000
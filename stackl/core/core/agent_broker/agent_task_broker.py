@@ -3,17 +3,67 @@ Module for handling the delivery and results of automation jobs
 """
 
 import asyncio
+import functools
+import uuid
 
 from loguru import logger
 
 from core import config
+from core.agent_broker.job_results import job_results
 from core.handler.stack_handler import delete_services
-from core.manager.stackl_manager import get_snapshot_manager, get_document_manager
-from core.models.items.stack_instance_model import StackInstance
-
-
-async def create_service(action, redis, stack_instance, to_be_deleted,
-                         force_delete, service_name, service):
+from core.manager.stackl_manager import get_document_manager
+
+
+class JobLimiter:
+    """
+    Limits the amount of automation jobs running at the same time, in total
+    and per agent queue
+    """
+
+    def __init__(self):
+        self._loop = None
+        self._global_slots = None
+        self._queue_slots = {}
+
+    def _get_slots(self, queue_name):
+        # Semaphores are bound to the event loop they are used in
+        loop = asyncio.get_event_loop()
+        if self._loop is not loop:
+            self._loop = loop
+            self._global_slots = asyncio.Semaphore(
+                config.settings.stackl_max_concurrent_jobs)
+            self._queue_slots = {}
+        if queue_name not in self._queue_slots:
+            self._queue_slots[queue_name] = asyncio.Semaphore(
+                config.settings.stackl_max_concurrent_jobs_per_agent)
+        return self._global_slots, self._queue_slots[queue_name]
+
+    async def run(self, queue_name, job):
+        """Awaits a job once there is room for it"""
+        global_slots, queue_slots = self._get_slots(queue_name)
+        async with global_slots:
+            async with queue_slots:
+                return await job()
+
+
+job_limiter = JobLimiter()
+
+
+async def create_service(action,
+                         redis,
+                         stack_instance,
+                         to_be_deleted,
+                         force_delete,
+                         service_name,
+                         service,
+                         *,
+                         progress=None):
+    """
+    Runs the functional requirements of a service one after the other,
+    returns whether they all succeeded. With the progress of an orchestration
+    functional requirements which already finished are skipped and jobs which
+    were already enqueued are not enqueued again
+    """
     success = True
     document_manager = get_document_manager()
     service_doc = document_manager.get_service(service_name)
@@ -22,43 +72,40 @@ async def create_service(action, redis, stack_instance, to_be_deleted,
         functional_requirements = reversed(functional_requirements)
     for fr in functional_requirements:
         fr_doc = document_manager.get_functional_requirement(fr)
-        fr_jobs = []
-        infrastructure_target = service.infrastructure_target
-        cloud_provider = service.cloud_provider
         logger.debug(
             f"Retrieved fr '{fr_doc}' from service_doc '{service_doc}'")
-        invoc = {}
-        invoc['action'] = action
-        invoc['functional_requirement'] = fr
-        invoc['image'] = fr_doc.invocation[cloud_provider].image
-        invoc['before_command'] = fr_doc.invocation[
-            cloud_provider].before_command
-        invoc['infrastructure_target'] = infrastructure_target
-        invoc['stack_instance'] = stack_instance.name
-        tool = fr_doc.invocation[cloud_provider].tool
-        invoc['tool'] = tool
-        if tool.lower() == "ansible":
-            if fr_doc.invocation[cloud_provider].playbook_path is not None:
-                invoc['playbook_path'] = fr_doc.invocation[
-                    cloud_provider].playbook_path
-            if fr_doc.invocation[cloud_provider].serial is not None:
-                invoc['serial'] = fr_doc.invocation[cloud_provider].serial
-        invoc['service'] = service_name
-        invoc["hosts"] = service.hosts
+        invoc = _get_invocation(action, stack_instance, service_name, service,
+                                fr_doc)
+        job_key = f"{service_name}/{fr}/{service.infrastructure_target}"
+        if progress is not None:
+            status = await progress.get_result(job_key)
+            if status is not None:
+                logger.debug(f"Job '{job_key}' already finished with {status}")
+                if status == "FAILED":
+                    success = False
+                if not force_delete and not success:
+                    break
+                continue
         logger.debug("Appending job")
-        job = await redis.enqueue_job("invoke_automation",
-                                      invoc,
-                                      _queue_name=service.agent)
-        fr_jobs.append(asyncio.create_task(job.result(timeout=7200)))
         if fr_doc.as_group:
+            job_id = await _get_job_id(progress, job_key)
+            await redis.enqueue_job("invoke_automation",
+                                    invoc,
+                                    _job_id=job_id,
+                                    _queue_name=service.agent)
             logger.debug("running as group")
             break
-        for fr_job in asyncio.as_completed(fr_jobs):
-            automation_result = await fr_job
-            await update_status(automation_result, stack_instance, action,
-                                to_be_deleted)
-            if automation_result["status"] == "FAILED":
-                success = False
+
+        automation_result = await job_limiter.run(
+            service.agent,
+            functools.partial(_run_job, redis, service.agent, invoc, job_key,
+                              progress))
+        await update_status(automation_result, stack_instance, action,
+                            to_be_deleted)
+        if progress is not None:
+            await progress.set_result(job_key, automation_result["status"])
+        if automation_result["status"] == "FAILED":
+            success = False
         if not force_delete and not success:
             logger.debug("Not all fr's succeeded, stopping execution")
             break
@@ -66,29 +113,67 @@ async def create_service(action, redis, stack_instance, to_be_deleted,
     return success
 
 
-async def create_job_for_agent(stack_instance,
-                               action,
-                               redis,
-                               first_run=True,
-                               force_delete=False):
-    """creates jobs and puts them on the right agent queue"""
-    logger.debug(
-        f"For stack_instance '{stack_instance}' and action '{action}'")
-
-    success = await create_job_per_service(stack_instance.services, action,
-                                           redis, stack_instance, force_delete)
-
-    document_manager = get_document_manager()
-    if action == "delete" and (success or force_delete):
-        document_manager.delete_stack_instance(stack_instance.name)
-    elif not success and first_run and config.settings.rollback_enabled:
-        snapshot_document = get_snapshot_manager().restore_latest_snapshot(
-            "stack_instance", stack_instance.name)
-        stack_instance = StackInstance.parse_obj(snapshot_document["snapshot"])
-        await create_job_for_agent(stack_instance,
-                                   action,
-                                   redis,
-                                   first_run=False)
+def _get_invocation(action, stack_instance, service_name, service, fr_doc):
+    """Returns the invocation sent to the agent for a functional requirement"""
+    invocation = fr_doc.invocation[service.cloud_provider]
+    invoc = {}
+    invoc['action'] = action
+    invoc['functional_requirement'] = fr_doc.name
+    invoc['image'] = invocation.image
+    invoc['before_command'] = invocation.before_command
+    invoc['infrastructure_target'] = service.infrastructure_target
+    invoc['stack_instance'] = stack_instance.name
+    invoc['tool'] = invocation.tool
+    if invocation.tool.lower() == "ansible":
+        if invocation.playbook_path is not None:
+            invoc['playbook_path'] = invocation.playbook_path
+        if invocation.serial is not None:
+            invoc['serial'] = invocation.serial
+    invoc['service'] = service_name
+    invoc["hosts"] = service.hosts
+    # The agent stops waiting for the job when core does
+    invoc['timeout'] = fr_doc.timeout or config.settings.stackl_job_timeout
+    return invoc
+
+
+async def _run_job(redis, queue_name, invoc, job_key, progress):
+    """
+    Enqueues the job of an invocation and waits for its result, a job which
+    gives no result within the timeout of the invocation failed
+    """
+    job_id = await _get_job_id(progress, job_key)
+    await job_results.expect(job_id)
+    # arq does not enqueue a job id it already knows
+    job = await redis.enqueue_job("invoke_automation",
+                                  invoc,
+                                  _job_id=job_id,
+                                  _queue_name=queue_name)
+    automation_result = await job_results.wait(job_id,
+                                               invoc['timeout'],
+                                               redis,
+                                               queue_name,
+                                               enqueued=job is not None)
+    if automation_result is None:
+        automation_result = {
+            **invoc, "status": "FAILED",
+            "error_message":
+            f"No result of the job within {invoc['timeout']} seconds"
+        }
+    return automation_result
+
+
+async def _get_job_id(progress, job_key):
+    """
+    Returns the id of the job of a functional requirement, the id is kept in
+    the progress of the orchestration before the job is enqueued
+    """
+    if progress is None:
+        return uuid.uuid4().hex
+    job_id = await progress.get_job_id(job_key)
+    if job_id is None:
+        job_id = uuid.uuid4().hex
+        await progress.set_job_id(job_key, job_id)
+    return job_id
 
 
 async def create_job_per_service(services,
@@ -96,30 +181,40 @@ async def create_job_per_service(services,
                                  redis,
                                  stack_instance,
                                  to_be_deleted=None,
-                                 force_delete=False):
-    success = True
-    stage_jobs = []
-    document_mananger = get_document_manager()
-    # do stages
+                                 force_delete=False,
+                                 *,
+                                 progress=None):
+    """
+    Runs the jobs of the given services. The functional requirements of a
+    service run in order, services run concurrently unless the stack
+    instance has stages, then the stages run one after the other.
+    Returns whether all jobs succeeded
+    """
     if stack_instance.stages:
-        for stage in stack_instance.stages:
-            for service_name in stage.services:
-                for service in stack_instance.services[service_name]:
-                    success = create_service(action, redis, stack_instance,
-                                             to_be_deleted, force_delete,
-                                             service_name, service)
-                    stage_jobs.append(asyncio.create_task(success))
-
-            await asyncio.gather(*stage_jobs)
-            stage_jobs = []
-
-    # not using stages
+        stages = [[
+            service_name for service_name in stage.services
+            if service_name in services
+        ] for stage in stack_instance.stages]
     else:
-        for service_name, service_list in services.items():
-            for service in service_list:
-                success = await create_service(action, redis, stack_instance,
-                                               to_be_deleted, force_delete,
-                                               service_name, service)
+        stages = [list(services)]
+
+    success = True
+    for stage in stages:
+        results = await asyncio.gather(*[
+            create_service(action,
+                           redis,
+                           stack_instance,
+                           to_be_deleted,
+                           force_delete,
+                           service_name,
+                           service,
+                           progress=progress)
+            for service_name in stage for service in services[service_name]
+        ])
+        success = success and all(results)
+        if not force_delete and not success:
+            logger.debug("Not all services succeeded, skipping next stages")
+            break
 
     return success
 
@@ -130,30 +225,19 @@ async def update_status(automation_result,
                         to_be_deleted=None):
     """Updates the status of a functional requirement in a stack instance"""
     document_manager = get_document_manager()
-    stack_instance = document_manager.get_stack_instance(stack_instance.name)
-    status_to_be_deleted = None
-    for status in stack_instance.status:
-        if status.functional_requirement == automation_result[
-            "functional_requirement"] and automation_result[
-            "infrastructure_target"] in status.infrastructure_target \
-                and status.service == automation_result["service"]:
-            status.service = automation_result["service"]
-            status.functional_requirement = automation_result[
-                "functional_requirement"]
-            if 'error_message' in automation_result:
-                error_message = automation_result["error_message"]
-            else:
-                error_message = ""
-            if action == "delete" and automation_result["status"] == "READY":
-                status_to_be_deleted = status
-            status.status = automation_result["status"]
-            status.error_message = error_message
-            break
-
-    if action == "delete":
-        if status_to_be_deleted:
-            stack_instance.status.remove(status_to_be_deleted)
-        if to_be_deleted:
-            delete_services(to_be_deleted, stack_instance)
-
-    document_manager.write_stack_instance(stack_instance)
+    status = {
+        "service": automation_result["service"],
+        "functional_requirement": automation_result["functional_requirement"],
+        "infrastructure_target": automation_result["infrastructure_target"],
+        "status": automation_result["status"],
+        "error_message": automation_result.get("error_message", "")
+    }
+    remove = action == "delete" and automation_result["status"] == "READY"
+    document_manager.update_stack_instance_status(stack_instance.name, status,
+                                                  remove)
+
+    if action == "delete" and to_be_deleted:
+        document_manager.update_stack_instance(
+            stack_instance.name,
+            lambda stack_instance: delete_services(to_be_deleted,
+                                                   stack_instance))
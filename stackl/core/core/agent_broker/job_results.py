@@ -0,0 +1,136 @@
+"""
+Module for receiving the results of automation jobs
+
+Agents add the result of every job to a Redis stream. A single listener per
+core worker reads the stream and hands the results to the jobs waiting for
+them, instead of every job polling Redis for its own result.
+"""
+
+import asyncio
+import json
+
+import aioredis
+from arq.jobs import Job
+from loguru import logger
+
+from core import config
+
+
+class JobResults:
+    """Dispatches the results on the job results stream to waiting jobs"""
+
+    def __init__(self):
+        self._loop = None
+        self._redis = None
+        self._listener = None
+        self._latest_id = None
+        self._futures = {}
+
+    async def _connect(self):
+        # A blocking XREAD holds its connection, so the listener has its own
+        self._redis = await aioredis.create_redis(
+            (config.settings.stackl_redis_host,
+             config.settings.stackl_redis_port),
+            password=config.settings.stackl_redis_password,
+            encoding='utf8')
+
+    async def start(self):
+        """Starts listening on the job results stream if that did not happen yet"""
+        loop = asyncio.get_event_loop()
+        if self._loop is loop and self._listener is not None:
+            return
+        self._loop = loop
+        self._futures = {}
+        await self._connect()
+        # Results added from now on are read, this uses the clock of Redis
+        # because the stream ids are based on it
+        seconds, microseconds = await self._redis.execute("TIME")
+        self._latest_id = f"{int(seconds) * 1000 + int(microseconds) // 1000}-0"
+        self._listener = loop.create_task(self._listen())
+        logger.info(
+            f"[JobResults] Listening on '{config.settings.stackl_job_results_stream}'"
+        )
+
+    async def stop(self):
+        """Stops listening and closes the connection"""
+        if self._listener is not None:
+            self._listener.cancel()
+            try:
+                await self._listener
+            except asyncio.CancelledError:
+                pass
+            self._listener = None
+        if self._redis is not None:
+            self._redis.close()
+            await self._redis.wait_closed()
+            self._redis = None
+
+    async def _listen(self):
+        while True:
+            try:
+                entries = await self._redis.xread(
+                    [config.settings.stackl_job_results_stream],
+                    timeout=config.settings.stackl_job_results_block * 1000,
+                    latest_ids=[self._latest_id])
+            except (aioredis.RedisError, ConnectionError, OSError) as err:
+                logger.warning(
+                    f"[JobResults] Reading job results failed, reconnecting: {err}"
+                )
+                await asyncio.sleep(1)
+                try:
+                    self._redis.close()
+                    await self._connect()
+                except (aioredis.RedisError, ConnectionError, OSError):
+                    pass
+                continue
+            for _, entry_id, fields in entries:
+                self._latest_id = entry_id
+                self._dispatch(fields["job_id"], json.loads(fields["result"]))
+
+    def _dispatch(self, job_id, result):
+        # Results of jobs of other core workers are on the stream as well
+        future = self._futures.get(job_id)
+        if future is not None and not future.done():
+            future.set_result(result)
+
+    async def expect(self, job_id):
+        """
+        Registers a job before it is enqueued, so its result can not arrive
+        before anyone waits for it
+        """
+        await self.start()
+        self._futures[job_id] = asyncio.get_event_loop().create_future()
+
+    async def wait(self, job_id, timeout, redis, queue_name, enqueued=True):
+        """
+        Waits at most timeout seconds for the result of a job, when it did not
+        arrive on the stream the result kept by arq is checked once. A job
+        which was enqueued before, by a core worker that stopped, can have
+        finished already so then the result kept by arq is checked first.
+        Returns None when there is no result
+        """
+        try:
+            if not enqueued:
+                result = await self._get_kept_result(job_id, redis,
+                                                     queue_name)
+                if result is not None:
+                    return result
+            return await asyncio.wait_for(self._futures[job_id], timeout)
+        except asyncio.TimeoutError:
+            logger.warning(
+                f"[JobResults] No result for job '{job_id}' after {timeout} seconds"
+            )
+            return await self._get_kept_result(job_id, redis, queue_name)
+        finally:
+            self._futures.pop(job_id, None)
+
+    @staticmethod
+    async def _get_kept_result(job_id, redis, queue_name):
+        job_result = await Job(job_id, redis,
+                               _queue_name=queue_name).result_info()
+        if job_result is not None and job_result.success:
+            return job_result.result
+        return None
+
+
+job_results = JobResults()
@@ -0,0 +1,336 @@
+"""
+Module for the orchestration of automation jobs of stack instances
+
+The state of every orchestration is kept in Redis, so when a core worker
+stops while it runs jobs another worker, or the same one after a restart,
+resumes it. A lease makes sure only one worker drives the orchestrations of
+a stack instance, they are run one after the other.
+"""
+
+import asyncio
+import json
+import uuid
+
+import aioredis
+from loguru import logger
+
+from core import config
+from core.agent_broker.agent_task_broker import create_job_per_service
+from core.manager.stackl_manager import (get_document_manager, get_redis,
+                                         get_snapshot_manager)
+from core.models.items.stack_instance_model import StackInstance
+
+#: Set of the stack instances with orchestrations which did not finish
+ORCHESTRATED_INSTANCES_KEY = "orchestrations"
+
+#: Releases the lease of a stack instance if it has no orchestrations left,
+# returns 0 when there still are orchestrations
+RELEASE_IF_IDLE_SCRIPT = """
+if redis.call('LLEN', KEYS[1]) > 0 then
+    return 0
+end
+redis.call('SREM', KEYS[3], ARGV[2])
+if redis.call('GET', KEYS[2]) == ARGV[1] then
+    redis.call('DEL', KEYS[2])
+end
+return 1
+"""
+
+#: Extends a lease if it is still owned by the worker
+RENEW_LEASE_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('PEXPIRE', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+#: Deletes a lease if it is still owned by the worker
+RELEASE_LEASE_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+
+def get_queue_key(stack_instance_name):
+    """Returns the list of orchestration ids of a stack instance"""
+    return f"orchestrations:{stack_instance_name}"
+
+
+def get_lease_key(stack_instance_name):
+    """Returns the key of the lease on the orchestrations of a stack instance"""
+    return f"orchestration_lease:{stack_instance_name}"
+
+
+def get_orchestration_key(orchestration_id):
+    """Returns the key of an orchestration"""
+    return f"orchestration:{orchestration_id}"
+
+
+class OrchestrationProgress:
+    """
+    The jobs of an orchestration that were enqueued and the results of the
+    ones that finished
+    """
+
+    def __init__(self, redis, orchestration_id):
+        self.redis = redis
+        self.jobs_key = get_orchestration_key(orchestration_id) + ":jobs"
+        self.results_key = get_orchestration_key(orchestration_id) + ":results"
+
+    async def get_job_id(self, job_key):
+        """Returns the id of the job enqueued for a functional requirement"""
+        return await self.redis.hget(self.jobs_key, job_key)
+
+    async def set_job_id(self, job_key, job_id):
+        """Keeps the id of a job before it is enqueued"""
+        await self.redis.hset(self.jobs_key, job_key, job_id)
+
+    async def get_result(self, job_key):
+        """Returns the status a finished job ended with"""
+        return await self.redis.hget(self.results_key, job_key)
+
+    async def set_result(self, job_key, status):
+        """Keeps the status a job ended with"""
+        await self.redis.hset(self.results_key, job_key, status)
+
+
+class Orchestrator:
+    """Runs the orchestrations of stack instances"""
+
+    def __init__(self):
+        self.worker_id = uuid.uuid4().hex
+        self._drivers = {}
+        self._resumer = None
+
+    async def submit(self,
+                     redis,
+                     stack_instance,
+                     action,
+                     *,
+                     services=None,
+                     remove_services=False,
+                     force_delete=False,
+                     first_run=True):
+        """
+        Adds an orchestration of the jobs of a stack instance. Without services
+        the jobs of all services of the stack instance are run. With
+        remove_services the services are removed from the stack instance once
+        they were deleted. Returns the id of the orchestration
+        """
+        orchestration_id = uuid.uuid4().hex
+        orchestration = {
+            "id": orchestration_id,
+            "stack_instance": stack_instance.to_stored(),
+            "action": action,
+            "services": services,
+            "remove_services": remove_services,
+            "force_delete": force_delete,
+            "first_run": first_run
+        }
+        transaction = redis.multi_exec()
+        transaction.set(get_orchestration_key(orchestration_id),
+                        json.dumps(orchestration))
+        transaction.rpush(get_queue_key(stack_instance.name), orchestration_id)
+        transaction.sadd(ORCHESTRATED_INSTANCES_KEY, stack_instance.name)
+        await transaction.execute()
+        logger.info(
+            f"[Orchestrator] Added orchestration '{orchestration_id}' to "
+            f"{action} stack instance '{stack_instance.name}'"
+        )
+        self._start_driver(redis, stack_instance.name)
+        return orchestration_id
+
+    def _start_driver(self, redis, stack_instance_name):
+        # A new driver starts after the previous one of this worker stopped,
+        # it finds the orchestrations that were added meanwhile
+        previous = self._drivers.get(stack_instance_name)
+        if previous is not None and previous.done():
+            previous = None
+        driver = asyncio.ensure_future(
+            self._drive(redis, stack_instance_name, previous))
+        self._drivers[stack_instance_name] = driver
+        driver.add_done_callback(lambda _: self._forget_driver(
+            stack_instance_name, driver))
+
+    def _forget_driver(self, stack_instance_name, driver):
+        if self._drivers.get(stack_instance_name) is driver:
+            del self._drivers[stack_instance_name]
+
+    async def _drive(self, redis, stack_instance_name, previous):
+        """Runs the orchestrations of a stack instance while holding its lease"""
+        if previous is not None:
+            await asyncio.wait([previous])
+        lease_key = get_lease_key(stack_instance_name)
+        lease = config.settings.stackl_orchestration_lease * 1000
+        acquired = await redis.set(lease_key,
+                                   self.worker_id,
+                                   pexpire=lease,
+                                   exist=redis.SET_IF_NOT_EXIST)
+        if not acquired:
+            logger.debug(
+                f"[Orchestrator] Stack instance '{stack_instance_name}' is "
+                "orchestrated by another worker"
+            )
+            return
+        driver = asyncio.current_task()
+        keeper = asyncio.ensure_future(self._keep_lease(redis, lease_key))
+
+        def stop_when_lease_lost(keeper):
+            if not keeper.cancelled():
+                driver.cancel()
+
+        keeper.add_done_callback(stop_when_lease_lost)
+        try:
+            while True:
+                orchestration_id = await redis.lindex(
+                    get_queue_key(stack_instance_name), 0)
+                if orchestration_id is None:
+                    if await redis.eval(RELEASE_IF_IDLE_SCRIPT,
+                                        keys=[
+                                            get_queue_key(stack_instance_name),
+                                            lease_key,
+                                            ORCHESTRATED_INSTANCES_KEY
+                                        ],
+                                        args=[
+                                            self.worker_id,
+                                            stack_instance_name
+                                        ]):
+                        return
+                    continue
+                try:
+                    await self._run(redis, orchestration_id)
+                except (aioredis.RedisError, ConnectionError, OSError):
+                    raise
+                except Exception:  # pylint: disable=broad-except
+                    # Running it again would fail the same way
+                    logger.exception(
+                        f"[Orchestrator] Orchestration '{orchestration_id}' failed"
+                    )
+                await self._finish(redis, stack_instance_name,
+                                   orchestration_id)
+        except asyncio.CancelledError:
+            logger.warning(
+                "[Orchestrator] Stopped driving stack instance "
+                f"'{stack_instance_name}'"
+            )
+            raise
+        except (aioredis.RedisError, ConnectionError, OSError) as err:
+            # The orchestration is resumed later
+            logger.error(
+                "[Orchestrator] Orchestration of stack instance "
+                f"'{stack_instance_name}' interrupted: {err}"
+            )
+        finally:
+            keeper.cancel()
+            await redis.eval(RELEASE_LEASE_SCRIPT,
+                             keys=[lease_key],
+                             args=[self.worker_id])
+
+    async def _keep_lease(self, redis, lease_key):
+        """Renews a lease until it is lost"""
+        lease = config.settings.stackl_orchestration_lease * 1000
+        while True:
+            await asyncio.sleep(lease / 3000)
+            if not await redis.eval(RENEW_LEASE_SCRIPT,
+                                    keys=[lease_key],
+                                    args=[self.worker_id, lease]):
+                logger.error(f"[Orchestrator] Lost lease '{lease_key}'")
+                return
+
+    async def _run(self, redis, orchestration_id):
+        """Runs the jobs of an orchestration, it continues where it stopped"""
+        orchestration = await redis.get(
+            get_orchestration_key(orchestration_id))
+        if orchestration is None:
+            return
+        orchestration = json.loads(orchestration)
+        stack_instance = StackInstance.parse_obj(
+            orchestration["stack_instance"])
+        action = orchestration["action"]
+        force_delete = orchestration["force_delete"]
+        logger.info(
+            f"[Orchestrator] Running orchestration '{orchestration_id}' to "
+            f"{action} stack instance '{stack_instance.name}'"
+        )
+        services = stack_instance.services
+        if orchestration["services"] is not None:
+            services = {
+                name: services[name]
+                for name in orchestration["services"]
+            }
+        to_be_deleted = None
+        if orchestration["remove_services"]:
+            to_be_deleted = [{name: service} for name, service in services.items()]
+
+        success = await create_job_per_service(
+            services,
+            action,
+            redis,
+            stack_instance,
+            to_be_deleted,
+            force_delete=force_delete,
+            progress=OrchestrationProgress(redis, orchestration_id))
+
+        if action == "delete" and orchestration["services"] is None and (
+                success or force_delete):
+            get_document_manager().delete_stack_instance(stack_instance.name)
+        elif not success and orchestration[
+                "first_run"] and config.settings.rollback_enabled:
+            snapshot_document = get_snapshot_manager().restore_latest_snapshot(
+                "stack_instance", stack_instance.name)
+            stack_instance = StackInstance.parse_obj(
+                snapshot_document["snapshot"])
+            await self.submit(redis, stack_instance, action, first_run=False)
+
+    @staticmethod
+    async def _finish(redis, stack_instance_name, orchestration_id):
+        orchestration_key = get_orchestration_key(orchestration_id)
+        transaction = redis.multi_exec()
+        transaction.lrem(get_queue_key(stack_instance_name), 1,
+                         orchestration_id)
+        transaction.delete(orchestration_key, orchestration_key + ":jobs",
+                           orchestration_key + ":results")
+        await transaction.execute()
+
+    async def resume(self, redis):
+        """
+        Drives the orchestrations of stack instances nobody holds a lease on,
+        because the worker that drove them stopped
+        """
+        for stack_instance_name in await redis.smembers(
+                ORCHESTRATED_INSTANCES_KEY):
+            if stack_instance_name not in self._drivers:
+                self._start_driver(redis, stack_instance_name)
+
+    async def start(self):
+        """Resumes orchestrations now and every time a lease can expire"""
+        if self._resumer is None:
+            self._resumer = asyncio.ensure_future(self._resume_periodically())
+
+    async def _resume_periodically(self):
+        while True:
+            try:
+                await self.resume(await get_redis())
+            except Exception as err:  # pylint: disable=broad-except
+                logger.warning(
+                    f"[Orchestrator] Could not resume orchestrations: {err}")
+            await asyncio.sleep(config.settings.stackl_orchestration_lease)
+
+    async def stop(self):
+        """
+        Stops driving orchestrations and releases their leases, so other
+        workers resume them
+        """
+        if self._resumer is not None:
+            self._resumer.cancel()
+            self._resumer = None
+        drivers = list(self._drivers.values())
+        for driver in drivers:
+            driver.cancel()
+        if drivers:
+            await asyncio.wait(drivers)
+
+
+orchestrator = Orchestrator()
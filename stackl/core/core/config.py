@@ -4,7 +4,7 @@ Config module used for configuration data of stackl core
 import logging
 
 from loguru import logger
-from pydantic import BaseSettings
+from pydantic import BaseSettings, Field
 
 
 class InterceptHandler(logging.Handler):
@@ -38,15 +38,56 @@ class Settings(BaseSettings):  # pylint: disable=too-few-public-methods
     # Datastore options
     stackl_store: str = "Redis"
     stackl_datastore_path: str = "/lfs-store"
+    # Encoding of stored documents: json, orjson or msgpack
+    stackl_datastore_codec: str = "json"
+    # Compression of large stored documents: zlib, zstd, lz4 or empty for none
+    stackl_datastore_compression: str = ""
+    stackl_datastore_compression_min_size: int = 16384
 
     # Redis options
     stackl_redis_type: str = "real"
     stackl_redis_host: str = "localhost"
     stackl_redis_password: str = None
     stackl_redis_port: int = 6379
+    stackl_redis_batch_size: int = 500
+    stackl_redis_pool_minsize: int = 1
+    stackl_redis_pool_maxsize: int = 10
+    # Attempts of a write to a stack instance which conflicts with another one
+    stackl_write_retries: int = Field(5, ge=1)
+
+    # Cache of config documents
+    stackl_cache_enabled: bool = True
+    stackl_cache_size: int = 1000
+    stackl_cache_ttl: int = 60
 
     # OPA options
     stackl_opa_host: str = "http://localhost:8181"
+    stackl_opa_timeout: float = 10
+    stackl_opa_max_connections: int = 20
+    stackl_opa_max_concurrency: int = 10
+    stackl_opa_batch_policies: bool = False
+    stackl_opa_decision_cache_size: int = 1000
+    stackl_opa_decision_cache_ttl: int = 300
+
+    # Automation jobs
+    stackl_max_concurrent_jobs: int = 50
+    stackl_max_concurrent_jobs_per_agent: int = 10
+    stackl_job_timeout: int = 7200
+    stackl_job_results_stream: str = "stackl:job_results"
+    # Seconds a read of the job results stream blocks
+    stackl_job_results_block: int = 5
+    # Seconds a worker keeps driving orchestrations after it stopped renewing
+    # its lease, orchestrations without lease are resumed this often as well
+    stackl_orchestration_lease: int = 30
+
+    # Snapshots, a snapshot is stored whole every rebase interval snapshots
+    # and as a patch from the snapshot before it otherwise
+    stackl_snapshot_rebase_interval: int = 10
+    # Snapshots kept per document and their maximum age in seconds, 0 for no
+    # limit. The compactor removes the others this often, 0 disables it
+    stackl_snapshot_keep: int = 0
+    stackl_snapshot_max_age: int = 0
+    stackl_snapshot_compaction_interval: int = 3600
 
     # Extra functionality
     rollback_enabled: bool = False
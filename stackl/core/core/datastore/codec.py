@@ -0,0 +1,147 @@
+"""
+Module for encoding the documents kept in a datastore
+
+Documents are stored as plain JSON unless another format or compression is
+configured. Other values start with a header naming their format and
+compression, so a store reads the values written with any codec, including
+the plain JSON written before codecs existed.
+"""
+import json
+import zlib
+
+from core import config
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+try:
+    import lz4.frame as lz4_frame
+except ImportError:
+    lz4_frame = None
+
+#: Starts every value that is not plain JSON, JSON never starts with NUL
+MAGIC = b"\x00stk"
+
+#: Byte in the header for every format
+FORMAT_IDS = {"json": 1, "orjson": 1, "msgpack": 2}
+
+#: Byte in the header for every compression
+COMPRESSION_IDS = {"": 0, "zlib": 1, "zstd": 2, "lz4": 3}
+
+#: Python package needed for a format or compression
+REQUIRED_PACKAGES = {
+    "orjson": ("orjson", lambda: orjson),
+    "msgpack": ("msgpack", lambda: msgpack),
+    "zstd": ("zstandard", lambda: zstandard),
+    "lz4": ("lz4", lambda: lz4_frame)
+}
+
+
+def _check_available(name):
+    if name in REQUIRED_PACKAGES:
+        package, module = REQUIRED_PACKAGES[name]
+        if module() is None:
+            raise ValueError(f"'{name}' needs the '{package}' package")
+
+
+def _decode_json(value):
+    if orjson is not None:
+        try:
+            return orjson.loads(value)
+        except orjson.JSONDecodeError:
+            # The json module also writes NaN and Infinity
+            pass
+    return json.loads(value)
+
+
+def _compress(compression, value):
+    if compression == "zlib":
+        return zlib.compress(value)
+    if compression == "zstd":
+        return zstandard.ZstdCompressor().compress(value)
+    return lz4_frame.compress(value)
+
+
+def _decompress(compression_id, value):
+    if compression_id == COMPRESSION_IDS["zlib"]:
+        return zlib.decompress(value)
+    if compression_id == COMPRESSION_IDS["zstd"]:
+        _check_available("zstd")
+        return zstandard.ZstdDecompressor().decompress(value)
+    if compression_id == COMPRESSION_IDS["lz4"]:
+        _check_available("lz4")
+        return lz4_frame.decompress(value)
+    raise ValueError(f"Unknown compression {compression_id}")
+
+
+class Codec:
+    """
+    Encodes documents for a datastore and decodes them again. The format is
+    json, orjson or msgpack, documents of at least compression_min_size
+    bytes are compressed with zlib, zstd or lz4 when compression is set
+    """
+
+    def __init__(self,
+                 format_name="json",
+                 compression="",
+                 compression_min_size=16384):
+        if format_name not in FORMAT_IDS:
+            raise ValueError(f"Unknown datastore codec '{format_name}'")
+        if compression not in COMPRESSION_IDS:
+            raise ValueError(f"Unknown datastore compression '{compression}'")
+        _check_available(format_name)
+        _check_available(compression)
+        self.format_name = format_name
+        self.compression = compression
+        self.compression_min_size = compression_min_size
+
+    @classmethod
+    def from_settings(cls):
+        """Returns the codec configured in the settings"""
+        return cls(config.settings.stackl_datastore_codec,
+                   config.settings.stackl_datastore_compression,
+                   config.settings.stackl_datastore_compression_min_size)
+
+    def encode(self, document):
+        """Returns the bytes to store for a document"""
+        if self.format_name == "msgpack":
+            value = msgpack.packb(document, use_bin_type=True)
+        elif self.format_name == "orjson":
+            value = orjson.dumps(document, option=orjson.OPT_NON_STR_KEYS)
+        else:
+            value = json.dumps(document).encode()
+        compression = ""
+        if self.compression and len(value) >= self.compression_min_size:
+            compression = self.compression
+            value = _compress(compression, value)
+        if self.format_name != "msgpack" and not compression:
+            # Plain JSON stays readable by anything reading the store
+            return value
+        return MAGIC + bytes([
+            FORMAT_IDS[self.format_name], COMPRESSION_IDS[compression]
+        ]) + value
+
+    @staticmethod
+    def decode(value):
+        """Returns the document of a stored value, whatever codec wrote it"""
+        if isinstance(value, str):
+            value = value.encode()
+        if not value.startswith(MAGIC):
+            return _decode_json(value)
+        format_id, compression_id = value[len(MAGIC):len(MAGIC) + 2]
+        value = value[len(MAGIC) + 2:]
+        if compression_id != COMPRESSION_IDS[""]:
+            value = _decompress(compression_id, value)
+        if format_id == FORMAT_IDS["msgpack"]:
+            _check_available("msgpack")
+            return msgpack.unpackb(value, raw=False, strict_map_key=False)
+        return _decode_json(value)
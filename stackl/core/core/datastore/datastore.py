@@ -4,23 +4,154 @@ Module for everything containing datastores
 from abc import ABC, abstractmethod
 
 from core.enums.stackl_codes import StatusCode
+from .codec import Codec
+
+
+def get_status_field(service, functional_requirement, infrastructure_target):
+    """Returns the field under which a status of a stack instance is stored"""
+    return f"{service}/{functional_requirement}/{infrastructure_target}"
 
 
 class DataStore(ABC):
-    """Abstract class for implementing a datastore"""
+    """
+    Abstract class for implementing a datastore, documents are encoded with
+    its codec
+    """
+
+    def __init__(self, codec=None):
+        self.codec = codec or Codec.from_settings()
 
     @abstractmethod
     def get(self, **keys):
         """abstractmethod for getting a document"""
 
+    @abstractmethod
+    def get_all(self, category, document_type, wildcard_prefix=""):
+        """
+        abstractmethod for getting all documents of a type, with a
+        wildcard_prefix only the ones whose name starts with it
+        """
+
+    def get_many(self, category, document_type, names):
+        """
+        Gets multiple documents of a type by name, missing documents are
+        left out. Stores that can fetch several documents at once override this
+        """
+        content = []
+        for name in names:
+            store_response = self.get(category=category,
+                                      type=document_type,
+                                      name=name)
+            if store_response.status_code == StatusCode.OK:
+                content.append(store_response.content)
+        return self._create_store_response(status_code=StatusCode.OK,
+                                           content=content)
+
+    def get_names(self, category, document_type, after=""):
+        """
+        Yields the names of the documents of a type in lists, sorted and
+        starting after the name after. Stores that keep an index of the names
+        override this, so the documents do not need to be read
+        """
+        store_response = self.get_all(category, document_type)
+        names = sorted(document["name"]
+                       for document in store_response.content
+                       if document["name"] > after)
+        if names:
+            yield names
+
     @abstractmethod
     def put(self, file):
-        """Abstract method for saving a document"""
+        """
+        Abstract method for saving a document. The content of the response
+        is the saved document itself, stores should not read it back
+        """
+
+    @abstractmethod
+    def put_versioned(self, file, version):
+        """
+        Abstract method for saving a document only when the stored version
+        still is version, a document which is not stored has version 0. The
+        saved document gets version + 1, when another version is stored the
+        response has status code CONFLICT
+        """
+
+    def put_many_versioned(self, files_and_versions):
+        """
+        Saves several documents with put_versioned, every document is only
+        saved when its stored version still is the given one. Returns a store
+        response per document. Stores that can save several documents at
+        once override this
+        """
+        return [
+            self.put_versioned(file, version)
+            for file, version in files_and_versions
+        ]
+
+    @abstractmethod
+    def get_version(self, **keys):
+        """Abstract method returning the stored version of a document"""
 
     @abstractmethod
     def delete(self, **keys):
         """Abstract method for deleting a document"""
 
+    @abstractmethod
+    def get_statuses(self, stack_instance_names):
+        """
+        Returns the stored statuses of stack instances as a dict of lists,
+        instances without stored statuses are left out
+        """
+
+    @abstractmethod
+    def set_statuses(self, stack_instance_name, statuses, replace=True):
+        """
+        Stores the statuses of a stack instance. Without replace, the statuses
+        are only stored when the stack instance has no stored statuses yet
+        """
+
+    def set_many_statuses(self, statuses_by_name, replace=True):
+        """
+        Stores the statuses of several stack instances, statuses_by_name maps
+        the name of a stack instance to its statuses
+        """
+        for stack_instance_name, statuses in statuses_by_name.items():
+            self.set_statuses(stack_instance_name, statuses, replace=replace)
+
+    @abstractmethod
+    def update_status(self, stack_instance_name, status, remove=False):
+        """
+        Updates the status and error message of the stored status matching the
+        service, functional requirement and infrastructure target of status,
+        or removes it. The update is atomic so concurrent updates are not lost.
+        Returns whether a status matched, or None when the stack instance has
+        no stored statuses
+        """
+
+    @abstractmethod
+    def delete_statuses(self, stack_instance_name):
+        """Deletes the stored statuses of a stack instance"""
+
+    @abstractmethod
+    def lock(self, name, timeout=60):
+        """
+        Returns a context manager holding the lock with the given name, shared
+        by all stackl processes using the store. Waiting for the lock longer
+        than timeout seconds raises an error
+        """
+
+    def publish(self, channel, message):
+        """
+        Publishes a message to the other stackl processes using this store.
+        Stores without a messaging mechanism ignore it
+        """
+
+    def subscribe(self, channel, callback):
+        """
+        Calls the callback with every message published on the channel.
+        Stores without a messaging mechanism never call it
+        """
+
     def _create_store_response(self,
                                status_code=StatusCode.OK,
                                reason=None,
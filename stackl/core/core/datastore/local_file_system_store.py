@@ -1,18 +1,24 @@
 """Module for using Local File System as datastore"""
+import fcntl
 import json
 import os
+import time
+from contextlib import contextmanager
 
 from loguru import logger
 
 from core.enums.stackl_codes import StatusCode
 from .datastore import DataStore
 
+#: Seconds between the attempts to take a lock held by another process
+LOCK_RETRY_DELAY = 0.05
+
 
 class LocalFileSystemStore(DataStore):
     """Implementation of LocalFileSystemStore"""
 
-    def __init__(self, root):
-        super().__init__()
+    def __init__(self, root, codec=None):
+        super().__init__(codec)
         self.file_system_root = root
 
     @property
@@ -34,8 +40,8 @@ class LocalFileSystemStore(DataStore):
                 status_code=StatusCode.NOT_FOUND, content="File is not found")
         logger.debug(f"[LocalFileSystemStore] get on key '{document_key}'")
         try:
-            with open(document_key) as file_to_get:
-                content = json.load(file_to_get)
+            with open(document_key, 'rb') as file_to_get:
+                content = self.codec.decode(file_to_get.read())
             response = self._create_store_response(status_code=StatusCode.OK,
                                                    content=content)
         except OSError as err:
@@ -66,8 +72,9 @@ class LocalFileSystemStore(DataStore):
                                 f"{wildcard_prefix} not in {file}"
                             )
                             continue
-                        with open(dirpath + file) as file_to_get:
-                            content.append(json.load(file_to_get))
+                        with open(dirpath + file, 'rb') as file_to_get:
+                            content.append(
+                                self.codec.decode(file_to_get.read()))
                         logger.debug(
                             f"File found. Added to content. len(content): '{len(content)}'"
                         )
@@ -93,16 +100,10 @@ class LocalFileSystemStore(DataStore):
         logger.debug(
             f"[LocalFileSystemStore] put on '{document_key}' with file {file}")
         try:
-            with open(document_key, 'w+') as outfile:
-                json.dump(file,
-                          outfile,
-                          sort_keys=True,
-                          indent=4,
-                          separators=(',', ': '))
-            with open(document_key, 'r') as storedfile:
-                response = self._create_store_response(
-                    status_code=StatusCode.CREATED,
-                    content=json.load(storedfile))
+            with open(document_key, 'wb') as outfile:
+                outfile.write(self.codec.encode(file))
+            response = self._create_store_response(
+                status_code=StatusCode.CREATED, content=file)
         except OSError as err:
             response = self._create_store_response(
                 status_code=StatusCode.INTERNAL_ERROR,
@@ -111,6 +112,46 @@ class LocalFileSystemStore(DataStore):
             f"[LocalFileSystemStore] StoreResponse for put: {response}")
         return response
 
+    def _document_key(self, keys):
+        if keys.get("type") in keys.get("name"):
+            return self.datastore_url + keys.get(
+                "category") + '/' + keys.get("name") + ".json"
+        return self.datastore_url + keys.get("category") + '/' + keys.get(
+            "type") + '_' + keys.get("name") + ".json"
+
+    def put_versioned(self, file, version):
+        """
+        Update a document from filestore if its version did not change. A lock
+        file serialises the writers, the document is replaced with a rename so
+        readers never see a partial document
+        """
+        document_key = self._document_key(file)
+        logger.debug(
+            f"[LocalFileSystemStore] put_versioned on '{document_key}' with version {version}"
+        )
+        file = {**file, "version": version + 1}
+        with open(document_key + ".lock", 'w', encoding="utf-8") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            current_version = self.get_version(**file)
+            if current_version != version:
+                return self._create_store_response(
+                    status_code=StatusCode.CONFLICT,
+                    reason=f"Stored version is {current_version}, not {version}",
+                    content=file)
+            with open(document_key + ".tmp", 'wb') as outfile:
+                outfile.write(self.codec.encode(file))
+            os.replace(document_key + ".tmp", document_key)
+        return self._create_store_response(status_code=StatusCode.CREATED,
+                                           content=file)
+
+    def get_version(self, **keys):
+        """Gets the version of a document from filestore"""
+        document_key = self._document_key(keys)
+        if not os.path.exists(document_key):
+            return 0
+        with open(document_key, 'rb') as file_to_get:
+            return self.codec.decode(file_to_get.read()).get("version", 0)
+
     def delete(self, **keys):
         """Delete a document from filestore"""
         if keys.get("type") in keys.get("name"):
@@ -137,3 +178,104 @@ class LocalFileSystemStore(DataStore):
         logger.debug(
             f"[LocalFileSystemStore] StoreResponse for delete: {response}")
         return response
+
+    def _status_path(self, stack_instance_name):
+        return self.datastore_url + "status/stack_instance_" + \
+            stack_instance_name + ".json"
+
+    @contextmanager
+    def lock(self, name, timeout=60):
+        """
+        Holds a lock file in the locks directory, waiting for it longer than
+        timeout raises a TimeoutError. The operating system releases the lock
+        of a process that stops
+        """
+        lock_path = self.datastore_url + "locks/" + name.replace("/",
+                                                                 "_") + ".lock"
+        os.makedirs(os.path.dirname(lock_path), exist_ok=True)
+        deadline = time.monotonic() + timeout
+        with open(lock_path, 'w', encoding="utf-8") as lock_file:
+            while True:
+                try:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    break
+                except BlockingIOError as err:
+                    if time.monotonic() >= deadline:
+                        raise TimeoutError(
+                            f"Lock '{name}' was not acquired within {timeout} seconds"
+                        ) from err
+                    time.sleep(LOCK_RETRY_DELAY)
+            yield
+
+    @contextmanager
+    def _lock_statuses(self, stack_instance_name):
+        """
+        Serialises the changes to the statuses of a stack instance, the lock
+        file works across the processes of all workers
+        """
+        status_path = self._status_path(stack_instance_name)
+        os.makedirs(os.path.dirname(status_path), exist_ok=True)
+        with open(status_path + ".lock", 'w', encoding="utf-8") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            yield
+
+    def _read_statuses(self, stack_instance_name):
+        status_path = self._status_path(stack_instance_name)
+        if not os.path.exists(status_path):
+            return None
+        with open(status_path, encoding="utf-8") as status_file:
+            return json.load(status_file)
+
+    def _write_statuses(self, stack_instance_name, statuses):
+        # Written to a temporary file first so readers never see a partial file
+        status_path = self._status_path(stack_instance_name)
+        os.makedirs(os.path.dirname(status_path), exist_ok=True)
+        with open(status_path + ".tmp", 'w', encoding="utf-8") as status_file:
+            json.dump(statuses, status_file)
+        os.replace(status_path + ".tmp", status_path)
+
+    def get_statuses(self, stack_instance_names):
+        """Gets the statuses of stack instances from the status directory"""
+        statuses = {}
+        for name in stack_instance_names:
+            stack_instance_statuses = self._read_statuses(name)
+            if stack_instance_statuses is not None:
+                statuses[name] = stack_instance_statuses
+        return statuses
+
+    def set_statuses(self, stack_instance_name, statuses, replace=True):
+        """Stores the statuses of a stack instance in the status directory"""
+        with self._lock_statuses(stack_instance_name):
+            if not replace and self._read_statuses(
+                    stack_instance_name) is not None:
+                return
+            self._write_statuses(stack_instance_name, statuses)
+
+    def update_status(self, stack_instance_name, status, remove=False):
+        """Updates a single status of a stack instance"""
+        with self._lock_statuses(stack_instance_name):
+            statuses = self._read_statuses(stack_instance_name)
+            if statuses is None:
+                return None
+            for stored_status in statuses:
+                if stored_status["service"] == status["service"] and \
+                        stored_status["functional_requirement"] == status[
+                            "functional_requirement"] and \
+                        status["infrastructure_target"] in stored_status[
+                            "infrastructure_target"]:
+                    if remove:
+                        statuses.remove(stored_status)
+                    else:
+                        stored_status["status"] = status["status"]
+                        stored_status["error_message"] = status.get(
+                            "error_message") or ""
+                    self._write_statuses(stack_instance_name, statuses)
+                    return True
+            return False
+
+    def delete_statuses(self, stack_instance_name):
+        """Deletes the statuses of a stack instance"""
+        status_path = self._status_path(stack_instance_name)
+        with self._lock_statuses(stack_instance_name):
+            if os.path.exists(status_path):
+                os.remove(status_path)
@@ -9,14 +9,109 @@ from redislite import Redis
 
 from core import config
 from core.enums.stackl_codes import StatusCode
-from .datastore import DataStore
+from .datastore import DataStore, get_status_field
+
+#: Updates a status in the hash of a stack instance, see
+# RedisStore.update_status. Statuses of functional requirements running as a
+# group have a comma separated list of targets, they are found by scanning
+# the fields of the service and functional requirement
+UPDATE_STATUS_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return -1
+end
+local field = ARGV[1]
+local value = redis.call('HGET', KEYS[1], field)
+if not value then
+    local prefix = ARGV[2]
+    for _, candidate in ipairs(redis.call('HKEYS', KEYS[1])) do
+        if string.sub(candidate, 1, #prefix) == prefix and
+                string.find(string.sub(candidate, #prefix + 1), ARGV[3], 1,
+                            true) then
+            field = candidate
+            value = redis.call('HGET', KEYS[1], field)
+            break
+        end
+    end
+end
+if not value then
+    return 0
+end
+if ARGV[6] == '1' then
+    redis.call('HDEL', KEYS[1], field)
+    return 1
+end
+local status = cjson.decode(value)
+status['status'] = ARGV[4]
+status['error_message'] = ARGV[5]
+redis.call('HSET', KEYS[1], field, cjson.encode(status))
+return 1
+"""
+
+#: Sets a document when its version key still has the expected version,
+# returns -1 on success and the stored version otherwise
+PUT_VERSIONED_SCRIPT = """
+local current = tonumber(redis.call('GET', KEYS[2]) or '0')
+if current ~= tonumber(ARGV[1]) then
+    return current
+end
+redis.call('SET', KEYS[1], ARGV[2])
+redis.call('SET', KEYS[2], current + 1)
+redis.call('ZADD', KEYS[3], 0, ARGV[3])
+return -1
+"""
+
+#: Stores the statuses of a stack instance, ARGV[1] tells whether existing
+# statuses are replaced, the other arguments are field and value pairs
+SET_STATUSES_SCRIPT = """
+if ARGV[1] == '0' and redis.call('EXISTS', KEYS[1]) == 1 then
+    return 0
+end
+redis.call('DEL', KEYS[1])
+for i = 2, #ARGV, 2 do
+    redis.call('HSET', KEYS[1], ARGV[i], ARGV[i + 1])
+end
+return 1
+"""
+
+
+def get_index_key(category, document_type):
+    """
+    Returns the key of the sorted set containing the names of all documents
+    of a type. Every member has score 0 so the set is ordered by name
+    """
+    return f"index:{category}/{document_type}"
+
+
+def get_version_key(document_key):
+    """
+    Returns the key holding the version of a document, it is kept apart so
+    a versioned put does not need to parse the stored document
+    """
+    return f"version:{document_key}"
+
+
+def get_status_key(stack_instance_name):
+    """
+    Returns the key of the hash containing the statuses of a stack instance
+    """
+    return f"status:items/stack_instance/{stack_instance_name}"
+
+
+def _set_statuses_arguments(statuses, replace):
+    args = ['1' if replace else '0']
+    for position, status in enumerate(statuses):
+        args.append(
+            get_status_field(status["service"], status["functional_requirement"],
+                             status["infrastructure_target"]))
+        args.append(json.dumps({**status, "position": position}))
+    return args
 
 
 class RedisStore(DataStore):
     """Implementation of Redis datastore"""
 
-    def __init__(self):
-        super().__init__()
+    def __init__(self, codec=None):
+        super().__init__(codec)
         if config.settings.stackl_redis_type == "fake":
             logger.info("Using fake client")
 
@@ -26,6 +121,9 @@ class RedisStore(DataStore):
                                      port=config.settings.stackl_redis_port,
                                      password=config.settings.stackl_redis_password,
                                      db=0)
+        self._put_versioned = self.redis.register_script(PUT_VERSIONED_SCRIPT)
+        self._update_status = self.redis.register_script(UPDATE_STATUS_SCRIPT)
+        self._set_statuses = self.redis.register_script(SET_STATUSES_SCRIPT)
 
     def get(self, **keys):
         """Gets a document from a redis instance"""
@@ -38,7 +136,7 @@ class RedisStore(DataStore):
             response = self._create_store_response(
                 status_code=StatusCode.NOT_FOUND, content={})
         else:
-            content = json.loads(self.redis.get(document_key))
+            content = self.codec.decode(redis_value)
             response = self._create_store_response(status_code=StatusCode.OK,
                                                    content=content)
         logger.debug(f"[RedisStore] StoreResponse for get: {response}")
@@ -46,25 +144,81 @@ class RedisStore(DataStore):
 
     def get_all(self, category, document_type, wildcard_prefix=""):
         """Gets all documents of a type from a Redis"""
-        document_key = f"{category}/{document_type}/{wildcard_prefix}*"
+        index_key = get_index_key(category, document_type)
         logger.debug(
-            f"[RedisStore] get_all in '{document_key}' for type '{document_type}'")
+            f"[RedisStore] get_all in '{index_key}' for type '{document_type}' "
+            f"with prefix '{wildcard_prefix}'")
         content = []
-        for key in self.redis.scan_iter(document_key):
-            content.append(json.loads(self.redis.get(key)))
+        for names in self._index_names(index_key, wildcard_prefix):
+            keys = [
+                f"{category}/{document_type}/{name.decode()}" for name in names
+            ]
+            content.extend(self._get_documents(keys))
         response = self._create_store_response(status_code=StatusCode.OK,
                                                content=content)
         logger.debug(f"[RedisStore] StoreResponse for get: {response}")
         return response
 
+    def get_many(self, category, document_type, names):
+        """Gets multiple documents of a type from Redis with MGET"""
+        keys = [f"{category}/{document_type}/{name}" for name in names]
+        logger.debug(f"[RedisStore] get_many on keys '{keys}'")
+        content = []
+        batch_size = config.settings.stackl_redis_batch_size
+        for i in range(0, len(keys), batch_size):
+            content.extend(self._get_documents(keys[i:i + batch_size]))
+        response = self._create_store_response(status_code=StatusCode.OK,
+                                               content=content)
+        logger.debug(f"[RedisStore] StoreResponse for get_many: {response}")
+        return response
+
+    def get_names(self, category, document_type, after=""):
+        """Gets the names of the documents of a type from the index"""
+        for names in self._index_names(get_index_key(category, document_type),
+                                       after=after):
+            yield [name.decode() for name in names]
+
+    def _index_names(self, index_key, prefix="", after=""):
+        """
+        Yields the names in the index of a type in batches. Names are sorted
+        lexicographically so a prefix is a range query on the index, and
+        the names after a name are as well
+        """
+        batch_size = config.settings.stackl_redis_batch_size
+        if prefix:
+            minimum = b"[" + prefix.encode()
+            maximum = b"[" + prefix.encode() + b"\xff"
+        else:
+            minimum = b"-"
+            maximum = b"+"
+        if after and after >= prefix:
+            minimum = b"(" + after.encode()
+        while True:
+            names = self.redis.zrangebylex(index_key,
+                                           minimum,
+                                           maximum,
+                                           start=0,
+                                           num=batch_size)
+            if not names:
+                return
+            yield names
+            if len(names) < batch_size:
+                return
+            minimum = b"(" + names[-1]
+
+    def _get_documents(self, keys):
+        """Fetches multiple documents in one round trip"""
+        for value in self.redis.mget(keys):
+            # The index can briefly reference a key that was removed outside of stackl
+            if value is not None:
+                yield self.codec.decode(value)
+
     def get_history(self, category, document_type, name):
         """Gets the snapshots of document from Redis"""
         document_key = category + '/' + document_type + '/' + name
         logger.debug(
             f"[RedisStore] get_history in '{document_key}' for type '{document_type}'")
-        content = []
-        for key in self.redis.scan_iter(document_key):
-            content.append(json.loads(self.redis.get(key)))
+        content = list(self._get_documents([document_key]))
         response = self._create_store_response(status_code=StatusCode.OK,
                                                content=content)
         logger.debug(f"[RedisStore] StoreResponse for get: {response}")
@@ -75,18 +229,150 @@ class RedisStore(DataStore):
         document_key = file.get("category") + '/' + file.get(
             "type") + '/' + file["name"]
         logger.debug(f"[RedisStore] put on '{document_key}' with file {file}")
-        self.redis.set(document_key, json.dumps(file))
-        response = self._create_store_response(
-            status_code=StatusCode.CREATED,
-            content=json.loads(self.redis.get(document_key)))
+        pipeline = self.redis.pipeline(transaction=True)
+        pipeline.set(document_key, self.codec.encode(file))
+        pipeline.zadd(get_index_key(file.get("category"), file.get("type")),
+                      {file["name"]: 0})
+        pipeline.execute()
+        response = self._create_store_response(status_code=StatusCode.CREATED,
+                                               content=file)
         logger.debug(f"[RedisStore] StoreResponse for put: {response}")
         return response
 
+    def put_versioned(self, file, version):
+        """Puts a document in Redis if its version did not change"""
+        file, keys, args = self._put_versioned_arguments(file, version)
+        logger.debug(
+            f"[RedisStore] put_versioned on '{keys[0]}' with version {version}")
+        result = self._put_versioned(keys=keys, args=args)
+        response = self._put_versioned_response(file, version, result)
+        logger.debug(
+            f"[RedisStore] StoreResponse for put_versioned: {response}")
+        return response
+
+    def put_many_versioned(self, files_and_versions):
+        """
+        Puts several documents in Redis in one pipeline, every document is
+        checked against its version by the script on its own
+        """
+        logger.debug(
+            f"[RedisStore] put_many_versioned of {len(files_and_versions)} documents"
+        )
+        pipeline = self.redis.pipeline(transaction=True)
+        files = []
+        for file, version in files_and_versions:
+            file, keys, args = self._put_versioned_arguments(file, version)
+            self._put_versioned(keys=keys, args=args, client=pipeline)
+            files.append((file, version))
+        return [
+            self._put_versioned_response(file, version, result)
+            for (file, version), result in zip(files, pipeline.execute())
+        ]
+
+    def _put_versioned_arguments(self, file, version):
+        document_key = file.get("category") + '/' + file.get(
+            "type") + '/' + file["name"]
+        file = {**file, "version": version + 1}
+        keys = [
+            document_key,
+            get_version_key(document_key),
+            get_index_key(file.get("category"), file.get("type"))
+        ]
+        return file, keys, [version, self.codec.encode(file), file["name"]]
+
+    def _put_versioned_response(self, file, version, result):
+        if result != -1:
+            return self._create_store_response(
+                status_code=StatusCode.CONFLICT,
+                reason=f"Stored version is {result}, not {version}",
+                content=file)
+        return self._create_store_response(status_code=StatusCode.CREATED,
+                                           content=file)
+
+    def get_version(self, **keys):
+        """Gets the version of a document in Redis"""
+        document_key = keys.get("category") + '/' + keys.get(
+            "type") + '/' + keys.get("name")
+        return int(self.redis.get(get_version_key(document_key)) or 0)
+
     def delete(self, **keys):
         """Deletes a document in Redis"""
         document_key = keys.get("category") + '/' + keys.get(
             "type") + '/' + keys.get("name")
-        self.redis.delete(document_key)
+        pipeline = self.redis.pipeline(transaction=True)
+        pipeline.delete(document_key, get_version_key(document_key))
+        pipeline.zrem(get_index_key(keys.get("category"), keys.get("type")),
+                      keys.get("name"))
+        pipeline.execute()
         response = self._create_store_response(status_code=200, content={})
         logger.debug(f"[RedisStore] StoreResponse for delete: {response}")
         return response
+
+    def get_statuses(self, stack_instance_names):
+        """Gets the statuses of stack instances in one round trip"""
+        pipeline = self.redis.pipeline(transaction=False)
+        for name in stack_instance_names:
+            pipeline.hgetall(get_status_key(name))
+        statuses = {}
+        for name, fields in zip(stack_instance_names, pipeline.execute()):
+            if fields:
+                values = [json.loads(value) for value in fields.values()]
+                values.sort(key=lambda status: status["position"])
+                for status in values:
+                    del status["position"]
+                statuses[name] = values
+        return statuses
+
+    def set_statuses(self, stack_instance_name, statuses, replace=True):
+        """Stores the statuses of a stack instance in a hash"""
+        self._set_statuses(keys=[get_status_key(stack_instance_name)],
+                           args=_set_statuses_arguments(statuses, replace))
+
+    def set_many_statuses(self, statuses_by_name, replace=True):
+        """Stores the statuses of several stack instances in one pipeline"""
+        pipeline = self.redis.pipeline(transaction=True)
+        for stack_instance_name, statuses in statuses_by_name.items():
+            self._set_statuses(keys=[get_status_key(stack_instance_name)],
+                               args=_set_statuses_arguments(statuses, replace),
+                               client=pipeline)
+        pipeline.execute()
+
+    def update_status(self, stack_instance_name, status, remove=False):
+        """Updates a single status with a script, without reading the hash"""
+        result = self._update_status(
+            keys=[get_status_key(stack_instance_name)],
+            args=[
+                get_status_field(status["service"],
+                                 status["functional_requirement"],
+                                 status["infrastructure_target"]),
+                get_status_field(status["service"],
+                                 status["functional_requirement"], ""),
+                status["infrastructure_target"], status["status"],
+                status.get("error_message") or "", '1' if remove else '0'
+            ])
+        if result == -1:
+            return None
+        return result == 1
+
+    def delete_statuses(self, stack_instance_name):
+        """Deletes the statuses of a stack instance"""
+        self.redis.delete(get_status_key(stack_instance_name))
+
+    def lock(self, name, timeout=60):
+        """
+        Returns a Redis lock, waiting for it longer than timeout raises a
+        redis.exceptions.LockError
+        """
+        return self.redis.lock(f"lock:{name}",
+                               timeout=timeout,
+                               blocking_timeout=timeout)
+
+    def publish(self, channel, message):
+        """Publishes a message on a Redis channel"""
+        self.redis.publish(channel, message)
+
+    def subscribe(self, channel, callback):
+        """Listens on a Redis channel in a background thread"""
+        pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(**{channel: lambda message: callback(message['data'])})
+        return pubsub.run_in_thread(sleep_time=1, daemon=True)
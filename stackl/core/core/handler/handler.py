@@ -14,7 +14,7 @@ class Handler(ABC):  # pylint: disable=too-few-public-methods
         pass
 
     @abstractmethod
-    def handle(self, item):
+    async def handle(self, item):
         """
         This method is for the handle logic
         """
@@ -0,0 +1,96 @@
+"""
+Module containing the documents needed while handling a single stack request
+"""
+from typing import Dict, List
+
+from loguru import logger
+
+from core.models.configs.functional_requirement_model import FunctionalRequirement
+from core.models.configs.policy_template_model import PolicyTemplate
+from core.models.configs.stack_application_template_model import StackApplicationTemplate
+from core.models.configs.stack_infrastructure_template_model import \
+    StackInfrastructureTemplate
+from core.models.items.service_model import Service
+
+
+class ResolutionContext:
+    """
+    Holds the services, functional requirements and policy templates used by a
+    stack request. Everything the templates refer to is fetched up front with
+    one batched read per document type, documents that are only discovered
+    later are fetched once and kept as well.
+    """
+
+    def __init__(self, document_manager):
+        self.document_manager = document_manager
+        self.services: Dict[str, Service] = {}
+        self.functional_requirements: Dict[str, FunctionalRequirement] = {}
+        self.policy_templates: Dict[str, PolicyTemplate] = {}
+
+    def load(self,
+             stack_application_template: StackApplicationTemplate,
+             stack_infrastructure_template: StackInfrastructureTemplate,
+             service_names: List[str] = None):
+        """
+        Loads all documents referred to by the templates and the extra
+        services
+        """
+        service_names = [
+            service.service for service in stack_application_template.services
+        ] + list(service_names or [])
+        self._load_services(service_names)
+
+        policy_names = list(stack_application_template.policies or {})
+        for capability in stack_infrastructure_template.infrastructure_capabilities.values(
+        ):
+            policy_names.extend(capability.policies or {})
+        self._load_policy_templates(policy_names)
+        logger.debug(
+            f"[ResolutionContext] loaded {len(self.services)} services, "
+            f"{len(self.functional_requirements)} functional requirements and "
+            f"{len(self.policy_templates)} policy templates")
+
+    def _load_services(self, names):
+        missing = [name for name in set(names) if name not in self.services]
+        if not missing:
+            return
+        self.services.update(
+            self.document_manager.get_services_by_name(missing))
+        fr_names = []
+        for name in missing:
+            if name in self.services:
+                fr_names.extend(self.services[name].functional_requirements)
+        self._load_functional_requirements(fr_names)
+
+    def _load_functional_requirements(self, names):
+        missing = [
+            name for name in set(names)
+            if name not in self.functional_requirements
+        ]
+        if missing:
+            self.functional_requirements.update(
+                self.document_manager.get_functional_requirements_by_name(
+                    missing))
+
+    def _load_policy_templates(self, names):
+        missing = [
+            name for name in set(names) if name not in self.policy_templates
+        ]
+        if missing:
+            self.policy_templates.update(
+                self.document_manager.get_policy_templates_by_name(missing))
+
+    def get_service(self, name) -> Service:
+        """Returns a service, reading it only when it was not loaded yet"""
+        self._load_services([name])
+        return self.services.get(name)
+
+    def get_functional_requirement(self, name) -> FunctionalRequirement:
+        """Returns a functional requirement, reading it only when it was not loaded yet"""
+        self._load_functional_requirements([name])
+        return self.functional_requirements.get(name)
+
+    def get_policy_template(self, name) -> PolicyTemplate:
+        """Returns a policy template, reading it only when it was not loaded yet"""
+        self._load_policy_templates([name])
+        return self.policy_templates.get(name)
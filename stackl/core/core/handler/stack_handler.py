@@ -2,11 +2,15 @@
 Module containing all logic for creating and updating Stack instances
 """
 
+import asyncio
+import hashlib
+import json
 from collections import OrderedDict
 from core.models.configs.stack_application_template_model import StackApplicationTemplate
 
 from loguru import logger
 
+from core import config
 from core.enums.stackl_codes import StatusCode
 from core.models.configs.stack_infrastructure_template_model import \
     StackInfrastructureTemplate
@@ -16,10 +20,18 @@ from core.models.items.stack_instance_model import StackInstance
 from core.models.items.stack_instance_service_model import StackInstanceService
 from core.models.items.stack_instance_status_model import StackInstanceStatus
 from core.models.api.stack_instance import StackInstanceUpdate
+from core.utils.cache import LRUCache
 from core.utils.general_utils import get_timestamp, tree
 
 from ..opa_broker.opa_broker import convert_sit_to_opa_data
 from .handler import Handler
+from .resolution_context import ResolutionContext
+
+#: Fingerprint of the inputs and the description stamp of the last
+# materialisation of the capabilities of a SIT, by SIT name
+_materialised_capabilities = LRUCache(
+    maxsize=config.settings.stackl_cache_size,
+    ttl=config.settings.stackl_cache_ttl)
 
 
 def process_service_targets(attributes,
@@ -47,10 +59,24 @@ def process_service_targets(attributes,
     service_targets[service]['targets'] = new_targets
 
 
+def _capabilities_fingerprint(infr_targets, infr_target_documents):
+    """
+    Returns a hash over the infrastructure targets of a SIT and the
+    environment, location and zone documents they consist of
+    """
+    content = {
+        "targets": [infr_target.dict() for infr_target in infr_targets],
+        "documents": [[document.dict() for document in documents]
+                      for documents in infr_target_documents]
+    }
+    return hashlib.sha256(
+        json.dumps(content, sort_keys=True).encode()).hexdigest()
+
+
 def delete_services(to_be_deleted, stack_instance):
     for service in to_be_deleted:
         for key, _ in service.items():
-            del stack_instance.services[key]
+            stack_instance.services.pop(key, None)
 
 
 class StackHandler(Handler):
@@ -60,21 +86,23 @@ class StackHandler(Handler):
         self.document_manager = document_manager
         self.opa_broker = opa_broker
         self.opa_broker.document_manager = self.document_manager
+        self.context = ResolutionContext(self.document_manager)
+        self._templates_as_opa_data = {}
 
-    def handle(self, item):
+    async def handle(self, item):
         """
         Handle logic of the action
         """
         action = item['action']
         if action == 'create':
             logger.debug("[StackHandler] handle. Received create task")
-            return self._handle_create(item['document'])
+            return await self._handle_create(item['document'])
         if action == 'update':
             logger.debug("[StackHandler] handle. Received update task")
-            return self._handle_update(item['document'])
+            return await self._handle_update(item['document'])
         if action == 'delete':
             logger.debug("[StackHandler] handle. Received delete task")
-            return self._handle_delete(item['document'])
+            return await self._handle_delete(item['document'])
         return StatusCode.BAD_REQUEST
 
     def _create_stack_instance(
@@ -101,7 +129,7 @@ class StackHandler(Handler):
         stack_instance_statuses = []
         for svc, opa_result in opa_decision.items():
             # if a svc doesnt have a result raise an error cause we cant resolve it
-            svc_doc = self.document_manager.get_service(opa_result['service'])
+            svc_doc = self.context.get_service(opa_result['service'])
             service_definitions = []
             for infra_target in opa_result['targets']:
                 infra_target_counter = 1
@@ -138,7 +166,7 @@ class StackHandler(Handler):
         merged_secrets = {**secrets_of_target, **svc_doc.secrets}
         fr_params = {}
         for fr in svc_doc.functional_requirements:
-            fr_doc = self.document_manager.get_functional_requirement(fr)
+            fr_doc = self.context.get_functional_requirement(fr)
             fr_params = {**fr_params, **fr_doc.params}
             merged_secrets = {**merged_secrets, **fr_doc.secrets}
             if fr_doc.as_group:
@@ -254,8 +282,7 @@ class StackHandler(Handler):
         stack_instances_services_copy = stack_instance.services.copy()
         for svc, service_definitions in stack_instances_services_copy.items():
             for count, service_definition in enumerate(service_definitions):
-                svc_doc = self.document_manager.get_service(
-                    service_definition.service)
+                svc_doc = self.context.get_service(service_definition.service)
                 if svc in service_targets and not service_definition.infrastructure_target in \
                                            service_targets[svc]['targets']:
                     return "Update impossible. Target in service definition not in service_targets"
@@ -274,7 +301,7 @@ class StackHandler(Handler):
                 if start_index < 1:
                     return f"Can't add more replicas cause there are not enough extra targets for {svc}"
                 # Get the service doc, but I really dont like this way:
-                svc_doc = self.document_manager.get_service(
+                svc_doc = self.context.get_service(
                     service_definitions[0].service)
                 for i in range(start_index,
                                len(service_targets[svc]["targets"])):
@@ -288,7 +315,7 @@ class StackHandler(Handler):
 
         for service in item.services:
             if service.name not in stack_instance.services:
-                svc_doc = self.document_manager.get_service(service.service)
+                svc_doc = self.context.get_service(service.service)
                 service_definition = self.add_service_definition(
                     service_targets[service.name]["targets"][0], 0, item,
                     opa_service_params, stack_infrastructure_template,
@@ -330,7 +357,7 @@ class StackHandler(Handler):
                     status="in_progress",
                     error_message="")
                 stack_instance_statuses.append(stack_instance_status)
-            fr_doc = self.document_manager.get_functional_requirement(fr)
+            fr_doc = self.context.get_functional_requirement(fr)
             fr_params = {**fr_params, **fr_doc.params}
             merged_secrets = {**merged_secrets, **fr_doc.secrets}
         merged_capabilities = {
@@ -357,13 +384,11 @@ class StackHandler(Handler):
                     "instances", None), count + 1)
         return service_definition
 
-    def add_outputs(self, outputs_update):
+    def add_outputs(self, outputs_update, stack_instance):
         """
         Adds outputs on the right service definition of a stack instance
         """
         logger.debug("Adding outputs to stack_instance")
-        stack_instance = self.document_manager.get_stack_instance(
-            outputs_update.stack_instance)
         service = stack_instance.services[outputs_update.service]
         for service_definition in service:
             if service_definition.infrastructure_target == outputs_update.infrastructure_target:
@@ -381,26 +406,65 @@ class StackHandler(Handler):
 
         return stack_instance
 
-    def _handle_create(self, item):
+    async def _handle_create(self, item):
         """
         Handles the create action of a stack instance
         """
         logger.debug(
             "[StackHandler] _handle_create received with item: {0}".format(
                 item))
+        stack_infr, stack_app_template = self._load_templates(
+            item.stack_infrastructure_template,
+            item.stack_application_template, item.services)
+        return await self._evaluate_create(item, stack_infr,
+                                           stack_app_template)
+
+    async def handle_creates(self, items):
+        """
+        Handles the create action of several stack instances with the same
+        SIT and SAT. The templates are resolved and converted once, the
+        policies of all stack instances are evaluated concurrently so equal
+        decisions are asked once. Returns a (stack instance, result) tuple or
+        the raised exception per item
+        """
+        logger.debug(
+            f"[StackHandler] handle_creates received {len(items)} items")
+        stack_infr, stack_app_template = self._load_templates(
+            items[0].stack_infrastructure_template,
+            items[0].stack_application_template,
+            [service for item in items for service in item.services])
+        return await asyncio.gather(*[
+            self._evaluate_create(item, stack_infr, stack_app_template)
+            for item in items
+        ],
+                                    return_exceptions=True)
+
+    def _load_templates(self, stack_infr_template_name,
+                        stack_app_template_name, extra_services):
+        """
+        Gets the SIT with up to date capabilities and the SAT, and loads the
+        documents they refer to in the resolution context
+        """
         stack_infr_template = self.document_manager.get_stack_infrastructure_template(
-            item.stack_infrastructure_template)
+            stack_infr_template_name)
         stack_app_template = self.document_manager.get_stack_application_template(
-            item.stack_application_template)
+            stack_app_template_name)
 
         stack_infr = self._update_infr_capabilities(stack_infr_template, "yes")
+        self.context.load(stack_app_template, stack_infr,
+                          [service.service for service in extra_services])
+        return stack_infr, stack_app_template
 
+    async def _evaluate_create(self, item, stack_infr, stack_app_template):
+        """
+        Evaluates the policies for a new stack instance and creates it
+        """
         # Transform to OPA format
         opa_data = self.transform_opa_data(item, stack_app_template,
                                            stack_infr, item.services)
 
         # Evaluate orchestration policy
-        opa_solution = self.evaluate_orchestration_policy(opa_data)
+        opa_solution = await self.evaluate_orchestration_policy(opa_data)
 
         if not opa_solution['fulfilled']:
             logger.error(
@@ -413,9 +477,9 @@ class StackHandler(Handler):
         # Verify the SAT policies
         if stack_app_template.policies:
             for policy_name, attributes in stack_app_template.policies.items():
-                policy = self.document_manager.get_policy_template(policy_name)
+                policy = self.context.get_policy_template(policy_name)
                 for policy_params in attributes:
-                    new_result = self.evaluate_sat_policy(
+                    new_result = await self.evaluate_sat_policy(
                         policy_params, opa_data, policy, item.params,
                         item.replicas)
 
@@ -431,7 +495,8 @@ class StackHandler(Handler):
                                             opa_service_params,
                                             outputs=policy.outputs)
 
-        service_targets = self.evaluate_replica_policy(item, service_targets)
+        service_targets = await self.evaluate_replica_policy(
+            item, service_targets)
 
         if not service_targets['result']['fulfilled']:
             logger.error(
@@ -441,7 +506,7 @@ class StackHandler(Handler):
 
         # Verify that each of the SIT policies doesn't violate
 
-        infringment_messages = self.evaluate_sit_policies(
+        infringment_messages = await self.evaluate_sit_policies(
             opa_data, service_targets, stack_infr, item.params)
 
         if infringment_messages:
@@ -454,38 +519,79 @@ class StackHandler(Handler):
             stack_app_template,
             opa_service_params), service_targets['result']['services']
 
-    def evaluate_sit_policies(self, opa_data, service_targets, stack_infr,
-                              item_params):
+    async def evaluate_sit_policies(self, opa_data, service_targets,
+                                    stack_infr, item_params):
         """
-        Evaluates the SIT policies using the OPA broker
+        Evaluates the SIT policies using the OPA broker. The checks are
+        independent of each other so they are sent concurrently, the broker
+        bounds the amount of requests in flight. When batching is enabled
+        the checks of batch safe policies are sent in a single query
         """
-        infringment_messages = []
+        checks = []
         for _, service_definition in service_targets['result'][
                 'services'].items():
             for t in service_definition['targets']:
                 policies = stack_infr.infrastructure_capabilities[t].policies
 
                 for policy_name, policy_attributes in policies.items():
-                    policy = self.document_manager.get_policy_template(
-                        policy_name)
-
-                    # Make sure the policy is in OPA
-                    self.opa_broker.add_policy(policy.name, policy.policy)
-
+                    policy = self.context.get_policy_template(policy_name)
                     policy_input = {
                         "parameters": policy_attributes,
                         "stack_instance_params": item_params,
                         "target": t
                     }
-
-                    opa_data_with_inputs = {**opa_data, **policy_input}
-                    # evaluate
-                    opa_result = self.opa_broker.ask_opa_policy_decision(
-                        policy.name, "infringement", opa_data_with_inputs)
-                    infringment_messages.extend(opa_result['result'])
+                    checks.append((policy, policy_input))
+
+        # Make sure the policies are in OPA, once per policy
+        policies = {policy.name: policy for policy, _ in checks}
+        await asyncio.gather(*[
+            self.opa_broker.add_policy_async(policy.name, policy.policy)
+            for policy in policies.values()
+        ])
+
+        batch_positions = []
+        single_positions = []
+        for position, (policy, _) in enumerate(checks):
+            if config.settings.stackl_opa_batch_policies and policy.batch_safe:
+                batch_positions.append(position)
+            else:
+                single_positions.append(position)
+
+        evaluations = [
+            self.opa_broker.ask_opa_policy_decision_async(
+                checks[position][0].name, "infringement", {
+                    **opa_data,
+                    **checks[position][1]
+                }) for position in single_positions
+        ]
+        if batch_positions:
+            evaluations.append(
+                self.opa_broker.ask_opa_batch_decision_async(
+                    [checks[position][0].name for position in batch_positions],
+                    "infringement", opa_data, [{
+                        "policy": checks[position][0].name,
+                        "input": checks[position][1]
+                    } for position in batch_positions]))
+        opa_results = await asyncio.gather(*evaluations)
+
+        # The messages are returned in the order of the checks
+        check_messages = [None] * len(checks)
+        for position, opa_result in zip(single_positions, opa_results):
+            check_messages[position] = opa_result.get('result')
+        if batch_positions and opa_results[-1] is not None:
+            for position, messages in zip(batch_positions, opa_results[-1]):
+                check_messages[position] = messages
+        infringment_messages = []
+        for (policy, policy_input), messages in zip(checks, check_messages):
+            if messages is None:
+                messages = [{
+                    "msg":
+                    f"Policy '{policy.name}' on target '{policy_input['target']}' could not be evaluated by OPA"
+                }]
+            infringment_messages.extend(messages)
         return infringment_messages
 
-    def evaluate_replica_policy(self, item, service_targets):
+    async def evaluate_replica_policy(self, item, service_targets):
         """
         Evaluates the replica policy
         """
@@ -503,14 +609,14 @@ class StackHandler(Handler):
         services = {"services": service_targets}
         replica_input = {**parameters, **services}
         # And verify it
-        service_targets = self.opa_broker.ask_opa_policy_decision(
+        service_targets = await self.opa_broker.ask_opa_policy_decision_async(
             "replicas", "solutions", replica_input)
 
         logger.debug(f"opa_result for replicas policy: {service_targets}")
         return service_targets
 
-    def evaluate_sat_policy(self, attributes, opa_data, policy, user_params,
-                            replicas):
+    async def evaluate_sat_policy(self, attributes, opa_data, policy,
+                                  user_params, replicas):
         """
         Evaluates the Stack Application Template policies using OPA
         Returns the possible targets
@@ -522,16 +628,16 @@ class StackHandler(Handler):
         }
         opa_data_with_inputs = {**opa_data, **policy_input}
         # Make sure the policy is in OPA
-        self.opa_broker.add_policy(policy.name, policy.policy)
+        await self.opa_broker.add_policy_async(policy.name, policy.policy)
         # And verify it
-        new_solution = self.opa_broker.ask_opa_policy_decision(
+        new_solution = await self.opa_broker.ask_opa_policy_decision_async(
             policy.name, "solutions", opa_data_with_inputs)
         logger.debug(
             f"opa_result for policy {policy.name}: {new_solution['result']}")
         new_result = new_solution['result']
         return new_result
 
-    def evaluate_orchestration_policy(self, opa_data):
+    async def evaluate_orchestration_policy(self, opa_data):
         """
         Evaluates the default orchestration policy
         """
@@ -539,7 +645,7 @@ class StackHandler(Handler):
             "[StackHandler] _handle_create. performing opa query with data: {0}"
             .format(opa_data))
 
-        opa_result = self.opa_broker.ask_opa_policy_decision(
+        opa_result = await self.opa_broker.ask_opa_policy_decision_async(
             "orchestration", "solutions", opa_data)
         logger.debug("opa_result: {0}".format(opa_result['result']))
         opa_solution = opa_result['result']
@@ -552,28 +658,37 @@ class StackHandler(Handler):
         and adds extra needed data so OPA can evaluate more complicated
         policies
         """
-        sit_as_opa_data = convert_sit_to_opa_data(stack_infr)
-        services = []
-        for service in stack_app_template.services:
-            services.append({
-                'name':
-                service.name,
-                'service':
-                self.document_manager.get_service(service.service)
-            })
-        for service in extra_services:
-            services.append({
-                'name':
-                service.name,
-                'service':
-                self.document_manager.get_service(service.service)
-            })
-        logger.debug(f"Services transformed for OPA data: {services}")
-        sat_as_opa_data = self.opa_broker.convert_sat_to_opa_data(
-            stack_app_template, services)
+        key = (stack_infr.name, stack_app_template.name,
+               tuple((service.name, service.service)
+                     for service in extra_services))
+        templates_as_opa_data = self._templates_as_opa_data.get(key)
+        if templates_as_opa_data is None:
+            sit_as_opa_data = convert_sit_to_opa_data(stack_infr)
+            services = []
+            for service in stack_app_template.services:
+                services.append({
+                    'name':
+                    service.name,
+                    'service':
+                    self.context.get_service(service.service)
+                })
+            for service in extra_services:
+                services.append({
+                    'name':
+                    service.name,
+                    'service':
+                    self.context.get_service(service.service)
+                })
+            logger.debug(f"Services transformed for OPA data: {services}")
+            sat_as_opa_data = self.opa_broker.convert_sat_to_opa_data(
+                stack_app_template, services,
+                self.context.functional_requirements)
+            # Stack instances created with the same templates share them
+            templates_as_opa_data = {**sat_as_opa_data, **sit_as_opa_data}
+            self._templates_as_opa_data[key] = templates_as_opa_data
         required_tags = {}
         required_tags["required_tags"] = item.tags
-        opa_data = {**required_tags, **sat_as_opa_data, **sit_as_opa_data}
+        opa_data = {**required_tags, **templates_as_opa_data}
         return opa_data
 
     def _update_infr_capabilities(
@@ -582,7 +697,9 @@ class StackHandler(Handler):
             update="auto") -> StackInfrastructureTemplate:
         """
         Merges the data from environment, location and zone and saves
-        it in the stack infrastructure template
+        it in the stack infrastructure template. The merge is skipped when
+        neither the targets nor their documents changed since the last
+        materialisation, and the SIT is only written when the result differs
         """
         infr_targets = stack_infr_template.infrastructure_targets
 
@@ -592,15 +709,27 @@ class StackHandler(Handler):
                 .format(update))
             return stack_infr_template
 
+        infr_target_documents = [
+            (self.document_manager.get_environment(infr_target.environment),
+             self.document_manager.get_location(infr_target.location),
+             self.document_manager.get_zone(infr_target.zone))
+            for infr_target in infr_targets
+        ]
+        fingerprint = _capabilities_fingerprint(infr_targets,
+                                                infr_target_documents)
+        materialised = _materialised_capabilities.get(
+            stack_infr_template.name)
+        if materialised == (fingerprint, stack_infr_template.description):
+            logger.debug(
+                "[StackHandler] _update_infr_capabilities. capabilities up to date"
+            )
+            return stack_infr_template
+
         logger.debug(
             "[StackHandler] _update_infr_capabilities. update is '{0}', doing update."
             .format(update))
         infr_targets_capabilities = {}
-        for infr_target in infr_targets:
-            environment = self.document_manager.get_environment(
-                infr_target.environment)
-            location = self.document_manager.get_location(infr_target.location)
-            zone = self.document_manager.get_zone(infr_target.zone)
+        for environment, location, zone in infr_target_documents:
             infr_target_capability = {
                 **environment.params,
                 **location.params,
@@ -653,14 +782,18 @@ class StackHandler(Handler):
                     policies=infr_target_policies,
                     agent=infr_target_agent,
                     cloud_provider=infr_target_cloud_provider)
-        stack_infr_template.infrastructure_capabilities = infr_targets_capabilities
-        stack_infr_template.description = "SIT updated at {}".format(
-            get_timestamp())
-        self.document_manager.write_stack_infrastructure_template(
-            stack_infr_template)
+        if infr_targets_capabilities != stack_infr_template.infrastructure_capabilities:
+            stack_infr_template.infrastructure_capabilities = infr_targets_capabilities
+            stack_infr_template.description = "SIT updated at {}".format(
+                get_timestamp())
+            self.document_manager.write_stack_infrastructure_template(
+                stack_infr_template)
+        _materialised_capabilities.set(
+            stack_infr_template.name,
+            (fingerprint, stack_infr_template.description))
         return stack_infr_template
 
-    def _handle_update(self, item):
+    async def _handle_update(self, item):
         """
         Handle the update action of a stack instance
         """
@@ -680,12 +813,18 @@ class StackHandler(Handler):
 
         stack_infr = self._update_infr_capabilities(
             stack_infrastructure_template, "yes")
+        service_names = [service.service for service in item.services]
+        for service_definitions in stack_instance.services.values():
+            service_names.extend(service_definition.service
+                                 for service_definition in service_definitions)
+        self.context.load(stack_application_template, stack_infr,
+                          service_names)
 
         # Transform to OPA format
         opa_data = self.transform_opa_data(item, stack_application_template,
                                            stack_infr, item.services)
 
-        opa_solution = self.evaluate_orchestration_policy(opa_data)
+        opa_solution = await self.evaluate_orchestration_policy(opa_data)
 
         if not opa_solution['fulfilled']:
             logger.error(
@@ -699,9 +838,9 @@ class StackHandler(Handler):
         if stack_application_template.policies:
             for policy_name, attributes in stack_application_template.policies.items(
             ):
-                policy = self.document_manager.get_policy_template(policy_name)
+                policy = self.context.get_policy_template(policy_name)
                 for policy_params in attributes:
-                    new_result = self.evaluate_sat_policy(
+                    new_result = await self.evaluate_sat_policy(
                         policy_params, opa_data, policy, {
                             **stack_instance.instance_params,
                             **item.params
@@ -719,7 +858,7 @@ class StackHandler(Handler):
                                             opa_service_params,
                                             outputs=policy.outputs)
         if item.replicas != {}:
-            service_targets = self.evaluate_replica_policy(
+            service_targets = await self.evaluate_replica_policy(
                 item, service_targets)
             if not service_targets['result']['fulfilled']:
                 return None, "Not enough targets for extra replicas"
@@ -734,7 +873,7 @@ class StackHandler(Handler):
             return None, stack_instance
         return stack_instance, "Stack instance updating"
 
-    def _handle_delete(self, item):
+    async def _handle_delete(self, item):
         """
         Handles the delete action of a stack instance
         """
@@ -17,7 +17,14 @@ from fastapi.routing import APIRoute
 from loguru import logger
 
 from core import config
+from core.agent_broker.job_results import job_results
+from core.agent_broker.orchestrator import orchestrator
+from core.manager import stackl_manager
+from core.manager.document_manager import DocumentManager
+from core.manager.snapshot_compactor import snapshot_compactor
+from core.migrations.create_indexes import create_indexes
 from core.migrations.upgrade2to3 import upgrade
+from core.opa_broker.opa_broker_factory import OPABrokerFactory
 
 from .routers import (about_router, functional_requirements_router,
                       infrastructure_base_router, outputs_router,
@@ -41,6 +48,21 @@ app = FastAPI(title="STACKL",
 
 # Migrations
 upgrade()
+create_indexes()
+
+
+def sync_opa_policies():
+    """Makes sure OPA has the current version of every policy template"""
+    try:
+        OPABrokerFactory().get_opa_broker().sync_policies(
+            DocumentManager().get_policy_templates())
+    except Exception as err:  # pylint: disable=broad-except
+        logger.warning(
+            f"Could not sync policies with OPA, they will be uploaded on first use: {err}"
+        )
+
+
+sync_opa_policies()
 
 if config.settings.elastic_apm_enabled:
     logger.debug("Elastic APM Enabled")
@@ -75,6 +97,28 @@ app.include_router(outputs_router.router, prefix="/outputs", tags=["outputs"])
 app.include_router(about_router.router, prefix="/about", tags=["about"])
 
 
+@app.on_event("startup")
+async def open_redis_pool():
+    """
+    Creates the Redis pool used to enqueue automation jobs, starts listening
+    for their results, resumes orchestrations and compacts snapshots
+    """
+    await stackl_manager.get_redis()
+    await job_results.start()
+    await orchestrator.start()
+    await snapshot_compactor.start()
+
+
+@app.on_event("shutdown")
+async def close_connections():
+    """Closes the pooled connections to Redis and OPA"""
+    await snapshot_compactor.stop()
+    await orchestrator.stop()
+    await job_results.stop()
+    await stackl_manager.close_redis_pool()
+    await OPABrokerFactory().get_opa_broker().close()
+
+
 def use_route_names_as_operation_ids(application: FastAPI) -> None:
     """
     Simplify operation IDs so that generated API clients have simpler function
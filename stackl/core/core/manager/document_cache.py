@@ -0,0 +1,85 @@
+"""
+Module for the cache of parsed config documents
+"""
+import json
+from uuid import uuid4
+
+from loguru import logger
+
+from core import config
+from core.datastore.datastore_factory import DataStoreFactory
+from core.utils.cache import LRUCache
+from core.utils.stackl_singleton import Singleton
+
+INVALIDATION_CHANNEL = "stackl:invalidations"
+
+
+class DocumentCache(metaclass=Singleton):
+    """
+    Process wide cache of parsed config documents, shared by all managers.
+    Invalidations are published on the store so the other workers drop their
+    copy too, the time to live bounds the staleness when a message is lost.
+    Invalidations are also published and received when the cache is disabled,
+    the listeners keep caches of their own.
+    """
+
+    def __init__(self):
+        self.enabled = config.settings.stackl_cache_enabled
+        self.cache = LRUCache(maxsize=config.settings.stackl_cache_size,
+                              ttl=config.settings.stackl_cache_ttl)
+        self._origin = uuid4().hex
+        self._listeners = []
+        self._store = DataStoreFactory().get_store()
+        self._subscriber = self._store.subscribe(INVALIDATION_CHANNEL,
+                                                 self._handle_invalidation)
+
+    def add_listener(self, callback):
+        """
+        Registers a callback which is called with the type and name of every
+        invalidated document, in this process and in the other workers
+        """
+        self._listeners.append(callback)
+
+    @property
+    def generation(self):
+        """Returns the current generation of the cache"""
+        return self.cache.generation
+
+    def get(self, document_type, name):
+        """Returns a copy of a cached document or None"""
+        if not self.enabled:
+            return None
+        document = self.cache.get((document_type, name))
+        if document is None:
+            return None
+        return document.copy(deep=True)
+
+    def set(self, document_type, name, document, generation):
+        """Caches a document which was read at the given generation"""
+        if self.enabled:
+            self.cache.set((document_type, name),
+                           document.copy(deep=True),
+                           generation=generation)
+
+    def invalidate(self, document_type, name):
+        """Drops a document in this process and in all other workers"""
+        self._invalidate(document_type, name)
+        self._store.publish(
+            INVALIDATION_CHANNEL,
+            json.dumps({
+                "origin": self._origin,
+                "type": document_type,
+                "name": name
+            }))
+
+    def _invalidate(self, document_type, name):
+        logger.debug(
+            f"[DocumentCache] invalidating '{document_type}' '{name}'")
+        self.cache.invalidate((document_type, name))
+        for callback in self._listeners:
+            callback(document_type, name)
+
+    def _handle_invalidation(self, message):
+        invalidation = json.loads(message)
+        if invalidation["origin"] != self._origin:
+            self._invalidate(invalidation["type"], invalidation["name"])
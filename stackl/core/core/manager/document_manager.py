@@ -1,11 +1,12 @@
 """Module for Stackl Documents"""
 
 import json
-from typing import List
+from typing import Dict, List
 
 from loguru import logger
 from pydantic import parse_obj_as
 
+from core import config
 from core.enums.stackl_codes import StatusCode
 from core.models.configs.document_model import BaseDocument
 from core.models.configs.environment_model import Environment
@@ -19,6 +20,7 @@ from core.models.history.snapshot_model import Snapshot
 from core.models.items.service_model import Service
 from core.models.items.stack_instance_model import StackInstance
 from core.utils.stackl_exceptions import InvalidDocTypeError, InvalidDocNameError
+from .document_cache import DocumentCache
 from .manager import Manager
 
 types_categories = ["configs", "items", "history"]
@@ -74,6 +76,111 @@ def _process_document_keys(keys):
 class DocumentManager(Manager):
     """Manager for everything document related"""
 
+    def __init__(self):
+        super().__init__()
+        self.cache = DocumentCache()
+
+    def _get_config_document(self, model, document_type, name):
+        """
+        Gets a parsed config document, served from the cache when possible
+        """
+        document = self.cache.get(document_type, name)
+        if document is not None:
+            return document
+        generation = self.cache.generation
+        store_response = self.store.get(type=document_type,
+                                        name=name,
+                                        category="configs")
+        if store_response.status_code == StatusCode.NOT_FOUND:
+            return None
+        document = model.parse_obj(store_response.content)
+        self.cache.set(document_type, name, document, generation)
+        return document
+
+    def _get_config_documents(self, model, document_type, names):
+        """
+        Gets multiple parsed config documents by name as a dict. Only the
+        documents missing from the cache are read, in a single store call
+        """
+        documents = {}
+        missing = []
+        for name in set(names):
+            document = self.cache.get(document_type, name)
+            if document is None:
+                missing.append(name)
+            else:
+                documents[name] = document
+        if missing:
+            generation = self.cache.generation
+            store_response = self.store.get_many("configs", document_type,
+                                                 missing)
+            for content in store_response.content:
+                document = model.parse_obj(content)
+                self.cache.set(document_type, document.name, document,
+                               generation)
+                documents[document.name] = document
+        return documents
+
+    def _invalidate(self, document):
+        """Drops a written or deleted config document from the cache"""
+        if document.get("category") == "configs":
+            self.cache.invalidate(document.get("type"), document.get("name"))
+
+    def _merge_statuses(self, stack_instance_documents):
+        """
+        Sets the statuses, which are stored apart from the stack instances, on
+        the stack instance documents. Documents written before the statuses
+        were stored apart keep their own statuses
+        """
+        statuses = self.store.get_statuses(
+            [document["name"] for document in stack_instance_documents])
+        for document in stack_instance_documents:
+            if document["name"] in statuses:
+                document["status"] = statuses[document["name"]]
+        return stack_instance_documents
+
+    def _put_stack_instance(self,
+                            document,
+                            write_statuses=True,
+                            expected_version=None):
+        """
+        Puts a stack instance document, its statuses are stored apart so a
+        status can be updated without rewriting the document. Without
+        write_statuses the stored statuses are left as they are.
+        With an expected version the document is only written when nobody
+        wrote it since that version, otherwise it overwrites the stored one
+        """
+        document = dict(document)
+        statuses = document.get("status")
+        if statuses is not None:
+            document["status"] = []
+        for _ in range(config.settings.stackl_write_retries):
+            version = expected_version
+            if version is None:
+                version = self.store.get_version(category="items",
+                                                 type="stack_instance",
+                                                 name=document["name"])
+            store_response = self.store.put_versioned(document, version)
+            if store_response.status_code != StatusCode.CONFLICT or \
+                    expected_version is not None:
+                break
+        if store_response.status_code == StatusCode.CONFLICT:
+            logger.info(
+                f"[DocumentManager] Stack instance '{document['name']}' was "
+                f"changed concurrently: {store_response.reason}"
+            )
+            return store_response
+        if statuses is not None:
+            self.store.set_statuses(document["name"],
+                                    statuses,
+                                    replace=write_statuses)
+        return store_response
+
+    def _put_document(self, document):
+        if document.get("type") == "stack_instance":
+            return self._put_stack_instance(document)
+        return self.store.put(document)
+
     def get_document(self, **keys):
         """Get a document from the chosen store"""
         logger.debug(f"[DocumentManager] get_document. Keys '{keys}'")
@@ -83,6 +190,8 @@ class DocumentManager(Manager):
         store_response = self.store.get(**keys)
         if store_response.status_code == StatusCode.NOT_FOUND:
             return {}
+        if keys["type"] == "stack_instance":
+            self._merge_statuses([store_response.content])
         return store_response.content
 
     def write_document(self, document, overwrite=False):
@@ -104,7 +213,8 @@ class DocumentManager(Manager):
             logger.debug(
                 f" No document found yet. Creating document with data: {json.dumps(document)}"
             )
-            store_response = self.store.put(document)
+            store_response = self._put_document(document)
+            self._invalidate(document)
             return store_response.status_code
         if overwrite:
             prev_document_string = json.dumps(prev_document)
@@ -123,7 +233,8 @@ class DocumentManager(Manager):
                 )
                 return StatusCode.OK
 
-            store_response = self.store.put(document)
+            store_response = self._put_document(document)
+            self._invalidate(document)
             return store_response.status_code
         logger.debug(
             "Document already exists and overwrite is false. Returning."
@@ -133,6 +244,7 @@ class DocumentManager(Manager):
     def write_base_document(self, base_document: BaseDocument):
         """Writes a base document to the store"""
         store_response = self.store.put(base_document.dict())
+        self._invalidate(store_response.content)
         return store_response.content
 
     def delete_base_document(self, document_type, name):
@@ -140,18 +252,13 @@ class DocumentManager(Manager):
         store_response = self.store.delete(type=document_type,
                                            category="configs",
                                            name=name)
+        self.cache.invalidate(document_type, name)
         return store_response
 
     def get_policy_template(self, policy_name):
         """gets a PolicyTemplate from the store"""
-        store_response = self.store.get(type="policy_template",
-                                        name=policy_name,
-                                        category="configs")
-        if store_response.status_code == 404:
-            return None
-
-        policy = PolicyTemplate.parse_obj(store_response.content)
-        return policy
+        return self._get_config_document(PolicyTemplate, "policy_template",
+                                         policy_name)
 
     def get_policy_templates(self):
         """gets all PolicyTemplate from the store"""
@@ -161,11 +268,16 @@ class DocumentManager(Manager):
                                         store_response.content)
         return policy_templates
 
+    def get_policy_templates_by_name(self, names) -> Dict[str, PolicyTemplate]:
+        """gets multiple PolicyTemplates from the store by name"""
+        return self._get_config_documents(PolicyTemplate, "policy_template",
+                                          names)
+
     def write_policy_template(self, policy):
         """writes a PolicyTemplate to the store
         """
-        store_response = self.store.put(policy.dict())
-        policy = PolicyTemplate.parse_obj(store_response.content)
+        self.store.put(policy.dict())
+        self.cache.invalidate("policy_template", policy.name)
         return policy
 
     def delete_policy_template(self, name):
@@ -173,54 +285,195 @@ class DocumentManager(Manager):
         store_response = self.store.delete(type="policy_template",
                                            category="configs",
                                            name=name)
+        self.cache.invalidate("policy_template", name)
         return store_response
 
-    def get_stack_instance(self, stack_instance_name):
-        """gets a StackInstance Object from the store"""
+    def get_stack_instance(self, stack_instance_name, lazy=False):
+        """gets a StackInstance Object from the store. With lazy it is not
+        validated, its services are validated when they are accessed
+        """
+        document = self.get_stack_instance_document(stack_instance_name)
+        if document is None:
+            logger.debug("not found returning none")
+            return None
+        if lazy:
+            return StackInstance.from_stored(document)
+        return StackInstance.parse_obj(document)
+
+    def get_stack_instance_document(self, stack_instance_name):
+        """
+        Gets a stored stack instance document as it is, without validating
+        it. Use this to return a stack instance that is not changed
+        """
         store_response = self.store.get(type="stack_instance",
                                         name=stack_instance_name,
                                         category="items")
         if store_response.status_code == 404:
-            logger.debug("not found returning none")
             return None
-        stack_instance = StackInstance.parse_obj(store_response.content)
-        return stack_instance
+        return self._merge_statuses([store_response.content])[0]
 
     def get_stack_instances(self):
         """Get all stack instances"""
         store_response = self.store.get_all(document_type="stack_instance",
                                             category="items")
-        stack_instances = parse_obj_as(List[StackInstance],
-                                       store_response.content)
         if store_response.status_code == 404:
             return None
+        stack_instances = parse_obj_as(
+            List[StackInstance], self._merge_statuses(store_response.content))
         return stack_instances
 
-    def write_stack_instance(self, stack_instance):
-        """writes a StackInstance object to the store
+    def iter_stack_instances(self,
+                             name="",
+                             after="",
+                             limit=None,
+                             fields=None):
+        """
+        Yields stack instance documents sorted by name, a batch at a time so
+        they are never all in memory. Only the stack instances whose name
+        contains name and comes after after are yielded, at most limit of
+        them. With fields the documents only have those fields and their name
         """
-        store_response = self.store.put(stack_instance.dict())
+        remaining = limit
+        for names in self.store.get_names("items", "stack_instance", after):
+            names = [
+                stack_instance_name for stack_instance_name in names
+                if name in stack_instance_name
+            ]
+            if remaining is not None:
+                names = names[:remaining]
+            if not names:
+                continue
+            documents = self.store.get_many("items", "stack_instance",
+                                            names).content
+            # The statuses are stored apart, they are only read when needed
+            if fields is None or "status" in fields:
+                self._merge_statuses(documents)
+            for document in documents:
+                if fields is not None:
+                    document = {
+                        field: document[field]
+                        for field in ["name", *fields] if field in document
+                    }
+                yield document
+            if remaining is not None:
+                remaining -= len(documents)
+                if remaining <= 0:
+                    return
+
+    def write_stack_instance(self,
+                             stack_instance,
+                             write_statuses=True,
+                             expected_version=None):
+        """writes a StackInstance object to the store. Without write_statuses
+        the statuses in the store are kept, use this when the statuses of the
+        object were read earlier and could be outdated. With expected_version
+        the write fails with StatusCode.CONFLICT when the stack instance was
+        written since that version
+        """
+        store_response = self._put_stack_instance(stack_instance.to_stored(),
+                                                  write_statuses,
+                                                  expected_version)
+        if store_response.status_code != StatusCode.CONFLICT:
+            stack_instance.version = store_response.content["version"]
         return store_response.status_code
 
+    def write_stack_instances(self, stack_instances):
+        """
+        writes new StackInstance objects to the store at once. A stack
+        instance that is stored already is not overwritten, its status code
+        is StatusCode.CONFLICT. Returns the status code of every stack instance
+        """
+        documents = []
+        statuses = []
+        for stack_instance in stack_instances:
+            document = stack_instance.to_stored()
+            statuses.append(document.get("status"))
+            if document.get("status") is not None:
+                document["status"] = []
+            documents.append((document, 0))
+        store_responses = self.store.put_many_versioned(documents)
+        status_codes = []
+        statuses_by_name = {}
+        for stack_instance, store_response, stack_instance_statuses in zip(
+                stack_instances, store_responses, statuses):
+            status_codes.append(store_response.status_code)
+            if store_response.status_code == StatusCode.CONFLICT:
+                logger.info(
+                    f"[DocumentManager] Stack instance '{stack_instance.name}' exists already"
+                )
+                continue
+            stack_instance.version = store_response.content["version"]
+            if stack_instance_statuses is not None:
+                statuses_by_name[stack_instance.name] = stack_instance_statuses
+        self.store.set_many_statuses(statuses_by_name)
+        return status_codes
+
+    def update_stack_instance(self, name, update, write_statuses=False):
+        """
+        Reads a stack instance, changes it with the update function and writes
+        it back. When it was written by someone else in the meantime this is
+        retried with the new version, so no change is lost.
+        Returns the written stack instance or None
+        """
+        for _ in range(config.settings.stackl_write_retries):
+            stack_instance = self.get_stack_instance(name, lazy=True)
+            if stack_instance is None:
+                return None
+            update(stack_instance)
+            status_code = self.write_stack_instance(
+                stack_instance,
+                write_statuses,
+                expected_version=stack_instance.version)
+            if status_code != StatusCode.CONFLICT:
+                return stack_instance
+            logger.debug(
+                f"[DocumentManager] Retrying update of stack instance '{name}'"
+            )
+        logger.error(
+            f"[DocumentManager] Giving up updating stack instance '{name}' "
+            f"after {config.settings.stackl_write_retries} conflicts"
+        )
+        return None
+
+    def update_stack_instance_status(self,
+                                     stack_instance_name,
+                                     status,
+                                     remove=False):
+        """
+        Updates the status of a functional requirement of a stack instance,
+        or removes it, without rewriting the stack instance
+        """
+        updated = self.store.update_status(stack_instance_name, status,
+                                           remove)
+        if updated is None:
+            # Written before the statuses were stored apart, move them first
+            store_response = self.store.get(type="stack_instance",
+                                            name=stack_instance_name,
+                                            category="items")
+            if store_response.status_code == StatusCode.NOT_FOUND:
+                return False
+            self.store.set_statuses(stack_instance_name,
+                                    store_response.content.get("status")
+                                    or [],
+                                    replace=False)
+            updated = self.store.update_status(stack_instance_name, status,
+                                               remove)
+        return bool(updated)
+
     def delete_stack_instance(self, name):
         """Delete a stack instance by name"""
         store_response = self.store.delete(type="stack_instance",
                                            name=name,
                                            category="items")
+        self.store.delete_statuses(name)
         return store_response
 
     def get_stack_infrastructure_template(self,
                                           stack_infrastructure_template_name):
         """gets a StackInfrastructureTemplate Object from the store"""
-        store_response = self.store.get(
-            type="stack_infrastructure_template",
-            name=stack_infrastructure_template_name,
-            category="configs")
-        if store_response.status_code == 404:
-            return None
-        stack_infrastructure_template = StackInfrastructureTemplate.parse_obj(
-            store_response.content)
-        return stack_infrastructure_template
+        return self._get_config_document(StackInfrastructureTemplate,
+                                         "stack_infrastructure_template",
+                                         stack_infrastructure_template_name)
 
     def get_stack_infrastructure_templates(self):
         """Get a stack infrastructure template"""
@@ -235,6 +488,8 @@ class DocumentManager(Manager):
         """writes a StackInfrastructureTemplate object to the store
         """
         store_response = self.store.put(stack_infrastructure_template.dict())
+        self.cache.invalidate("stack_infrastructure_template",
+                              stack_infrastructure_template.name)
         return store_response.content
 
     def delete_stack_infrastructure_template(self, name):
@@ -243,20 +498,15 @@ class DocumentManager(Manager):
             type="stack_infrastructure_template",
             category="configs",
             name=name)
+        self.cache.invalidate("stack_infrastructure_template", name)
         return store_response
 
     def get_stack_application_template(
             self, stack_application_template_name) -> StackApplicationTemplate:
         """Gets a StackApplicationTemplate Object from the store"""
-        store_response = self.store.get(type="stack_application_template",
-                                        name=stack_application_template_name,
-                                        category="configs")
-        if store_response.status_code == 404:
-            return None
-
-        stack_application_template = StackApplicationTemplate.parse_obj(
-            store_response.content)
-        return stack_application_template
+        return self._get_config_document(StackApplicationTemplate,
+                                         "stack_application_template",
+                                         stack_application_template_name)
 
     def get_stack_application_templates(
             self) -> List[StackApplicationTemplate]:
@@ -272,6 +522,8 @@ class DocumentManager(Manager):
         """writes a StackApplicationTemplate object to the store
         """
         store_response = self.store.put(stack_application_template.dict())
+        self.cache.invalidate("stack_application_template",
+                              stack_application_template.name)
         return store_response.content
 
     def delete_stack_application_template(self, name):
@@ -279,18 +531,13 @@ class DocumentManager(Manager):
         store_response = self.store.delete(type="stack_application_template",
                                            category="configs",
                                            name=name)
+        self.cache.invalidate("stack_application_template", name)
         return store_response
 
     def get_environment(self, environment_name):
         """gets a Environment Object from the store"""
-        store_response = self.store.get(type="environment",
-                                        name=environment_name,
-                                        category="configs")
-        if store_response.status_code == 404:
-            return None
-
-        environment = Environment.parse_obj(store_response.content)
-        return environment
+        return self._get_config_document(Environment, "environment",
+                                         environment_name)
 
     def get_environments(self):
         """Get all environments from the store"""
@@ -301,14 +548,7 @@ class DocumentManager(Manager):
 
     def get_location(self, location_name):
         """gets a Location Object from the store"""
-        store_response = self.store.get(type="location",
-                                        name=location_name,
-                                        category="configs")
-        if store_response.status_code == 404:
-            return None
-
-        location = Location.parse_obj(store_response.content)
-        return location
+        return self._get_config_document(Location, "location", location_name)
 
     def get_locations(self):
         """Gets all locations from the store"""
@@ -319,14 +559,7 @@ class DocumentManager(Manager):
 
     def get_zone(self, zone_name):
         """gets a Zone Object from the store"""
-        store_response = self.store.get(type="zone",
-                                        name=zone_name,
-                                        category="configs")
-        if store_response.status_code == 404:
-            return None
-
-        zone = Zone.parse_obj(store_response.content)
-        return zone
+        return self._get_config_document(Zone, "zone", zone_name)
 
     def get_zones(self):
         """Gets all zones from the store"""
@@ -351,6 +584,12 @@ class DocumentManager(Manager):
         services = parse_obj_as(List[Service], store_response.content)
         return services
 
+    def get_services_by_name(self, names) -> Dict[str, Service]:
+        """Gets multiple services from the store by name"""
+        store_response = self.store.get_many("items", "service", set(names))
+        services = parse_obj_as(List[Service], store_response.content)
+        return {service.name: service for service in services}
+
     def write_service(self, service: Service):
         """writes a Service object to the store
         """
@@ -363,14 +602,9 @@ class DocumentManager(Manager):
 
     def get_functional_requirement(self, functional_requirement_name):
         """gets a FunctionalRequirement Object from the store"""
-        store_response = self.store.get(type="functional_requirement",
-                                        name=functional_requirement_name,
-                                        category="configs")
-        if store_response.status_code == 404:
-            return None
-
-        fr = FunctionalRequirement.parse_obj(store_response.content)
-        return fr
+        return self._get_config_document(FunctionalRequirement,
+                                         "functional_requirement",
+                                         functional_requirement_name)
 
     def get_functional_requirements(self) -> List[FunctionalRequirement]:
         """gets a FunctionalRequirement Object from the store"""
@@ -379,10 +613,18 @@ class DocumentManager(Manager):
         fr = parse_obj_as(List[FunctionalRequirement], store_response.content)
         return fr
 
+    def get_functional_requirements_by_name(
+            self, names) -> Dict[str, FunctionalRequirement]:
+        """Gets multiple FunctionalRequirements from the store by name"""
+        return self._get_config_documents(FunctionalRequirement,
+                                          "functional_requirement", names)
+
     def write_functional_requirement(self, functional_requirement: FunctionalRequirement):
         """writes a Service object to the store
         """
         store_response = self.store.put(functional_requirement.dict())
+        self.cache.invalidate("functional_requirement",
+                              functional_requirement.name)
         return store_response.content
 
     def delete_functional_requirement(self, name: str):
@@ -390,6 +632,7 @@ class DocumentManager(Manager):
         self.store.delete(type="functional_requirement",
                           name=name,
                           category="configs")
+        self.cache.invalidate("functional_requirement", name)
 
     def get_snapshot(self, name) -> Snapshot:
         """Get a snapshot from the store"""
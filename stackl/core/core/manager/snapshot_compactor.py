@@ -0,0 +1,68 @@
+"""
+Module for removing the snapshots past their retention
+
+Every core worker runs the compactor, a lock in Redis makes sure only one of
+them compacts the snapshots per compaction interval.
+"""
+
+import asyncio
+
+from loguru import logger
+
+from core import config
+from core.manager.stackl_manager import get_redis, get_snapshot_manager
+
+#: Held by the worker compacting the snapshots
+COMPACTION_LOCK_KEY = "snapshot_compaction_lock"
+
+
+class SnapshotCompactor:
+    """Periodically applies the snapshot retention and rebases the chains"""
+
+    def __init__(self):
+        self._compactor = None
+
+    async def compact(self, redis):
+        """
+        Compacts the snapshots unless another worker did so during the last
+        compaction interval, returns the amount of removed snapshots
+        """
+        interval = config.settings.stackl_snapshot_compaction_interval
+        acquired = await redis.set(COMPACTION_LOCK_KEY,
+                                   "locked",
+                                   expire=interval,
+                                   exist=redis.SET_IF_NOT_EXIST)
+        if not acquired:
+            return 0
+        # The datastore is synchronous, so it is used outside the event loop
+        removed = await asyncio.get_event_loop().run_in_executor(
+            None,
+            get_snapshot_manager().compact_snapshots)
+        logger.info(f"[SnapshotCompactor] Removed {removed} snapshots")
+        return removed
+
+    async def start(self):
+        """Compacts the snapshots every compaction interval"""
+        if self._compactor is None and \
+                config.settings.stackl_snapshot_compaction_interval > 0:
+            self._compactor = asyncio.ensure_future(
+                self._compact_periodically())
+
+    async def _compact_periodically(self):
+        while True:
+            try:
+                await self.compact(await get_redis())
+            except Exception as err:  # pylint: disable=broad-except
+                logger.warning(
+                    f"[SnapshotCompactor] Could not compact snapshots: {err}")
+            await asyncio.sleep(
+                config.settings.stackl_snapshot_compaction_interval)
+
+    async def stop(self):
+        """Stops compacting the snapshots"""
+        if self._compactor is not None:
+            self._compactor.cancel()
+            self._compactor = None
+
+
+snapshot_compactor = SnapshotCompactor()
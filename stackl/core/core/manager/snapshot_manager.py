@@ -1,16 +1,54 @@
 """
 Module for snapshot manager
+
+Snapshots of a document form a chain. Every few snapshots the whole document
+is stored compressed as a base, the snapshots in between only store the JSON
+patch from the snapshot before them. Reading a snapshot applies the patches
+from its base onwards.
 """
+import base64
 import time
 
 from loguru import logger
 
+from core import config
+from core.datastore.codec import Codec
 from core.enums.stackl_codes import StatusCode
 from core.manager.document_manager import DocumentManager
 from core.utils.general_utils import get_timestamp
+from core.utils.json_patch import apply_patch, make_patch
 from .manager import Manager
 
 
+def _get_snapshot_prefix(type_name, name):
+    if type_name not in name:
+        return f"{type_name}_{name}"
+    return name
+
+
+def _get_document_key(type_name, name):
+    return f"{type_name}/{name}"
+
+
+def _get_chain_key(stored):
+    """Returns the key of the document a stored snapshot was taken from"""
+    if "document" in stored:
+        return stored["document"]
+    # Snapshots from before the chains hold the whole document
+    snapshot = stored.get("snapshot") or {}
+    return _get_document_key(snapshot.get("type"), snapshot.get("name"))
+
+
+def _is_snapshot_of(stored, document_key):
+    return _get_chain_key(stored) == document_key
+
+
+def _get_base_codec():
+    return Codec(config.settings.stackl_datastore_codec,
+                 config.settings.stackl_datastore_compression or "zlib",
+                 compression_min_size=0)
+
+
 class SnapshotManager(Manager):
     """Snapshot manager class"""
 
@@ -18,25 +56,122 @@ class SnapshotManager(Manager):
         super().__init__()
         self.document_manager = DocumentManager()
 
+    def _lock_chain(self, document_key):
+        """
+        Returns a context manager holding the lock of the snapshot chain of a
+        document, the chain only changes while it is held
+        """
+        return self.document_manager.store.lock(f"snapshots/{document_key}")
+
+    def _get_stored_snapshot(self, name):
+        return self.document_manager.get_document(type="snapshot", name=name)
+
+    def _get_stored_snapshots(self, type_name, name):
+        """Returns the stored snapshots of a document, oldest first"""
+        document_key = _get_document_key(type_name, name)
+        stored_snapshots = [
+            stored for stored in self.document_manager.get_snapshots(
+                "snapshot", _get_snapshot_prefix(type_name, name))
+            if _is_snapshot_of(stored, document_key)
+        ]
+        return sorted(stored_snapshots, key=lambda stored: stored["time"])
+
+    def _get_document(self, stored, stored_by_name):
+        """
+        Returns the document of a stored snapshot, stored_by_name holds the
+        snapshots already read, the rest of the chain is read from the store
+        """
+        chain = [stored]
+        while "patch" in chain[-1]:
+            previous = chain[-1]["previous"]
+            if previous not in stored_by_name:
+                stored_by_name[previous] = self._get_stored_snapshot(previous)
+            chain.append(stored_by_name[previous])
+        base = chain.pop()
+        if "base" in base:
+            document = Codec.decode(base64.b64decode(base["base"]))
+        else:
+            document = base["snapshot"]
+        for delta in reversed(chain):
+            document = apply_patch(document, delta["patch"])
+        return document
+
+    def _get_documents(self, stored_snapshots):
+        """
+        Returns the documents of stored snapshots by name, a patch after a
+        snapshot of the list is applied to the document already built
+        """
+        stored_by_name = {stored["name"]: stored for stored in stored_snapshots}
+        documents = {}
+        for stored in stored_snapshots:
+            if "patch" in stored and stored["previous"] in documents:
+                documents[stored["name"]] = apply_patch(
+                    documents[stored["previous"]], stored["patch"])
+            else:
+                documents[stored["name"]] = self._get_document(
+                    stored, stored_by_name)
+        return documents
+
+    def _get_depth(self, stored, stored_by_name):
+        """Returns the amount of patches since the base of a stored snapshot"""
+        depth = 0
+        while "patch" in stored:
+            stored = stored_by_name.get(stored["previous"]) or \
+                self._get_stored_snapshot(stored["previous"])
+            depth += 1
+        return depth
+
+    @staticmethod
+    def _to_snapshot(stored, document):
+        return {
+            "name": stored["name"],
+            "type": stored["type"],
+            "category": stored["category"],
+            "description": stored.get("description"),
+            "time": stored["time"],
+            "snapshot": document
+        }
+
+    @staticmethod
+    def _encode(stored, document, previous_document):
+        """Stores a document as a patch or, without previous document, a base"""
+        stored.pop("base", None)
+        stored.pop("patch", None)
+        stored.pop("snapshot", None)
+        if previous_document is None:
+            stored["previous"] = None
+            stored["base"] = base64.b64encode(
+                _get_base_codec().encode(document)).decode()
+        else:
+            stored["patch"] = make_patch(previous_document, document)
+        return stored
+
     def get_snapshot(self, name):
         """
         Gets a snapshot from the store
         """
-        result = self.document_manager.get_document(type="snapshot", name=name)
-        return result
+        stored = self._get_stored_snapshot(name)
+        if not stored:
+            return stored
+        return self._to_snapshot(stored, self._get_document(stored, {}))
 
     def get_snapshots(self, type_doc, name_doc):
         """Get all snapshots from a document"""
         logger.debug(
             f"Get the snapshots for doc with type '{type_doc}' and name '{name_doc}'"
         )
-        iter_key = f"{type_doc}_{name_doc}"
-        results = self.document_manager.get_snapshots("snapshot", iter_key)
-
-        return results
+        stored_snapshots = self._get_stored_snapshots(type_doc, name_doc)
+        documents = self._get_documents(stored_snapshots)
+        return [
+            self._to_snapshot(stored, documents[stored["name"]])
+            for stored in stored_snapshots
+        ]
 
     def create_snapshot(self, type_name, name):
-        """Create a snapshot from a document"""
+        """
+        Create a snapshot from a document, it is stored as a patch from the
+        latest snapshot unless the chain reached the rebase interval
+        """
         logger.debug(
             f"Creating snapshot for document with type '{type_name}' and name '{name}'"
         )
@@ -46,15 +181,32 @@ class SnapshotManager(Manager):
         snapshot_document['category'] = "history"
         snapshot_document['type'] = "snapshot"
         snapshot_document['time'] = time.time()
-        if type_name not in name:
-            snapshot_document['name'] = type_name + "_" + name + "_" + str(
-                get_timestamp(spaces=False))
-        else:
-            snapshot_document['name'] = name + "_" + str(
-                get_timestamp(spaces=False))
+        snapshot_document['name'] = _get_snapshot_prefix(
+            type_name, name) + "_" + str(get_timestamp(spaces=False))
         snapshot_document['description'] = snapshot_document.get("description")
-        snapshot_document["snapshot"] = document
-        result = self.document_manager.write_document(snapshot_document)
+        snapshot_document['document'] = _get_document_key(type_name, name)
+        with self._lock_chain(snapshot_document['document']):
+            # A snapshot with the same name is not overwritten by
+            # write_document
+            stored_snapshots = [
+                stored
+                for stored in self._get_stored_snapshots(type_name, name)
+                if stored["name"] != snapshot_document['name'].lower()
+            ]
+            previous_document = None
+            if stored_snapshots:
+                latest = stored_snapshots[-1]
+                stored_by_name = {
+                    stored["name"]: stored
+                    for stored in stored_snapshots
+                }
+                if self._get_depth(latest, stored_by_name) + 1 < \
+                        config.settings.stackl_snapshot_rebase_interval:
+                    previous_document = self._get_document(
+                        latest, stored_by_name)
+                    snapshot_document['previous'] = latest["name"]
+            self._encode(snapshot_document, document, previous_document)
+            result = self.document_manager.write_document(snapshot_document)
         return result
 
     def restore_snapshot(self, snapshot_name):
@@ -75,21 +227,104 @@ class SnapshotManager(Manager):
 
     def restore_latest_snapshot(self, type_doc, name_doc):
         """Restore the most recent snapshot of a document"""
-        snapshots = self.get_snapshots(type_doc, name_doc)
-        latest_snapshot = {"time": 0}
-        for snapshot in snapshots:
-            if snapshot['time'] > latest_snapshot['time']:
-                latest_snapshot = snapshot
-
-        return self.restore_snapshot(latest_snapshot['name'])
+        stored_snapshots = self._get_stored_snapshots(type_doc, name_doc)
+        if not stored_snapshots:
+            return StatusCode.NOT_FOUND
+        return self.restore_snapshot(stored_snapshots[-1]['name'])
 
     def delete_snapshot(self, name_doc_to_delete):
-        """Delete a snapshot by name"""
+        """
+        Delete a snapshot by name, the snapshot after it is rewritten so it no
+        longer needs the deleted one
+        """
         logger.debug(
             f"name doc to delete:  '{name_doc_to_delete}'"
         )
-        snapshot_document = self.get_snapshot(name_doc_to_delete)
+        stored = self._get_stored_snapshot(name_doc_to_delete)
         logger.debug(
-            f"[SnapshotManager] snapshot_to_delete. Snapshot to delete: '{snapshot_document}'"
+            f"[SnapshotManager] snapshot_to_delete. Snapshot to delete: '{stored}'"
         )
-        self.document_manager.delete_snapshot(name=snapshot_document['name'])
+        if not stored:
+            return StatusCode.NOT_FOUND
+        document_key = _get_chain_key(stored)
+        with self._lock_chain(document_key):
+            # The chain is read again, a snapshot may have been added to it
+            type_name, name = document_key.split("/", 1)
+            stored_snapshots = self._get_stored_snapshots(type_name, name)
+            remaining = [
+                other for other in stored_snapshots
+                if other["name"] != stored["name"]
+            ]
+            self._write_chain(stored_snapshots, remaining)
+            return self.document_manager.delete_snapshot(name=stored['name'])
+
+    def _write_chain(self, stored_snapshots, remaining):
+        """
+        Rewrites the remaining snapshots of a chain that need it once the
+        others are gone. The oldest one becomes a base, and so does every
+        snapshot that is rebase interval snapshots from its base
+        """
+        documents = self._get_documents(stored_snapshots)
+        rewritten = 0
+        previous = None
+        depth = 0
+        for stored in remaining:
+            is_base = "patch" not in stored
+            depth = 0 if is_base else depth + 1
+            needs_base = depth >= config.settings.stackl_snapshot_rebase_interval
+            if is_base or (stored["previous"] == previous and not needs_base):
+                previous = stored["name"]
+                continue
+            document = documents[stored["name"]]
+            if previous is None or needs_base:
+                self._encode(stored, document, None)
+                depth = 0
+            else:
+                stored["previous"] = previous
+                self._encode(stored, document, documents[previous])
+            self.document_manager.write_document(stored, overwrite=True)
+            rewritten += 1
+            previous = stored["name"]
+        return rewritten
+
+    def compact_snapshots(self, now=None):
+        """
+        Removes the snapshots past the retention and rebases the chains left
+        behind. A document keeps its latest snapshot, older ones are removed
+        once there are stackl_snapshot_keep newer ones or they are older than
+        stackl_snapshot_max_age seconds. Returns the amount of removed
+        snapshots
+        """
+        if now is None:
+            now = time.time()
+        keep = config.settings.stackl_snapshot_keep
+        max_age = config.settings.stackl_snapshot_max_age
+        document_keys = {
+            _get_chain_key(stored)
+            for stored in self.document_manager.get_snapshots("snapshot", "")
+        }
+        removed = 0
+        for document_key in sorted(document_keys):
+            with self._lock_chain(document_key):
+                type_name, name = document_key.split("/", 1)
+                stored_snapshots = self._get_stored_snapshots(type_name, name)
+                newest_first = list(reversed(stored_snapshots))
+                expired = {
+                    stored["name"]
+                    for position, stored in enumerate(newest_first)
+                    if position > 0 and ((keep and position >= keep) or (
+                        max_age and stored["time"] < now - max_age))
+                }
+                remaining = [
+                    stored for stored in stored_snapshots
+                    if stored["name"] not in expired
+                ]
+                self._write_chain(stored_snapshots, remaining)
+                for name in expired:
+                    self.document_manager.delete_snapshot(name=name)
+            if expired:
+                logger.info(
+                    f"[SnapshotManager] Removed {len(expired)} snapshots of '{document_key}'"
+                )
+            removed += len(expired)
+        return removed
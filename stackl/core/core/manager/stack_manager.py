@@ -1,6 +1,7 @@
 """
 Module for managing stack instances
 """
+import asyncio
 from typing import Dict, Any
 
 from loguru import logger
@@ -32,16 +33,20 @@ class StackManager(Manager):
         self.document_manager = DocumentManager()
 
     def add_outputs(self, outputs_update: OutputsUpdate):
-        """Method for adding outputs to a stack instance"""
+        """
+        Method for adding outputs to a stack instance, outputs of services
+        arriving at the same time are all kept
+        """
         handler = StackHandler(self.document_manager, self.opa_broker)
-        stack_instance = handler.add_outputs(outputs_update)
-        return stack_instance
+        return self.document_manager.update_stack_instance(
+            outputs_update.stack_instance, lambda stack_instance: handler.
+            add_outputs(outputs_update, stack_instance))
 
     def check_delete_services(self, instance_data):
         handler = StackHandler(self.document_manager, self.opa_broker)
         return handler.check_difference(instance_data)
 
-    def process_stack_request(self, instance_data, stack_action):
+    async def process_stack_request(self, instance_data, stack_action):
         """prepares a create, update or delete of a stack instance"""
         # create new object with the action and document in it
         logger.debug(
@@ -60,12 +65,78 @@ class StackManager(Manager):
         job['document'] = instance_data
         job['type'] = 'stack_instance'
         handler = StackHandler(self.document_manager, self.opa_broker)
-        stack_instance, err_message = handler.handle(job)
+        stack_instance, err_message = await handler.handle(job)
         logger.debug(
             f"Handle complete. stack_instance '{stack_instance}'"
         )
         return stack_instance, err_message
 
+    async def process_stack_requests(self, instances_data):
+        """
+        prepares the creates of several stack instances. Requests with the
+        same SIT and SAT are handled together, so the templates are resolved
+        once. Returns a (stack instance, result) tuple per request, the stack
+        instance is None when the request failed and the result then is the
+        error message
+        """
+        logger.debug(
+            f"Processing create requests of {len(instances_data)} stack instances"
+        )
+        results = [None] * len(instances_data)
+        names = [
+            instance_data.stack_instance_name
+            for instance_data in instances_data
+        ]
+        existing_names = {
+            document["name"]
+            for document in self.document_manager.store.get_many(
+                "items", "stack_instance", names).content
+        }
+        requested_names = set()
+        groups = {}
+        for position, instance_data in enumerate(instances_data):
+            if instance_data.stack_instance_name in existing_names:
+                results[position] = None, "Stack instance already exists"
+                continue
+            if instance_data.stack_instance_name in requested_names:
+                results[position] = None, "Stack instance is requested twice"
+                continue
+            requested_names.add(instance_data.stack_instance_name)
+            groups.setdefault((instance_data.stack_infrastructure_template,
+                               instance_data.stack_application_template),
+                              []).append(position)
+
+        async def handle_group(templates, positions):
+            stack_infr_template_name, stack_app_template_name = templates
+            error = None
+            if not self.document_manager.get_stack_infrastructure_template(
+                    stack_infr_template_name):
+                error = "Stack infrastructure template: " \
+                        f"{stack_infr_template_name} does not exist"
+            elif not self.document_manager.get_stack_application_template(
+                    stack_app_template_name):
+                error = f"Stack application template: " \
+                        f"{stack_app_template_name} does not exist"
+            if error is not None:
+                for position in positions:
+                    results[position] = None, error
+                return
+            handler = StackHandler(self.document_manager, self.opa_broker)
+            group_results = await handler.handle_creates(
+                [instances_data[position] for position in positions])
+            for position, result in zip(positions, group_results):
+                if isinstance(result, Exception):
+                    logger.opt(exception=result).error(
+                        f"Creating stack instance '{names[position]}' failed")
+                    result = None, str(result)
+                results[position] = result
+
+        await asyncio.gather(*[
+            handle_group(templates, positions)
+            for templates, positions in groups.items()
+        ])
+        return results
+
     def _validate_stack_request(self, instance_data,
                                 stack_action) -> (bool, str):
         """Validates a request for a stack instance"""
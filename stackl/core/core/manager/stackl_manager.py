@@ -1,17 +1,33 @@
 """Module for easy access to the managers"""
-from arq import create_pool
-from arq.connections import RedisSettings
+import asyncio
+
+import aioredis
+from arq.connections import ArqRedis, RedisSettings
+from loguru import logger
 
 from core import config
 from core.manager.document_manager import DocumentManager
 from core.manager.snapshot_manager import SnapshotManager
 from core.manager.stack_manager import StackManager
+from core.opa_broker.opa_broker_factory import OPABrokerFactory
 
 document_manager = DocumentManager()
 snapshot_manager = SnapshotManager()
 stack_manager = StackManager()
 
 
+class RedisPoolHolder:
+    """Holds the Redis pool used to enqueue automation jobs"""
+    def __init__(self):
+        #: Redis pool shared by all requests
+        self.pool = None
+        #: Makes sure concurrent requests create a single pool
+        self.lock = None
+
+
+redis_pool_holder = RedisPoolHolder()
+
+
 def get_document_manager():
     """Returns the document manager"""
     return document_manager
@@ -27,9 +43,61 @@ def get_stack_manager():
     return stack_manager
 
 
+def get_opa_broker():
+    """Returns the OPA broker"""
+    return OPABrokerFactory().get_opa_broker()
+
+
+async def create_redis_pool():
+    """
+    Creates the Redis pool shared by all requests. Connecting is retried like
+    arq does, so a Redis that is briefly unavailable does not stop core
+    """
+    logger.info("[StacklManager] Creating Redis pool")
+    # arq's create_pool can not size the pool, its connection settings are used
+    redis_settings = RedisSettings()
+    retry = 0
+    while True:
+        try:
+            pool = await aioredis.create_pool(
+                (config.settings.stackl_redis_host,
+                 config.settings.stackl_redis_port),
+                password=config.settings.stackl_redis_password,
+                encoding='utf8',
+                minsize=config.settings.stackl_redis_pool_minsize,
+                maxsize=config.settings.stackl_redis_pool_maxsize,
+                create_connection_timeout=redis_settings.conn_timeout)
+            break
+        except (ConnectionError, OSError, aioredis.RedisError,
+                asyncio.TimeoutError) as err:
+            if retry >= redis_settings.conn_retries:
+                raise
+            retry += 1
+            logger.warning(
+                f"[StacklManager] Could not connect to Redis, retrying: {err}")
+            await asyncio.sleep(redis_settings.conn_retry_delay)
+    redis_pool_holder.pool = ArqRedis(pool)
+    return redis_pool_holder.pool
+
+
+async def close_redis_pool():
+    """Closes the connections of the shared Redis pool"""
+    redis_pool = redis_pool_holder.pool
+    if redis_pool is not None:
+        redis_pool_holder.pool = None
+        redis_pool.close()
+        await redis_pool.wait_closed()
+
+
 async def get_redis():
-    """Returns a Redis from the pool"""
-    return await create_pool(
-        RedisSettings(host=config.settings.stackl_redis_host,
-                      port=config.settings.stackl_redis_port,
-                      password=config.settings.stackl_redis_password))
+    """
+    Returns the shared Redis pool, it is created on startup or by the first
+    request that needs it
+    """
+    if redis_pool_holder.pool is None:
+        if redis_pool_holder.lock is None:
+            redis_pool_holder.lock = asyncio.Lock()
+        async with redis_pool_holder.lock:
+            if redis_pool_holder.pool is None:
+                await create_redis_pool()
+    return redis_pool_holder.pool
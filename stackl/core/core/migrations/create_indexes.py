@@ -0,0 +1,41 @@
+"""
+One-time migration which fills the per type indexes of the Redis store with
+the documents that were written before the indexes existed
+"""
+from loguru import logger
+
+from core import config
+from core.datastore.datastore_factory import DataStoreFactory
+from core.datastore.redis_store import RedisStore, get_index_key
+
+MIGRATION_KEY = "migrations/create_indexes"
+CATEGORIES = ["configs", "items", "history"]
+
+
+def create_indexes():
+    """Adds every existing document to the index of its category and type"""
+    store = DataStoreFactory().get_store()
+    if not isinstance(store, RedisStore):
+        return
+    redis = store.redis
+    if redis.get(MIGRATION_KEY):
+        logger.debug("[create_indexes] Indexes already created")
+        return
+
+    logger.info("[create_indexes] Creating indexes for existing documents")
+    batch_size = config.settings.stackl_redis_batch_size
+    pipeline = redis.pipeline(transaction=False)
+    indexed = 0
+    for category in CATEGORIES:
+        for key in redis.scan_iter(f"{category}/*", count=batch_size):
+            parts = key.decode().split('/', 2)
+            if len(parts) != 3:
+                continue
+            _, document_type, name = parts
+            pipeline.zadd(get_index_key(category, document_type), {name: 0})
+            indexed += 1
+            if indexed % batch_size == 0:
+                pipeline.execute()
+    pipeline.set(MIGRATION_KEY, 1)
+    pipeline.execute()
+    logger.info(f"[create_indexes] Indexed {indexed} documents")
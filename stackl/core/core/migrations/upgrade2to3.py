@@ -1,4 +1,3 @@
-import json
 from enum import IntEnum, unique
 from os import environ
 
@@ -6,6 +5,7 @@ import redis
 from loguru import logger
 
 from core import config
+from core.datastore.codec import Codec
 
 
 # Modeled after HTTP Status Codes
@@ -44,6 +44,7 @@ class RedisStore():
                                  port=port,
                                  password=password,
                                  db=db)
+        self.codec = Codec.from_settings()
 
     class StoreResponse:
         """
@@ -91,7 +92,7 @@ class RedisStore():
             response = self._create_store_response(
                 status_code=StatusCode.NOT_FOUND, content={})
         else:
-            content = json.loads(self.redis.get(document_key))
+            content = self.codec.decode(self.redis.get(document_key))
             response = self._create_store_response(status_code=StatusCode.OK,
                                                    content=content)
         logger.debug(f"[RedisStore] StoreResponse for get: {response}")
@@ -105,7 +106,7 @@ class RedisStore():
         )
         content = []
         for key in self.redis.scan_iter(document_key):
-            content.append(json.loads(self.redis.get(key)))
+            content.append(self.codec.decode(self.redis.get(key)))
         response = self._create_store_response(status_code=StatusCode.OK,
                                                content=content)
         logger.debug(f"[RedisStore] StoreResponse for get: {response}")
@@ -116,10 +117,10 @@ class RedisStore():
         document_key = file.get("category") + '/' + file.get(
             "type") + '/' + file["name"]
         logger.debug(f"[RedisStore] put on '{document_key}' with file {file}")
-        self.redis.set(document_key, json.dumps(file))
+        self.redis.set(document_key, self.codec.encode(file))
         response = self._create_store_response(
             status_code=StatusCode.CREATED,
-            content=json.loads(self.redis.get(document_key)))
+            content=self.codec.decode(self.redis.get(document_key)))
         logger.debug(f"[RedisStore] StoreResponse for put: {response}")
         return response
 
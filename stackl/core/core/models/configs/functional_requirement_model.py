@@ -25,3 +25,5 @@ class FunctionalRequirement(BaseDocument):
     outputs: dict = {}
     outputs_format: str = "json"
     as_group: bool = False
+    #: Seconds to wait for the result of a job, STACKL_JOB_TIMEOUT when not set
+    timeout: int = None
@@ -17,3 +17,5 @@ class PolicyTemplate(BaseModel):
     policy: str
     inputs: List[str]
     outputs: List[str] = None
+    #: Whether the policy can be evaluated in a batch of SIT policy checks
+    batch_safe: bool = True
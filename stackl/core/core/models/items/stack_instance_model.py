@@ -4,7 +4,7 @@ StackInstance model
 from core.models.configs.stack_application_template_model import StackStage
 from typing import Dict, Any, List
 
-from pydantic import BaseModel  # pylint: disable=E0611 #error in pylin
+from pydantic import BaseModel, parse_obj_as  # pylint: disable=E0611 #error in pylin
 
 from .stack_instance_service_model import StackInstanceService
 from .stack_instance_status_model import StackInstanceStatus
@@ -18,6 +18,63 @@ class HostTarget(BaseModel):
     target: str
 
 
+class LazyServices(dict):
+    """
+    Services of a stored stack instance. The definitions of a service are
+    validated the first time the service is accessed, stored stack instances
+    were validated before they were written
+    """
+    def __init__(self, services):
+        super().__init__(services)
+        self._validated = set()
+
+    def __getitem__(self, name):
+        service = super().__getitem__(name)
+        if name not in self._validated:
+            service = parse_obj_as(List[StackInstanceService], service)
+            super().__setitem__(name, service)
+            self._validated.add(name)
+        return service
+
+    def __setitem__(self, name, service):
+        super().__setitem__(name, service)
+        self._validated.add(name)
+
+    def __delitem__(self, name):
+        super().__delitem__(name)
+        self._validated.discard(name)
+
+    def get(self, name, default=None):
+        return self[name] if name in self else default
+
+    def pop(self, name, *default):
+        if name not in self:
+            return super().pop(name, *default)
+        service = self[name]
+        del self[name]
+        return service
+
+    def values(self):
+        return [self[name] for name in self]
+
+    def items(self):
+        return [(name, self[name]) for name in self]
+
+    def to_stored(self):
+        """
+        Returns the services as they are stored, the ones that were not
+        accessed are not converted
+        """
+        services = {}
+        for name, service in dict.items(self):
+            if name in self._validated:
+                service = [
+                    service_definition.dict() for service_definition in service
+                ]
+            services[name] = service
+        return services
+
+
 class StackInstance(BaseModel):
     """
     StackInstance model
@@ -36,3 +93,32 @@ class StackInstance(BaseModel):
     category = "items"
     status: List[StackInstanceStatus] = None
     stages: List[StackStage] = None
+    #: Incremented on every write, used to detect concurrent changes
+    version: int = 0
+
+    @classmethod
+    def from_stored(cls, document):
+        """
+        Creates a stack instance from a stored document, its services are
+        validated when they are accessed. The other fields holding models are
+        small and are parsed right away
+        """
+        document = {
+            **document, "services": LazyServices(document.get("services", {}))
+        }
+        for field in ("groups", "status", "stages"):
+            if document.get(field) is not None:
+                document[field] = parse_obj_as(cls.__fields__[field].outer_type_,
+                                               document[field])
+        return cls.construct(**document)
+
+    def to_stored(self):
+        """
+        Returns the document to store. The services of a stack instance
+        created with from_stored that were not accessed are stored as read
+        """
+        if not isinstance(self.services, LazyServices):
+            return self.dict()
+        document = self.dict(exclude={"services"})
+        document["services"] = self.services.to_stored()
+        return document
@@ -1,17 +1,31 @@
 """Module containing all methods for interacting with OPA"""
 
+import asyncio
+import hashlib
 import json
-from typing import List
+from typing import Dict, List
 
+import httpx
 import requests
 from loguru import logger
 
 from core import config
+from core.manager.document_cache import DocumentCache
+from core.models.configs.functional_requirement_model import \
+    FunctionalRequirement
 from core.models.configs.stack_application_template_model import \
     StackApplicationTemplate
 from core.models.configs.stack_infrastructure_template_model import \
     StackInfrastructureTemplate
 from core.models.items.service_model import Service
+from core.utils.cache import LRUCache
+
+#: Documents which change the outcome of the decisions, when one of them is
+# written all cached decisions are dropped
+DECISION_DOCUMENT_TYPES = [
+    "policy_template", "stack_application_template",
+    "stack_infrastructure_template"
+]
 
 
 def convert_sit_to_opa_data(sit_doc: StackInfrastructureTemplate):
@@ -39,12 +53,147 @@ def convert_sit_to_opa_data(sit_doc: StackInfrastructureTemplate):
     return sit_as_opa_data
 
 
+def _policy_hash(policy_data):
+    """Returns the hash used to detect changes to the content of a policy"""
+    return hashlib.sha256(policy_data.encode()).hexdigest()
+
+
+def generate_batch_policy(policy_names: List[str], policy_rule: str):
+    """
+    Generates a policy which evaluates a rule of several policies for a list
+    of checks in a single query. Every check in input.checks names a policy
+    and the input specific to that check, which is merged with the input
+    shared by all checks in input.opa_data. The results are returned as
+    [check index, result] pairs.
+    Returns the package name and the policy
+    """
+    policy_names = sorted(set(policy_names))
+    digest = hashlib.sha256(
+        json.dumps([policy_names, policy_rule]).encode()).hexdigest()[:16]
+    package = f"stackl_batch_{digest}"
+    rules = [f"package {package}"]
+    for policy_name in policy_names:
+        rules.append(f"""
+{policy_rule}[[index, result]] {{
+    check := input.checks[index]
+    check.policy == {json.dumps(policy_name)}
+    check_input := object.union(input.opa_data, check.input)
+    result := data[{json.dumps(policy_name)}].{policy_rule}[_] with input as check_input
+}}""")
+    return package, "\n".join(rules) + "\n"
+
+
+def _decision_request(policy_package, policy_rule, data):
+    """
+    Returns the body of a decision request and its key in the decision
+    cache. The input is serialised canonically so equal inputs share a key
+    """
+    body = json.dumps({"input": data}, sort_keys=True, separators=(",", ":"))
+    key = (policy_package, policy_rule,
+           hashlib.sha256(body.encode()).hexdigest())
+    return body, key
+
+
+def _decision_from_response(response):
+    """Returns the decision in an OPA response or an empty dict on errors"""
+    if response.status_code >= 300:
+        logger.debug(
+            f"Error checking policy, status: {response.status_code} message: {response.text}"
+        )
+        return {}
+    response_as_json = response.json()
+    logger.debug(f"response: {response_as_json}")
+    return response_as_json
+
+
+class OPAConnection:
+    """
+    The HTTP clients used to talk to OPA, a session for the blocking requests
+    and an async client with a pool of keep-alive connections. A semaphore
+    limits the concurrent requests of the async client
+    """
+    def __init__(self):
+        self.host = config.settings.stackl_opa_host
+        self.timeout = config.settings.stackl_opa_timeout
+        self.session = requests.Session()
+        self._client = None
+        self._client_loop = None
+        self._semaphore = None
+
+    def _get_client(self):
+        """
+        Returns the async client, it is bound to the event loop it was
+        created in
+        """
+        loop = asyncio.get_event_loop()
+        if self._client is None or self._client_loop is not loop:
+            logger.debug("[OPABroker] Creating async OPA client")
+            self._client = httpx.AsyncClient(
+                base_url=self.host,
+                timeout=httpx.Timeout(self.timeout),
+                limits=httpx.Limits(
+                    max_connections=config.settings.stackl_opa_max_connections,
+                    max_keepalive_connections=config.settings.
+                    stackl_opa_max_connections))
+            self._client_loop = loop
+            self._semaphore = asyncio.Semaphore(
+                config.settings.stackl_opa_max_concurrency)
+        return self._client
+
+    def get(self, path):
+        """Sends a GET request to OPA"""
+        return self.session.get(self.host + path, timeout=self.timeout)
+
+    def put(self, path, data):
+        """Sends a PUT request to OPA"""
+        return self.session.put(self.host + path,
+                                data=data,
+                                timeout=self.timeout)
+
+    def post(self, path, data):
+        """Sends a POST request to OPA"""
+        return self.session.post(self.host + path,
+                                 data=data,
+                                 timeout=self.timeout)
+
+    def delete(self, path):
+        """Sends a DELETE request to OPA"""
+        return self.session.delete(self.host + path, timeout=self.timeout)
+
+    async def put_async(self, path, content):
+        """Sends a PUT request to OPA without blocking the event loop"""
+        client = self._get_client()
+        async with self._semaphore:
+            return await client.put(path, content=content)
+
+    async def post_async(self, path, content):
+        """Sends a POST request to OPA without blocking the event loop"""
+        client = self._get_client()
+        async with self._semaphore:
+            return await client.post(path, content=content)
+
+    async def close(self):
+        """Closes the connections of the async client"""
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+
 class OPABroker:
     """Class responsible for all communication between Stackl and OPA"""
     def __init__(self):
-        self.opa_host = config.settings.stackl_opa_host
         self.manager_factory = None
         self.document_manager = None
+        self.connection = OPAConnection()
+        #: Future of every decision being asked, by decision cache key
+        self._pending_decisions: Dict[str, asyncio.Future] = {}
+        #: Hash of the content of every policy uploaded by this worker
+        self._uploaded_policies: Dict[str, str] = {}
+        #: Decisions are stored as JSON so callers can change their copy
+        self.decision_cache = LRUCache(
+            maxsize=config.settings.stackl_opa_decision_cache_size,
+            ttl=config.settings.stackl_opa_decision_cache_ttl)
+        DocumentCache().add_listener(self._handle_document_invalidation)
 
     def start(self, manager_factory):
         """Starts the OPA Broker"""
@@ -52,12 +201,113 @@ class OPABroker:
         self.manager_factory = manager_factory
         self.document_manager = self.manager_factory.get_document_manager()
 
+    async def close(self):
+        """Closes the connections to OPA"""
+        await self.connection.close()
+
+    def _policy_uploaded(self, policy_name, policy_data):
+        return self._uploaded_policies.get(policy_name) == _policy_hash(
+            policy_data)
+
+    def _record_upload(self, policy_name, policy_data, response):
+        logger.debug(f"Response:{response}")
+        if response.status_code >= 300:
+            logger.error(
+                f"[OPABroker] Uploading policy '{policy_name}' failed, status: "
+                f"{response.status_code} message: {response.text}")
+            self._uploaded_policies.pop(policy_name, None)
+            return False
+        self._uploaded_policies[policy_name] = _policy_hash(policy_data)
+        self.decision_cache.clear()
+        return True
+
     def add_policy(self, policy_name, policy_data):
-        """Adds a policy in OPA"""
-        response = requests.put(self.opa_host + "/v1/policies/" + policy_name,
-                                data=policy_data)
+        """Adds a policy in OPA, unless OPA already has this version"""
+        if self._policy_uploaded(policy_name, policy_data):
+            return True
+        try:
+            response = self.connection.put("/v1/policies/" + policy_name,
+                                           policy_data)
+        except requests.RequestException as err:
+            logger.error(
+                f"[OPABroker] Uploading policy '{policy_name}' failed: {err}")
+            return False
+        return self._record_upload(policy_name, policy_data, response)
+
+    async def add_policy_async(self, policy_name, policy_data):
+        """
+        Adds a policy in OPA without blocking the event loop, unless OPA
+        already has this version
+        """
+        if self._policy_uploaded(policy_name, policy_data):
+            return True
+        try:
+            response = await self.connection.put_async(
+                "/v1/policies/" + policy_name, policy_data)
+        except httpx.HTTPError as err:
+            logger.error(
+                f"[OPABroker] Uploading policy '{policy_name}' failed: {err}")
+            return False
+        return self._record_upload(policy_name, policy_data, response)
+
+    async def ask_opa_batch_decision_async(self, policy_names, policy_rule,
+                                           opa_data, checks):
+        """
+        Evaluates a rule of several policies for a list of checks with a
+        single query. opa_data is the input shared by all checks, every check
+        is a dict with the name of the policy and the input of the check.
+        Returns a list with the results of every check, or None when OPA did
+        not return a decision
+        """
+        package, policy = generate_batch_policy(policy_names, policy_rule)
+        await self.add_policy_async(package, policy)
+        decision = await self.ask_opa_policy_decision_async(
+            package, policy_rule, {
+                "opa_data": opa_data,
+                "checks": checks
+            })
+        if "result" not in decision:
+            logger.error(
+                f"[OPABroker] No decision for the batch of {len(checks)} checks of '{package}'"
+            )
+            return None
+        results = [[] for _ in checks]
+        for index, result in decision["result"]:
+            results[index].append(result)
+        return results
+
+    def delete_policy(self, policy_name):
+        """Removes a policy from OPA"""
+        self._uploaded_policies.pop(policy_name, None)
+        self.decision_cache.clear()
+        try:
+            response = self.connection.delete("/v1/policies/" + policy_name)
+        except requests.RequestException as err:
+            logger.error(
+                f"[OPABroker] Deleting policy '{policy_name}' failed: {err}")
+            return
         logger.debug(f"Response:{response}")
 
+    def sync_policies(self, policy_templates):
+        """
+        Uploads the policy templates which are missing or outdated in OPA.
+        Policies which OPA loaded from elsewhere are left alone
+        """
+        opa_policies = {
+            policy["id"]: policy.get("raw", "")
+            for policy in self.get_opa_policies().get("result", [])
+        }
+        uploaded = 0
+        for policy_template in policy_templates:
+            name, policy = policy_template.name, policy_template.policy
+            if opa_policies.get(name) == policy:
+                self._uploaded_policies[name] = _policy_hash(policy)
+            elif self.add_policy(name, policy):
+                uploaded += 1
+        logger.info(
+            f"[OPABroker] Synced {len(policy_templates)} policy templates, uploaded {uploaded}"
+        )
+
     def ask_opa_policy_decision(self,
                                 policy_package="default",
                                 policy_rule="default",
@@ -67,27 +317,86 @@ class OPABroker:
             f"For policy_package '{policy_package}' and policy_rule '{policy_rule}' \
             and data '{json.dumps(data)}'")
         # create input to hand to OPA
-        input_dict = {"input": data}
+        body, key = _decision_request(policy_package, policy_rule, data)
+        cached_decision = self.decision_cache.get(key)
+        if cached_decision is not None:
+            return json.loads(cached_decision)
+        generation = self.decision_cache.generation
         try:
-            response = requests.post(self.opa_host + "/v1/data/" +
-                                     policy_package + "/" + policy_rule,
-                                     data=json.dumps(input_dict))
+            response = self.connection.post(
+                "/v1/data/" + policy_package + "/" + policy_rule, body)
         except Exception as err:  # pylint: disable=broad-except
             logger.debug(f"[OPABroker] ask_opa_policy_decision. error '{err}'")
             return {}
-        if response.status_code >= 300:
+        return self._handle_decision(policy_package, key, generation,
+                                     _decision_from_response(response))
+
+    async def ask_opa_policy_decision_async(self,
+                                            policy_package="default",
+                                            policy_rule="default",
+                                            data=None):
+        """
+        Asks for a policy evaluation and returns result without blocking the
+        event loop
+        """
+        logger.debug(
+            f"For policy_package '{policy_package}' and policy_rule '{policy_rule}' \
+            and data '{json.dumps(data)}'")
+        body, key = _decision_request(policy_package, policy_rule, data)
+        cached_decision = self.decision_cache.get(key)
+        if cached_decision is not None:
+            return json.loads(cached_decision)
+        loop = asyncio.get_event_loop()
+        pending = self._pending_decisions.get(key)
+        if pending is not None and pending.get_loop() is loop:
+            # The same decision is being asked already, for instance by stack
+            # instances created together, so its answer is shared
+            return json.loads(await asyncio.shield(pending))
+        pending = loop.create_future()
+        self._pending_decisions[key] = pending
+        decision = {}
+        try:
+            decision = await self._request_decision(policy_package,
+                                                    policy_rule, body, key)
+            return decision
+        finally:
+            if self._pending_decisions.get(key) is pending:
+                del self._pending_decisions[key]
+            pending.set_result(json.dumps(decision))
+
+    async def _request_decision(self, policy_package, policy_rule, body, key):
+        generation = self.decision_cache.generation
+        try:
+            response = await self.connection.post_async(
+                "/v1/data/" + policy_package + "/" + policy_rule, body)
+        except Exception as err:  # pylint: disable=broad-except
             logger.debug(
-                f"Error checking policy, status: {response.status_code} message: {response.text}"
-            )
+                f"[OPABroker] ask_opa_policy_decision_async. error '{err}'")
             return {}
-        response_as_json = response.json()
-        logger.debug(f"response: {response_as_json}")
-        return response_as_json
+        return self._handle_decision(policy_package, key, generation,
+                                     _decision_from_response(response))
+
+    def _handle_decision(self, policy_package, key, generation, decision):
+        if "result" not in decision:
+            # OPA could have been restarted and lost the policy, upload it
+            # again on the next request
+            self._uploaded_policies.pop(policy_package, None)
+            return decision
+        # Not cached when a policy or template changed during the request
+        self.decision_cache.set(key, json.dumps(decision), generation=generation)
+        return decision
+
+    def _handle_document_invalidation(self, document_type, name):
+        if document_type in DECISION_DOCUMENT_TYPES:
+            logger.debug(
+                f"[OPABroker] '{document_type}' '{name}' changed, dropping cached decisions"
+            )
+            self.decision_cache.clear()
 
     def get_opa_policies(self):
         """Return all policies available in OPA"""
         logger.debug("[OPABroker] get_opa_policies.")
-        response = requests.get(self.opa_host + "/v1/policies")
+        response = self.connection.get("/v1/policies")
         result = response.json()
         logger.debug(f"[OPABroker] get_opa_policies. Result: {result}")
         return result
@@ -96,7 +405,7 @@ class OPABroker:
         """Returns a specific policy from OPA by ID"""
         logger.debug(
             f"[OPABroker] get_opa_policy. For policy_id '{policy_id}'")
-        response = requests.get(self.opa_host + "/v1/policies/" + policy_id)
+        response = self.connection.get("/v1/policies/" + policy_id)
         result = response.json()
         logger.debug(f"[OPABroker] get_opa_policy. Result: {result}")
         return result
@@ -104,14 +413,21 @@ class OPABroker:
     def get_opa_data(self, data_path="default"):
         """Retrieve data from OPA"""
         logger.debug("[OPABroker] get_opa_data. For path '{data_path}'")
-        response = requests.get(self.opa_host + "/v1/data/" + data_path)
+        response = self.connection.get("/v1/data/" + data_path)
         result = response.json()
         logger.debug(f"[OPABroker] get_opa_data. Result: {result}")
         return result
 
-    def convert_sat_to_opa_data(self, sat_doc: StackApplicationTemplate,
-                                services: List[Service]):
-        """Converts SAT to data for OPA policy evaluation"""
+    def convert_sat_to_opa_data(self,
+                                sat_doc: StackApplicationTemplate,
+                                services: List[Service],
+                                functional_requirements: Dict[
+                                    str, FunctionalRequirement] = None):
+        """
+        Converts SAT to data for OPA policy evaluation. Functional requirements
+        which are not given are read from the store
+        """
+        functional_requirements = functional_requirements or {}
         logger.debug(
             f"[OPABroker] convert_sat_to_opa_data. For sat_doc '{sat_doc}'")
         services_as_data = {}
@@ -120,7 +436,10 @@ class OPABroker:
             frs = {}
             params = service['service'].params
             for fr in service['service'].functional_requirements:
-                fr_doc = self.document_manager.get_functional_requirement(fr)
+                fr_doc = functional_requirements.get(fr)
+                if fr_doc is None:
+                    fr_doc = self.document_manager.get_functional_requirement(
+                        fr)
                 frs[fr] = {
                     key: value.dict()
                     for (key, value) in fr_doc.invocation.items()
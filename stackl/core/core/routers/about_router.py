@@ -2,8 +2,11 @@
 Endpoint for retrieving metadata from Stackl
 """
 
-from fastapi import APIRouter
+from fastapi import APIRouter, Depends
 
+from core.manager.document_cache import DocumentCache
+from core.manager.stackl_manager import get_opa_broker
+from core.opa_broker.opa_broker import OPABroker
 from core.utils.general_utils import get_hostname as utils_hostname
 
 router = APIRouter()
@@ -13,3 +16,12 @@ router = APIRouter()
 def get_hostname():
     """Returns hostname of the REST API instance"""
     return utils_hostname()
+
+
+@router.get('/cache')
+def get_cache_stats(opa_broker: OPABroker = Depends(get_opa_broker)):
+    """Returns the size and hit counters of the caches of this instance"""
+    return {
+        "documents": DocumentCache().cache.stats(),
+        "opa_decisions": opa_broker.decision_cache.stats()
+    }
@@ -3,11 +3,11 @@ Endpoint used mainly by the automation handler for adding extra key-value pairs
 to an instance
 """
 
-from fastapi import APIRouter, Depends
+from fastapi import APIRouter, Depends, HTTPException
+from fastapi.responses import JSONResponse
 
-from core.manager.document_manager import DocumentManager
 from core.manager.stack_manager import StackManager, OutputsUpdate
-from core.manager.stackl_manager import get_document_manager, get_stack_manager
+from core.manager.stackl_manager import get_stack_manager
 from core.models.items.stack_instance_model import StackInstance
 
 router = APIRouter()
@@ -16,12 +16,14 @@ router = APIRouter()
 @router.post('', response_model=StackInstance)
 def add_outputs(
         outputs_update: OutputsUpdate,
-        document_manager: DocumentManager = Depends(get_document_manager),
         stack_manager: StackManager = Depends(get_stack_manager)):
     """
     Function used to add outputs to a stack instance
     Returns the updated stack_instance
     """
     stack_instance = stack_manager.add_outputs(outputs_update)
-    document_manager.write_stack_instance(stack_instance)
-    return stack_instance
+    if stack_instance is None:
+        raise HTTPException(status_code=409,
+                            detail="Outputs could not be added")
+    # Only the service with the outputs was validated
+    return JSONResponse(stack_instance.to_stored())
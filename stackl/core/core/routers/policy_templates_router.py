@@ -8,8 +8,9 @@ from fastapi import APIRouter, Depends, HTTPException
 from loguru import logger
 
 from core.manager.document_manager import DocumentManager
-from core.manager.stackl_manager import get_document_manager
+from core.manager.stackl_manager import get_document_manager, get_opa_broker
 from core.models.configs.policy_template_model import PolicyTemplate
+from core.opa_broker.opa_broker import OPABroker
 
 router = APIRouter()
 
@@ -43,22 +44,26 @@ def get_policy_template_by_name(
 @router.put('', response_model=PolicyTemplate)
 def put_policy_template(
         policy: PolicyTemplate,
-        document_manager: DocumentManager = Depends(get_document_manager)):
+        document_manager: DocumentManager = Depends(get_document_manager),
+        opa_broker: OPABroker = Depends(get_opa_broker)):
     """
-    Updates a policy template
+    Updates a policy template and uploads it to OPA
     """
     logger.info(
         f"[PutDocument] API PUT request with policy_template: {policy}")
     policy_template = document_manager.write_policy_template(policy)
+    opa_broker.add_policy(policy_template.name, policy_template.policy)
     return policy_template
 
 
 @router.delete('/{name}', status_code=200)
 def delete_policy_template(
         name: str,
-        document_manager: DocumentManager = Depends(get_document_manager)):
+        document_manager: DocumentManager = Depends(get_document_manager),
+        opa_broker: OPABroker = Depends(get_opa_broker)):
     """
     Deletes a policy template by name
     """
     document_manager.delete_policy_template(name)
+    opa_broker.delete_policy(name)
     return {"result": "deleted policy template"}
@@ -6,12 +6,10 @@ from typing import List
 
 from fastapi import APIRouter, Depends, HTTPException
 from loguru import logger
-from starlette.background import BackgroundTasks
 
-from core.agent_broker.agent_task_broker import create_job_for_agent
-from core.manager.document_manager import DocumentManager
+from core.agent_broker.orchestrator import orchestrator
 from core.manager.snapshot_manager import SnapshotManager
-from core.manager.stackl_manager import get_snapshot_manager, get_redis, get_document_manager
+from core.manager.stackl_manager import get_snapshot_manager, get_redis
 from core.models.history.snapshot_model import Snapshot
 from core.models.items.stack_instance_model import StackInstance
 
@@ -47,10 +45,8 @@ def get_snapshots(
 
 
 @router.post('/restore/{name}')
-def restore_snapshot(
+async def restore_snapshot(
         name: str,
-        background_tasks: BackgroundTasks,
-        document_manager: DocumentManager = Depends(get_document_manager),
         snapshot_manager: SnapshotManager = Depends(get_snapshot_manager),
         redis=Depends(get_redis)):
     """
@@ -64,8 +60,7 @@ def restore_snapshot(
 
     if snapshot_document['snapshot']["type"] == "stack_instance":
         stack_instance = StackInstance.parse_obj(snapshot_document["snapshot"])
-        background_tasks.add_task(create_job_for_agent, stack_instance,
-                                  "update", document_manager, redis)
+        await orchestrator.submit(redis, stack_instance, "update")
         return {"result": "stack instance restored, restoring in progress"}
 
     return {"result": f"snapshot {name} restored"}
@@ -2,15 +2,18 @@
 Endpoint used for creating, updating, reading and deleting stack instances
 """
 
-from typing import Any, Dict, List
+import asyncio
+import json
+from typing import Any, Dict, List, Optional
 
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, Depends, HTTPException, Query, Request
+from fastapi.responses import JSONResponse, StreamingResponse
 from loguru import logger
-from pydantic import BaseModel
-from starlette.background import BackgroundTasks
+from pydantic import BaseModel, create_model
 
-from core.agent_broker.agent_task_broker import (create_job_for_agent,
-                                                 create_job_per_service)
+from core import config
+from core.agent_broker.orchestrator import orchestrator
+from core.enums.stackl_codes import StatusCode
 from core.handler.stack_handler import delete_services
 from core.manager.document_manager import DocumentManager
 from core.manager.stack_manager import StackManager
@@ -23,12 +26,43 @@ from core.opa_broker.opa_broker_factory import OPABrokerFactory
 
 router = APIRouter()
 
+#: Header with the cursor of the next page of a listing
+NEXT_CURSOR_HEADER = "X-Next-Cursor"
+
 
 class StackCreateResult(BaseModel):
     """StackCreateResult Model"""
     result: str
 
 
+class StackBulkCreateResult(BaseModel):
+    """Result of creating one of the stack instances of a bulk request"""
+    stack_instance_name: str
+    created: bool
+    result: Any = None
+
+
+#: A listed stack instance, with fields it only has those fields and its name
+StackInstanceFields = create_model(
+    "StackInstanceFields",
+    name=(str, ...),
+    **{
+        field.name: (Optional[field.outer_type_], None)
+        for field in StackInstance.__fields__.values() if field.name != "name"
+    })
+
+
+def _to_response(document):
+    """
+    Returns the fields of the StackInstance model of a stored document, the
+    stored documents were validated when they were written
+    """
+    return {
+        field: document[field]
+        for field in StackInstance.__fields__ if field in document
+    }
+
+
 @router.get('/{name}', response_model=StackInstance)
 def get_stack_instance(
     name: str,
@@ -37,48 +71,137 @@ def get_stack_instance(
     logger.info(
         f"[StackInstancesName GET] Getting document for stack instance '{name}'"
     )
-    stack_instance = document_manager.get_stack_instance(name)
+    stack_instance = document_manager.get_stack_instance_document(name)
     if not stack_instance:
         raise HTTPException(status_code=404, detail="Stack instance not found")
-    return stack_instance
+    return JSONResponse(_to_response(stack_instance))
+
 
+def _json_array(stack_instances):
+    """Yields the JSON array of the stack instances a stack instance at a time"""
+    yield "["
+    for position, stack_instance in enumerate(stack_instances):
+        yield ("," if position else "") + json.dumps(
+            _to_response(stack_instance))
+    yield "]"
 
-@router.get('', response_model=List[StackInstance])
+
+@router.get('',
+            response_model=List[StackInstanceFields],
+            responses={200: {
+                "content": {
+                    "application/x-ndjson": {}
+                }
+            }})
 def get_stack_instances(
+    request: Request,
     name: str = "",
+    fields: str = None,
+    after: str = "",
+    limit: int = Query(None, gt=0),
     document_manager: DocumentManager = Depends(get_document_manager)):
-    """Returns all stack instances that contain optional name"""
+    """
+    Returns all stack instances that contain optional name, sorted by name.
+    fields is a comma separated list of the fields to return. With limit
+    only a page is returned, the X-Next-Cursor header holds the value of
+    after for the next page. The stack instances are streamed as a JSON
+    array, or one per line when application/x-ndjson is accepted
+    """
     logger.info(
         f"[StackInstancesAll GET] Returning all stack instances that contain optional name '{name}'"
     )
-    stack_instances = document_manager.get_stack_instances()
-    return stack_instances
+    if fields is not None:
+        fields = [field.strip() for field in fields.split(",")]
+    stack_instances = document_manager.iter_stack_instances(
+        name, after, limit, fields)
+    headers = {}
+    if limit is not None:
+        stack_instances = list(stack_instances)
+        if len(stack_instances) == limit:
+            headers[NEXT_CURSOR_HEADER] = stack_instances[-1]["name"]
+    if "application/x-ndjson" in request.headers.get("accept", ""):
+        return StreamingResponse(
+            (json.dumps(_to_response(stack_instance)) + "\n"
+             for stack_instance in stack_instances),
+            media_type="application/x-ndjson",
+            headers=headers)
+    return StreamingResponse(_json_array(stack_instances),
+                             media_type="application/json",
+                             headers=headers)
 
 
 @router.post('')
 async def post_stack_instance(
-    background_tasks: BackgroundTasks,
     stack_instance_invocation: StackInstanceInvocation,
     document_manager: DocumentManager = Depends(get_document_manager),
     stack_manager: StackManager = Depends(get_stack_manager),
     redis=Depends(get_redis)):
     """Creates a stack instance with a specific name"""
     logger.info("[StackInstances POST] Received POST request")
-    (stack_instance, return_result) = stack_manager.process_stack_request(
+    (stack_instance, return_result) = await stack_manager.process_stack_request(
         stack_instance_invocation, "create")
     if stack_instance is None:
         return HTTPException(422, return_result)
 
-    document_manager.write_stack_instance(stack_instance)
+    status_code = document_manager.write_stack_instance(stack_instance,
+                                                        expected_version=0)
+    if status_code == StatusCode.CONFLICT:
+        raise HTTPException(
+            status_code=409,
+            detail=f"Stack instance '{stack_instance.name}' already exists")
     # Perform invocations
-    background_tasks.add_task(create_job_for_agent, stack_instance, "create",
-                              redis)
+    await orchestrator.submit(redis, stack_instance, "create")
     return return_result
 
 
+@router.post('/bulk', response_model=List[StackBulkCreateResult])
+async def post_stack_instances(
+    stack_instance_invocations: List[StackInstanceInvocation],
+    document_manager: DocumentManager = Depends(get_document_manager),
+    stack_manager: StackManager = Depends(get_stack_manager),
+    redis=Depends(get_redis)):
+    """
+    Creates several stack instances at once, the stack instances with the same
+    templates are processed together. Returns the result of every stack
+    instance, one that failed does not stop the others
+    """
+    logger.info(
+        f"[StackInstances POST bulk] Received POST request for "
+        f"{len(stack_instance_invocations)} stack instances")
+    results = await stack_manager.process_stack_requests(
+        stack_instance_invocations)
+    stack_instances = [
+        stack_instance for stack_instance, _ in results
+        if stack_instance is not None
+    ]
+    status_codes = iter(
+        document_manager.write_stack_instances(stack_instances))
+    bulk_results = []
+    created = []
+    for invocation, (stack_instance, return_result) in zip(
+            stack_instance_invocations, results):
+        if stack_instance is not None and next(
+                status_codes) == StatusCode.CONFLICT:
+            stack_instance = None
+            return_result = (f"Stack instance "
+                             f"'{invocation.stack_instance_name}' already exists")
+        if stack_instance is not None:
+            created.append(stack_instance)
+        bulk_results.append(
+            StackBulkCreateResult(
+                stack_instance_name=invocation.stack_instance_name,
+                created=stack_instance is not None,
+                result=return_result))
+    # Perform invocations
+    await asyncio.gather(*[
+        orchestrator.submit(redis, stack_instance, "create")
+        for stack_instance in created
+    ])
+    return bulk_results
+
+
 @router.put('')
 async def put_stack_instance(
-    background_tasks: BackgroundTasks,
     stack_instance_update: StackInstanceUpdate,
     document_manager: DocumentManager = Depends(get_document_manager),
     stack_manager: StackManager = Depends(get_stack_manager),
@@ -87,47 +210,57 @@ async def put_stack_instance(
     Updates a stack instance by using a StackInstanceUpdate object
     """
     logger.info("[StackInstances PUT] Received PUT request")
-    to_be_deleted = stack_manager.check_delete_services(stack_instance_update)
-    (stack_instance, return_result) = stack_manager.process_stack_request(
-        stack_instance_update, "update")
-    if stack_instance is None:
-        return HTTPException(422, return_result)
+    # The update is processed again when the stack instance was written while
+    # it was being processed
+    for _ in range(config.settings.stackl_write_retries):
+        to_be_deleted = stack_manager.check_delete_services(
+            stack_instance_update)
+        (stack_instance,
+         return_result) = await stack_manager.process_stack_request(
+             stack_instance_update, "update")
+        if stack_instance is None:
+            return HTTPException(422, return_result)
+        status_code = document_manager.write_stack_instance(
+            stack_instance, expected_version=stack_instance.version)
+        if status_code != StatusCode.CONFLICT:
+            break
+    else:
+        raise HTTPException(
+            status_code=409,
+            detail=f"Stack instance '{stack_instance.name}' kept changing")
 
     # Perform invocations
     if not stack_instance_update.disable_invocation:
-        for service in to_be_deleted:
-            background_tasks.add_task(create_job_per_service, service,
-                                      document_manager, "delete", redis,
-                                      stack_instance, to_be_deleted)
+        if to_be_deleted:
+            await orchestrator.submit(
+                redis,
+                stack_instance,
+                "delete",
+                services=[name for service in to_be_deleted for name in service],
+                remove_services=True)
         copy_stack_instance = stack_instance.copy(deep=True)
         delete_services(to_be_deleted, copy_stack_instance)
-        background_tasks.add_task(create_job_for_agent, copy_stack_instance,
-                                  "update", redis)
-
-    document_manager.write_stack_instance(stack_instance)
+        await orchestrator.submit(redis, copy_stack_instance, "update")
 
     return return_result
 
 
 @router.delete('/{name}')
-def delete_stack_instance(
+async def delete_stack_instance(
     name: str,
-    background_tasks: BackgroundTasks,
     force: bool = False,
     document_manager: DocumentManager = Depends(get_document_manager),
     redis=Depends(get_redis)):
     """Delete a stack instance with a specific name"""
-    stack_instance = document_manager.get_stack_instance(name)
+    stack_instance = document_manager.get_stack_instance(name, lazy=True)
     if stack_instance is None:
         return {
             "result":
             f"Stack instance {name} can't be delete because it does not exist"
         }
     else:
-        background_tasks.add_task(create_job_for_agent,
+        await orchestrator.submit(redis,
                                   stack_instance,
                                   "delete",
-                                  document_manager,
-                                  redis,
                                   force_delete=force)
         return {"result": f"Stack instance {name} is being deleted"}
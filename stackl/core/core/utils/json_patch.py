@@ -0,0 +1,73 @@
+"""
+Module for JSON patches (RFC 6902) between documents
+
+Only the add, remove and replace operations are made and applied. Objects
+are compared key by key, other values that differ, lists included, are
+replaced as a whole.
+"""
+import copy
+
+
+def _escape(key):
+    return str(key).replace("~", "~0").replace("/", "~1")
+
+
+def _unescape(token):
+    return token.replace("~1", "/").replace("~0", "~")
+
+
+def make_patch(source, target, path=""):
+    """Returns the operations that turn the source into the target"""
+    if isinstance(source, dict) and isinstance(target, dict):
+        operations = []
+        for key, value in source.items():
+            key_path = f"{path}/{_escape(key)}"
+            if key not in target:
+                operations.append({"op": "remove", "path": key_path})
+            else:
+                operations.extend(make_patch(value, target[key], key_path))
+        for key, value in target.items():
+            if key not in source:
+                operations.append({
+                    "op": "add",
+                    "path": f"{path}/{_escape(key)}",
+                    "value": copy.deepcopy(value)
+                })
+        return operations
+    # 1 == True in Python, but not in JSON
+    if source == target and type(source) is type(target):
+        return []
+    return [{"op": "replace", "path": path, "value": copy.deepcopy(target)}]
+
+
+def apply_patch(document, operations):
+    """Returns a copy of the document with the operations applied"""
+    document = copy.deepcopy(document)
+    for operation in operations:
+        value = copy.deepcopy(operation.get("value"))
+        if operation["path"] == "":
+            if operation["op"] == "remove":
+                raise ValueError("Cannot remove the whole document")
+            document = value
+            continue
+        tokens = [
+            _unescape(token) for token in operation["path"].split("/")[1:]
+        ]
+        parent = document
+        for token in tokens[:-1]:
+            parent = parent[int(token) if isinstance(parent, list) else token]
+        key = tokens[-1]
+        if isinstance(parent, list):
+            if operation["op"] == "add":
+                parent.insert(len(parent) if key == "-" else int(key), value)
+            elif operation["op"] == "remove":
+                del parent[int(key)]
+            else:
+                parent[int(key)] = value
+        elif operation["op"] == "remove":
+            del parent[key]
+        elif operation["op"] == "replace" and key not in parent:
+            raise ValueError(f"Cannot replace missing '{operation['path']}'")
+        else:
+            parent[key] = value
+    return document
@@ -0,0 +1,159 @@
+import asyncio
+from types import SimpleNamespace
+
+from core import config
+from core.agent_broker import agent_task_broker
+
+invocation = {
+    "aws":
+    SimpleNamespace(image="image",
+                    before_command=None,
+                    tool="terraform",
+                    playbook_path=None,
+                    serial=None)
+}
+
+
+class FakeRedis:
+    def __init__(self):
+        self.running = 0
+        self.max_running = 0
+        self.finished = []
+        self.enqueued = []
+        self.invocations = []
+
+    async def enqueue_job(self, function, invoc, _job_id, _queue_name):
+        if _job_id in self.enqueued:
+            return None
+        self.enqueued.append(_job_id)
+        self.invocations.append(invoc)
+        asyncio.ensure_future(self.run(_job_id, invoc))
+        return _job_id
+
+    async def run(self, job_id, invoc):
+        self.running += 1
+        self.max_running = max(self.max_running, self.running)
+        await asyncio.sleep(0.01)
+        self.running -= 1
+        self.finished.append((invoc["service"], invoc["functional_requirement"]))
+        agent_task_broker.job_results._dispatch(  # pylint: disable=protected-access
+            job_id, {
+                **invoc, "status":
+                "FAILED" if invoc["service"] == "bad" else "READY"
+            })
+
+
+def _services(names):
+    return {
+        name: [
+            SimpleNamespace(infrastructure_target="target",
+                            cloud_provider="aws",
+                            hosts=None,
+                            agent="agent")
+        ]
+        for name in names
+    }
+
+
+class FakeProgress:
+    def __init__(self, results):
+        self.job_ids = {}
+        self.results = results
+
+    async def get_job_id(self, job_key):
+        return self.job_ids.get(job_key)
+
+    async def set_job_id(self, job_key, job_id):
+        self.job_ids[job_key] = job_id
+
+    async def get_result(self, job_key):
+        return self.results.get(job_key)
+
+    async def set_result(self, job_key, status):
+        self.results[job_key] = status
+
+
+def _run(monkeypatch, services, stages=None, progress=None, timeouts=None):
+    timeouts = timeouts or {}
+    document_manager = SimpleNamespace(
+        get_service=lambda name: SimpleNamespace(
+            functional_requirements=["fr1", "fr2"]),
+        get_functional_requirement=lambda name: SimpleNamespace(
+            name=name,
+            invocation=invocation,
+            as_group=False,
+            timeout=timeouts.get(name)))
+
+    async def update_status(*args, **kwargs):
+        pass
+
+    async def start():
+        pass
+
+    monkeypatch.setattr(agent_task_broker, "get_document_manager",
+                        lambda: document_manager)
+    monkeypatch.setattr(agent_task_broker, "update_status", update_status)
+    monkeypatch.setattr(agent_task_broker.job_results, "start", start)
+    monkeypatch.setattr(config.settings, "stackl_max_concurrent_jobs", 3)
+    redis = FakeRedis()
+    stack_instance = SimpleNamespace(name="instance", stages=stages)
+    success = asyncio.run(
+        agent_task_broker.create_job_per_service(services,
+                                                 "create",
+                                                 redis,
+                                                 stack_instance,
+                                                 progress=progress))
+    return success, redis
+
+
+def test_services_run_concurrently_with_ordered_functional_requirements(
+        monkeypatch):
+    names = [f"service{i}" for i in range(6)]
+    success, redis = _run(monkeypatch, _services(names))
+    assert success
+    assert redis.max_running == 3
+    for name in names:
+        assert redis.finished.index((name, "fr1")) < redis.finished.index(
+            (name, "fr2"))
+
+
+def test_failed_stage_stops_next_stages(monkeypatch):
+    stages = [
+        SimpleNamespace(services=["bad", "first"]),
+        SimpleNamespace(services=["second"])
+    ]
+    success, redis = _run(monkeypatch,
+                          _services(["bad", "first", "second"]), stages)
+    assert not success
+    assert ("second", "fr1") not in redis.finished
+
+
+def test_finished_functional_requirements_are_skipped_when_resuming(
+        monkeypatch):
+    progress = FakeProgress({"service0/fr1/target": "READY"})
+    success, redis = _run(monkeypatch, _services(["service0", "service1"]),
+                          progress=progress)
+    assert success
+    assert ("service0", "fr1") not in redis.finished
+    assert len(redis.finished) == 3
+    assert set(progress.results.values()) == {"READY"}
+    assert len(progress.results) == 4
+
+
+def test_the_timeout_of_a_functional_requirement_is_used_for_its_jobs(
+        monkeypatch):
+    waited = []
+    wait = agent_task_broker.job_results.wait
+
+    async def wait_for_result(job_id, timeout, *args, **kwargs):
+        waited.append(timeout)
+        return await wait(job_id, timeout, *args, **kwargs)
+
+    monkeypatch.setattr(agent_task_broker.job_results, "wait", wait_for_result)
+    monkeypatch.setattr(config.settings, "stackl_job_timeout", 7200)
+    success, redis = _run(monkeypatch,
+                          _services(["service0"]),
+                          timeouts={"fr2": 600})
+    assert success
+    assert [invoc["timeout"] for invoc in redis.invocations] == [7200, 600]
+    assert waited == [7200, 600]
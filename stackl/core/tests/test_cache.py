@@ -0,0 +1,46 @@
+import threading
+import time
+
+from core import config
+from core.manager.document_cache import DocumentCache
+from core.utils.cache import LRUCache
+
+
+def test_cache_evicts_least_recently_used():
+    cache = LRUCache(maxsize=2, ttl=60)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    cache.get("a")
+    cache.set("c", 3)
+    assert cache.get("a") == 1
+    assert cache.get("b") is None
+    assert cache.get("c") == 3
+
+
+def test_cache_expires_entries():
+    cache = LRUCache(maxsize=2, ttl=0.01)
+    cache.set("a", 1)
+    time.sleep(0.02)
+    assert cache.get("a") is None
+
+
+def test_cache_ignores_values_read_before_invalidation():
+    cache = LRUCache()
+    generation = cache.generation
+    cache.invalidate("a")
+    cache.set("a", "stale", generation=generation)
+    assert cache.get("a") is None
+
+
+def test_disabled_cache_still_invalidates_listeners_of_other_workers(
+        monkeypatch):
+    monkeypatch.setattr(config.settings, "stackl_cache_enabled", False)
+    # A DocumentCache apart from the singleton of this process
+    other_worker = type.__call__(DocumentCache)
+    invalidated = threading.Event()
+    other_worker.add_listener(
+        lambda document_type, name: invalidated.set())
+    monkeypatch.setattr(DocumentCache(), "enabled", False)
+    DocumentCache().invalidate("policy_template", "policy")
+    assert invalidated.wait(timeout=5)
+    other_worker._subscriber.stop()  # pylint: disable=protected-access
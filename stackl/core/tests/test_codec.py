@@ -0,0 +1,64 @@
+import json
+
+import pytest
+
+from core.datastore.codec import MAGIC, Codec
+from core.datastore.local_file_system_store import LocalFileSystemStore
+
+DOCUMENT = {
+    "name": "instance",
+    "type": "stack_instance",
+    "category": "items",
+    "services": {
+        "service": [{
+            "infrastructure_target": "env.location.zone",
+            "provisioning_parameters": {f"key_{i}": "value" for i in range(50)}
+        }]
+    }
+}
+
+
+def test_plain_json_is_written_without_header():
+    value = Codec().encode(DOCUMENT)
+    assert json.loads(value) == DOCUMENT
+    assert Codec("json", "zlib", 1000000).encode(DOCUMENT) == value
+
+
+def test_large_documents_are_compressed():
+    codec = Codec("json", "zlib", compression_min_size=100)
+    value = codec.encode(DOCUMENT)
+    assert value.startswith(MAGIC)
+    assert len(value) < len(json.dumps(DOCUMENT))
+    assert codec.decode(value) == DOCUMENT
+
+
+def test_values_of_every_codec_are_read():
+    values = [json.dumps(DOCUMENT), json.dumps(DOCUMENT).encode()]
+    values.append(Codec("json", "zlib", 0).encode(DOCUMENT))
+    try:
+        values.append(Codec("msgpack", "", 0).encode(DOCUMENT))
+    except ValueError:
+        pass
+    for value in values:
+        assert Codec.decode(value) == DOCUMENT
+
+
+def test_unknown_codecs_are_refused():
+    with pytest.raises(ValueError):
+        Codec("yaml")
+    with pytest.raises(ValueError):
+        Codec("json", "brotli")
+
+
+def test_local_file_system_store_reads_pretty_printed_documents(tmp_path):
+    (tmp_path / "items").mkdir()
+    with open(tmp_path / "items" / "stack_instance_instance.json",
+              "w") as document_file:
+        json.dump(DOCUMENT, document_file, indent=4, sort_keys=True)
+    store = LocalFileSystemStore(str(tmp_path),
+                                 Codec("json", "zlib", compression_min_size=0))
+    assert store.get(category="items", type="stack_instance",
+                     name="instance").content == DOCUMENT
+    store.put(DOCUMENT)
+    assert store.get(category="items", type="stack_instance",
+                     name="instance").content == DOCUMENT
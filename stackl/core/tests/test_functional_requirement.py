@@ -21,34 +21,44 @@ functional_requirement = {
             'before_command': None,
             'tool': 'test',
             'image': 'test',
+            'playbook_path': None,
+            'serial': None
         },
         'aws': {
             'description': 'test',
             'before_command': None,
             'tool': 'test',
             'image': 'test',
+            'playbook_path': None,
+            'serial': None
         }
     },
     'as_group': False,
     'outputs': {},
-    'outputs_format': "json"
+    'outputs_format': "json",
+    'timeout': None
 }
 
 functional_requirement_update = functional_requirement.copy()
 functional_requirement_update['secrets'] = {"update": "update"}
 functional_requirement_update['params'] = {"update": "update"}
+functional_requirement_update['timeout'] = 600
 functional_requirement_update['invocation'] = {
     "generic": {
         "description": "update",
         "before_command": None,
         "image": "update",
-        "tool": "update"
+        "tool": "update",
+        "playbook_path": None,
+        "serial": None
     },
     "aws": {
         "description": "update",
         "before_command": None,
         "image": "update",
-        "tool": "update"
+        "tool": "update",
+        "playbook_path": None,
+        "serial": None
     }
 }
 
@@ -79,6 +89,17 @@ def test_update_functional_requirement():
     assert response.json() == functional_requirement_update
 
 
+def test_update_functional_requirement_expect_422_for_invalid_timeout():
+    response = client.put("functional_requirements",
+                          json={
+                              **functional_requirement_update, "timeout":
+                              "later"
+                          })
+    assert response.status_code == 422
+    response = client.get("functional_requirements/test")
+    assert response.json()["timeout"] == 600
+
+
 def test_delete_functional_requirement():
     response = client.delete("functional_requirements/test")
     assert response.status_code == 200
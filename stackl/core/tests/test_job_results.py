@@ -0,0 +1,39 @@
+import asyncio
+import json
+
+import redis
+
+from core import config
+from core.agent_broker.job_results import JobResults
+
+
+def _add_result(client, job_id, result):
+    client.xadd(config.settings.stackl_job_results_stream, {
+        "job_id": job_id,
+        "result": json.dumps(result)
+    })
+
+
+def test_results_on_the_stream_are_dispatched_to_their_job(monkeypatch):
+    monkeypatch.setattr(config.settings, "stackl_job_results_block", 1)
+    client = redis.Redis(host=config.settings.stackl_redis_host,
+                         port=config.settings.stackl_redis_port,
+                         password=config.settings.stackl_redis_password)
+    _add_result(client, "first", {"status": "FAILED"})
+    job_results = JobResults()
+
+    async def run():
+        await job_results.expect("first")
+        await job_results.expect("second")
+        await asyncio.sleep(0.01)
+        _add_result(client, "other", {"status": "FAILED"})
+        _add_result(client, "second", {"status": "READY"})
+        _add_result(client, "first", {"status": "READY"})
+        try:
+            return await asyncio.gather(
+                job_results.wait("first", 5, None, "queue"),
+                job_results.wait("second", 5, None, "queue"))
+        finally:
+            await job_results.stop()
+
+    assert asyncio.run(run()) == [{"status": "READY"}, {"status": "READY"}]
@@ -0,0 +1,220 @@
+import asyncio
+from types import SimpleNamespace
+
+from core import config
+from core.handler.stack_handler import StackHandler
+from core.manager.document_manager import DocumentManager
+from core.models.configs.policy_template_model import PolicyTemplate
+from core.opa_broker.opa_broker import OPABroker, generate_batch_policy
+
+
+class FakeResponse:
+    status_code = 200
+    text = ""
+
+    def __init__(self, body=None):
+        self.body = body or {}
+
+    def json(self):
+        return self.body
+
+
+class FakeSession:
+    def __init__(self):
+        self.puts = []
+        self.posts = 0
+
+    def put(self, url, data=None, timeout=None):
+        self.puts.append(url.rsplit("/", 1)[1])
+        return FakeResponse()
+
+    def post(self, url, data=None, timeout=None):
+        self.posts += 1
+        return FakeResponse({"result": {"fulfilled": True}})
+
+    def get(self, url, timeout=None):
+        return FakeResponse(
+            {"result": [{
+                "id": "in_opa",
+                "raw": "package in_opa"
+            }]})
+
+
+def test_unchanged_policy_is_uploaded_once():
+    opa_broker = OPABroker()
+    opa_broker.connection.session = FakeSession()
+    opa_broker.add_policy("policy", "package policy")
+    opa_broker.add_policy("policy", "package policy")
+    assert opa_broker.connection.session.puts == ["policy"]
+    opa_broker.add_policy("policy", "package policy\ndefault allow = true")
+    assert opa_broker.connection.session.puts == ["policy", "policy"]
+
+
+def test_sync_only_uploads_missing_policies():
+    opa_broker = OPABroker()
+    opa_broker.connection.session = FakeSession()
+    opa_broker.sync_policies([
+        PolicyTemplate(name="in_opa", policy="package in_opa", inputs=[]),
+        PolicyTemplate(name="missing", policy="package missing", inputs=[])
+    ])
+    assert opa_broker.connection.session.puts == ["missing"]
+    opa_broker.add_policy("in_opa", "package in_opa")
+    assert opa_broker.connection.session.puts == ["missing"]
+
+
+def test_batch_policy_has_a_rule_per_policy():
+    package, policy = generate_batch_policy(["b", "a", "b"], "infringement")
+    assert policy.startswith(f"package {package}\n")
+    assert policy.count("infringement[[index, result]]") == 2
+    assert 'data["a"].infringement[_] with input as check_input' in policy
+    assert generate_batch_policy(["a", "b"], "infringement")[0] == package
+
+
+def test_batch_results_are_split_per_check():
+    opa_broker = OPABroker()
+    queries = []
+
+    async def add_policy_async(policy_name, policy_data):
+        return True
+
+    async def ask_opa_policy_decision_async(policy_package, policy_rule,
+                                            data):
+        queries.append(data)
+        return {"result": [[0, {"msg": "first"}], [2, {"msg": "third"}]]}
+
+    opa_broker.add_policy_async = add_policy_async
+    opa_broker.ask_opa_policy_decision_async = ask_opa_policy_decision_async
+    checks = [{"policy": name, "input": {}} for name in ["a", "b", "a"]]
+    results = asyncio.run(
+        opa_broker.ask_opa_batch_decision_async(["a", "b"], "infringement",
+                                                {"shared": True}, checks))
+    assert results == [[{"msg": "first"}], [], [{"msg": "third"}]]
+    assert queries == [{"opa_data": {"shared": True}, "checks": checks}]
+
+
+def test_batch_without_decision_returns_none():
+    opa_broker = OPABroker()
+
+    async def add_policy_async(policy_name, policy_data):
+        return True
+
+    async def ask_opa_policy_decision_async(policy_package, policy_rule,
+                                            data):
+        return {}
+
+    opa_broker.add_policy_async = add_policy_async
+    opa_broker.ask_opa_policy_decision_async = ask_opa_policy_decision_async
+    assert asyncio.run(
+        opa_broker.ask_opa_batch_decision_async(["a"], "infringement", {},
+                                                [{
+                                                    "policy": "a",
+                                                    "input": {}
+                                                }])) is None
+
+
+def test_sit_policy_messages_keep_the_order_of_the_checks(monkeypatch):
+    monkeypatch.setattr(config.settings, "stackl_opa_batch_policies", True)
+    policies = {
+        name: PolicyTemplate(name=name,
+                             policy=f"package {name}",
+                             inputs=[],
+                             batch_safe=name == "batched")
+        for name in ["batched", "single", "unreachable"]
+    }
+    opa_broker = OPABroker()
+
+    async def add_policy_async(policy_name, policy_data):
+        return True
+
+    async def ask_opa_policy_decision_async(policy_package, policy_rule,
+                                            data):
+        if policy_package == "single":
+            return {"result": [{"msg": f"single on {data['target']}"}]}
+        return {}
+
+    async def ask_opa_batch_decision_async(policy_names, policy_rule,
+                                           opa_data, checks):
+        return [[{"msg": f"batched on {check['input']['target']}"}]
+                for check in checks]
+
+    opa_broker.add_policy_async = add_policy_async
+    opa_broker.ask_opa_policy_decision_async = ask_opa_policy_decision_async
+    opa_broker.ask_opa_batch_decision_async = ask_opa_batch_decision_async
+    handler = StackHandler(DocumentManager(), opa_broker)
+    monkeypatch.setattr(handler.context, "get_policy_template",
+                        policies.get)
+    stack_infr = SimpleNamespace(
+        infrastructure_capabilities={
+            target: SimpleNamespace(policies={
+                "batched": {},
+                "single": {}
+            })
+            for target in ["first", "second"]
+        })
+    stack_infr.infrastructure_capabilities["second"].policies = {
+        "single": {},
+        "batched": {},
+        "unreachable": {}
+    }
+    service_targets = {
+        "result": {
+            "services": {
+                "service": {
+                    "targets": ["first", "second"]
+                }
+            }
+        }
+    }
+    messages = asyncio.run(
+        handler.evaluate_sit_policies({}, service_targets, stack_infr, {}))
+    assert [message["msg"] for message in messages] == [
+        "batched on first", "single on first", "single on second",
+        "batched on second",
+        "Policy 'unreachable' on target 'second' could not be evaluated by OPA"
+    ]
+
+
+def test_decisions_are_cached_until_a_policy_changes():
+    opa_broker = OPABroker()
+    opa_broker.connection.session = FakeSession()
+    first = opa_broker.ask_opa_policy_decision("orchestration", "solutions",
+                                               {"a": 1, "b": 2})
+    first["result"]["fulfilled"] = False
+    second = opa_broker.ask_opa_policy_decision("orchestration", "solutions",
+                                                {"b": 2, "a": 1})
+    assert second == {"result": {"fulfilled": True}}
+    assert opa_broker.connection.session.posts == 1
+    assert opa_broker.decision_cache.hits == 1
+
+    opa_broker.add_policy("orchestration", "package orchestration")
+    opa_broker.ask_opa_policy_decision("orchestration", "solutions", {
+        "a": 1,
+        "b": 2
+    })
+    assert opa_broker.connection.session.posts == 2
+
+
+def test_concurrent_equal_decisions_are_asked_once():
+    opa_broker = OPABroker()
+    posts = []
+
+    class FakeClient:
+        async def post(self, url, content=None):
+            posts.append(url)
+            await asyncio.sleep(0.01)
+            return FakeResponse({"result": {"fulfilled": True}})
+
+    opa_broker.connection._get_client = FakeClient
+
+    async def ask_all():
+        opa_broker.connection._semaphore = asyncio.Semaphore(1)
+        return await asyncio.gather(*[
+            opa_broker.ask_opa_policy_decision_async(
+                "orchestration", "solutions", {"a": 1}) for _ in range(10)
+        ])
+
+    decisions = asyncio.run(ask_all())
+    assert posts == ["/v1/data/orchestration/solutions"]
+    assert decisions == [{"result": {"fulfilled": True}}] * 10
+    decisions[0]["result"]["fulfilled"] = False
+    assert decisions[1] == {"result": {"fulfilled": True}}
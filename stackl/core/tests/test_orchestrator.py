@@ -0,0 +1,83 @@
+import asyncio
+
+import aioredis
+
+from core import config
+from core.agent_broker import orchestrator as orchestrator_module
+from core.models.items.stack_instance_model import StackInstance
+
+
+def _stack_instance():
+    return StackInstance(name="test_orchestration",
+                         stack_infrastructure_template="sit",
+                         stack_application_template="sat")
+
+
+async def _redis():
+    return await aioredis.create_redis_pool(
+        (config.settings.stackl_redis_host, config.settings.stackl_redis_port),
+        password=config.settings.stackl_redis_password,
+        encoding='utf8')
+
+
+async def _wait_for_drivers(orchestrator):
+    while orchestrator._drivers:  # pylint: disable=protected-access
+        await asyncio.wait(list(orchestrator._drivers.values()))  # pylint: disable=protected-access
+
+
+def _record_runs(monkeypatch):
+    runs = []
+
+    async def create_job_per_service(services, action, *args, **kwargs):
+        runs.append(("start", action))
+        await asyncio.sleep(0.01)
+        runs.append(("end", action))
+        return True
+
+    monkeypatch.setattr(orchestrator_module, "create_job_per_service",
+                        create_job_per_service)
+    return runs
+
+
+def test_orchestrations_of_a_stack_instance_run_one_after_the_other(
+        monkeypatch):
+    runs = _record_runs(monkeypatch)
+    orchestrator = orchestrator_module.Orchestrator()
+
+    async def run():
+        redis = await _redis()
+        await orchestrator.submit(redis, _stack_instance(), "create")
+        await orchestrator.submit(redis, _stack_instance(), "update")
+        await _wait_for_drivers(orchestrator)
+        keys = await redis.keys("orchestration*")
+        redis.close()
+        await redis.wait_closed()
+        return keys
+
+    assert asyncio.run(run()) == []
+    assert runs == [("start", "create"), ("end", "create"),
+                    ("start", "update"), ("end", "update")]
+
+
+def test_orchestration_is_resumed_when_nobody_holds_the_lease(monkeypatch):
+    runs = _record_runs(monkeypatch)
+    orchestrator = orchestrator_module.Orchestrator()
+    lease_key = orchestrator_module.get_lease_key("test_orchestration")
+
+    async def run():
+        redis = await _redis()
+        await redis.set(lease_key, "other worker")
+        await orchestrator.submit(redis, _stack_instance(), "create")
+        await _wait_for_drivers(orchestrator)
+        assert runs == []
+        await redis.delete(lease_key)
+        await orchestrator.resume(redis)
+        await _wait_for_drivers(orchestrator)
+        remaining = await redis.smembers(
+            orchestrator_module.ORCHESTRATED_INSTANCES_KEY)
+        redis.close()
+        await redis.wait_closed()
+        return remaining
+
+    assert asyncio.run(run()) == []
+    assert runs == [("start", "create"), ("end", "create")]
@@ -28,6 +28,7 @@ policy_template = {
     "type": "policy_template",
     "inputs": ["params"],
     "outputs": None,
+    "batch_safe": True,
     "policy": policy
 }
 
@@ -0,0 +1,73 @@
+import pytest
+
+from core import config
+from core.datastore.redis_store import RedisStore, get_index_key
+from core.migrations import create_indexes as create_indexes_module
+from core.migrations.create_indexes import MIGRATION_KEY, create_indexes
+
+store = RedisStore()
+
+INDEX_KEY = get_index_key("configs", "test_index")
+NAMES = ["a", "ap", "app", "apple", "apricot", "aq", "b", "ap\xff"]
+
+
+def _put(name):
+    store.put({"name": name, "category": "configs", "type": "test_index"})
+
+
+def _names(documents):
+    return [document["name"] for document in documents]
+
+
+@pytest.fixture(name="documents")
+def fixture_documents():
+    """Puts documents whose names share prefixes"""
+    for name in NAMES:
+        _put(name)
+    yield NAMES
+    for name in NAMES:
+        store.delete(category="configs", type="test_index", name=name)
+    store.redis.delete(INDEX_KEY)
+
+
+def test_put_and_delete_maintain_the_index(documents):
+    assert [name.decode() for name in store.redis.zrange(INDEX_KEY, 0, -1)
+            ] == sorted(documents)
+    store.delete(category="configs", type="test_index", name="app")
+    assert store.redis.zscore(INDEX_KEY, "app") is None
+    assert "app" not in _names(
+        store.get_all("configs", "test_index").content)
+
+
+def test_get_all_matches_a_prefix_with_a_range(documents):
+    assert _names(store.get_all("configs", "test_index", "ap").content) == [
+        "ap", "app", "apple", "apricot", "ap\xff"
+    ]
+    assert _names(store.get_all("configs", "test_index",
+                                "app").content) == ["app", "apple"]
+    assert store.get_all("configs", "test_index", "c").content == []
+
+
+def test_names_are_paged_after_the_last_name(documents, monkeypatch):
+    monkeypatch.setattr(config.settings, "stackl_redis_batch_size", 3)
+    pages = list(store.get_names("configs", "test_index"))
+    assert [len(page) for page in pages] == [3, 3, 2]
+    assert [name for page in pages for name in page] == sorted(documents)
+    assert list(store.get_names("configs", "test_index",
+                                after="apricot")) == [["ap\xff", "aq", "b"]]
+    assert _names(store.get_all("configs", "test_index", "ap").content) == [
+        "ap", "app", "apple", "apricot", "ap\xff"
+    ]
+
+
+def test_the_migration_indexes_existing_documents(documents, monkeypatch):
+    monkeypatch.setattr(config.settings, "stackl_redis_batch_size", 3)
+    # Documents written before the indexes existed
+    store.redis.delete(INDEX_KEY, MIGRATION_KEY)
+    assert store.get_all("configs", "test_index").content == []
+    monkeypatch.setattr(create_indexes_module.DataStoreFactory, "get_store",
+                        lambda self: store)
+    create_indexes()
+    assert _names(store.get_all("configs",
+                                "test_index").content) == sorted(documents)
+    assert store.redis.get(MIGRATION_KEY)
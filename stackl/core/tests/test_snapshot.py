@@ -0,0 +1,150 @@
+import itertools
+import threading
+import time
+
+import pytest
+
+from core import config
+from core.datastore.local_file_system_store import LocalFileSystemStore
+from core.manager import snapshot_manager as snapshot_module
+from core.manager.document_manager import DocumentManager
+from core.manager.snapshot_manager import SnapshotManager
+from core.utils.json_patch import apply_patch, make_patch
+
+document_manager = DocumentManager()
+snapshot_manager = SnapshotManager()
+
+
+@pytest.fixture(name="snapshots")
+def fixture_snapshots(monkeypatch):
+    """Creates 5 snapshots of an environment whose params change every time"""
+    counter = itertools.count()
+    monkeypatch.setattr(snapshot_module, "get_timestamp",
+                        lambda spaces: f"{next(counter):04}")
+    monkeypatch.setattr(config.settings, "stackl_snapshot_rebase_interval", 3)
+    documents = []
+    for version in range(5):
+        document = {
+            "name": "snapshotted",
+            "type": "environment",
+            "category": "configs",
+            "description": "",
+            "params": {
+                "version": version,
+                f"param_{version}": "value/with~special"
+            },
+            "packages": list(range(version))
+        }
+        document_manager.write_document(document, overwrite=True)
+        snapshot_manager.create_snapshot("environment", "snapshotted")
+        documents.append(document_manager.get_document(type="environment",
+                                                       name="snapshotted"))
+    yield documents
+    for snapshot in snapshot_manager.get_snapshots("environment",
+                                                   "snapshotted"):
+        document_manager.delete_snapshot(snapshot["name"])
+    document_manager.store.delete(category="configs",
+                                  type="environment",
+                                  name="snapshotted")
+
+
+def _stored_snapshots():
+    return [
+        document_manager.get_document(type="snapshot", name=snapshot["name"])
+        for snapshot in snapshot_manager.get_snapshots("environment",
+                                                       "snapshotted")
+    ]
+
+
+def test_json_patch_turns_source_into_target():
+    source = {"a": 1, "b": {"c": [1, 2], "d/e": True}, "f": None}
+    target = {"a": 1, "b": {"c": [1, 2, 3], "d/e": 1}, "g": {"h": "i"}}
+    patch = make_patch(source, target)
+    assert apply_patch(source, patch) == target
+    assert source["b"]["c"] == [1, 2]
+    assert make_patch(target, target) == []
+
+
+def test_snapshots_are_patches_from_a_base(snapshots):
+    stored_snapshots = _stored_snapshots()
+    assert ["base" in stored for stored in stored_snapshots
+            ] == [True, False, False, True, False]
+    assert "snapshot" not in stored_snapshots[1]
+    assert [
+        snapshot["snapshot"] for snapshot in snapshot_manager.get_snapshots(
+            "environment", "snapshotted")
+    ] == snapshots
+    latest = snapshot_manager.get_snapshot(stored_snapshots[-1]["name"])
+    assert latest["snapshot"] == snapshots[-1]
+
+
+def test_deleting_a_snapshot_rewrites_the_one_after_it(snapshots):
+    first, second = _stored_snapshots()[:2]
+    snapshot_manager.delete_snapshot(first["name"])
+    snapshot_manager.delete_snapshot(_stored_snapshots()[2]["name"])
+    stored_snapshots = _stored_snapshots()
+    assert stored_snapshots[0]["name"] == second["name"]
+    assert ["base" in stored for stored in stored_snapshots
+            ] == [True, False, False]
+    assert stored_snapshots[2]["previous"] == stored_snapshots[1]["name"]
+    assert [
+        snapshot["snapshot"] for snapshot in snapshot_manager.get_snapshots(
+            "environment", "snapshotted")
+    ] == [snapshots[1], snapshots[2], snapshots[4]]
+
+
+def test_compaction_keeps_the_latest_snapshots(snapshots, monkeypatch):
+    monkeypatch.setattr(config.settings, "stackl_snapshot_keep", 2)
+    assert snapshot_manager.compact_snapshots() == 3
+    assert [
+        snapshot["snapshot"] for snapshot in snapshot_manager.get_snapshots(
+            "environment", "snapshotted")
+    ] == snapshots[3:]
+
+    monkeypatch.setattr(config.settings, "stackl_snapshot_keep", 0)
+    monkeypatch.setattr(config.settings, "stackl_snapshot_max_age", 60)
+    latest = _stored_snapshots()[-1]
+    assert snapshot_manager.compact_snapshots(now=latest["time"] + 120) == 1
+    stored_snapshots = _stored_snapshots()
+    assert [stored["name"] for stored in stored_snapshots] == [latest["name"]]
+    assert "base" in stored_snapshots[0]
+    snapshot_manager.restore_latest_snapshot("environment", "snapshotted")
+    assert document_manager.get_document(type="environment",
+                                         name="snapshotted") == snapshots[-1]
+
+
+def test_a_snapshot_is_not_chained_onto_one_being_deleted(
+        snapshots, monkeypatch):
+    write_chain = SnapshotManager._write_chain
+    creating = []
+
+    def slow_write_chain(self, stored_snapshots, remaining):
+        creating.append(
+            threading.Thread(target=snapshot_manager.create_snapshot,
+                             args=("environment", "snapshotted")))
+        creating[-1].start()
+        time.sleep(0.2)
+        return write_chain(self, stored_snapshots, remaining)
+
+    monkeypatch.setattr(SnapshotManager, "_write_chain", slow_write_chain)
+    deleted = _stored_snapshots()[-1]
+    snapshot_manager.delete_snapshot(deleted["name"])
+    creating[0].join()
+    stored_snapshots = _stored_snapshots()
+    assert deleted["name"] not in [
+        stored["name"] for stored in stored_snapshots
+    ]
+    assert stored_snapshots[-1]["previous"] != deleted["name"]
+    assert snapshot_manager.get_snapshots(
+        "environment", "snapshotted")[-1]["snapshot"] == snapshots[-1]
+
+
+def test_lfs_lock_times_out_when_another_holder_keeps_it(tmp_path):
+    store = LocalFileSystemStore(str(tmp_path))
+    with store.lock("snapshots/environment/snapshotted"):
+        with pytest.raises(TimeoutError):
+            with LocalFileSystemStore(str(tmp_path)).lock(
+                    "snapshots/environment/snapshotted", timeout=0.1):
+                pass
+    with store.lock("snapshots/environment/snapshotted", timeout=0.1):
+        pass
@@ -0,0 +1,115 @@
+import asyncio
+
+import pytest
+from fastapi.testclient import TestClient
+
+from core.agent_broker.orchestrator import orchestrator
+from core.handler.stack_handler import StackHandler
+from core.main import app
+from core.manager.document_manager import DocumentManager
+from core.manager.stackl_manager import get_stack_manager
+from core.models.api.stack_instance import StackInstanceInvocation
+from core.models.items.stack_instance_model import StackInstance
+
+document_manager = DocumentManager()
+
+NAMES = [
+    "test_bulk_slow", "test_bulk_existing", "test_bulk_missing_sit",
+    "test_bulk_failing", "test_bulk_fast", "test_bulk_conflicting"
+]
+
+
+def _stack_instance(name):
+    return StackInstance(name=name,
+                         stack_infrastructure_template="sit",
+                         stack_application_template="sat")
+
+
+def _invocation(name, sit="sit", **params):
+    return StackInstanceInvocation(stack_instance_name=name,
+                                   stack_infrastructure_template=sit,
+                                   stack_application_template="sat",
+                                   params=params)
+
+
+@pytest.fixture(name="handler")
+def fixture_handler(monkeypatch):
+    """
+    Replaces the templates and the policy evaluations, items can ask to be
+    slow, to fail, or to be created by someone else while they are evaluated
+    """
+    evaluated = []
+
+    async def evaluate_create(_self, item, _stack_infr, _stack_app_template):
+        evaluated.append(item.stack_instance_name)
+        await asyncio.sleep(item.params.get("delay", 0))
+        if item.params.get("fail"):
+            raise RuntimeError("evaluation failed")
+        if item.params.get("conflict"):
+            document_manager.write_stack_instance(
+                _stack_instance(item.stack_instance_name))
+        return _stack_instance(item.stack_instance_name), "created"
+
+    monkeypatch.setattr(StackHandler, "_evaluate_create", evaluate_create)
+    monkeypatch.setattr(StackHandler, "_load_templates",
+                        lambda *args: (None, None))
+    monkeypatch.setattr(DocumentManager, "get_stack_infrastructure_template",
+                        lambda _self, name: name == "sit" or None)
+    monkeypatch.setattr(DocumentManager, "get_stack_application_template",
+                        lambda _self, name: name == "sat" or None)
+    document_manager.write_stack_instance(
+        _stack_instance("test_bulk_existing"))
+    yield evaluated
+    for name in NAMES:
+        document_manager.delete_stack_instance(name)
+
+
+def test_bulk_requests_get_a_result_each_in_request_order(handler):
+    results = asyncio.run(get_stack_manager().process_stack_requests([
+        _invocation("test_bulk_slow", delay=0.05),
+        _invocation("test_bulk_existing"),
+        _invocation("test_bulk_slow"),
+        _invocation("test_bulk_missing_sit", sit="missing"),
+        _invocation("test_bulk_failing", fail=True),
+        _invocation("test_bulk_fast")
+    ]))
+    assert [stack_instance and stack_instance.name
+            for stack_instance, _ in results] == [
+                "test_bulk_slow", None, None, None, None, "test_bulk_fast"
+            ]
+    assert [result for _, result in results] == [
+        "created", "Stack instance already exists",
+        "Stack instance is requested twice",
+        "Stack infrastructure template: missing does not exist",
+        "evaluation failed", "created"
+    ]
+    # The slow item was evaluated with the others of its group
+    assert handler == ["test_bulk_slow", "test_bulk_failing", "test_bulk_fast"]
+
+
+def test_bulk_endpoint_writes_the_created_stack_instances(handler,
+                                                          monkeypatch):
+    submitted = []
+
+    async def submit(_redis, stack_instance, action):
+        submitted.append((stack_instance.name, action))
+
+    monkeypatch.setattr(orchestrator, "submit", submit)
+    invocations = [
+        _invocation("test_bulk_conflicting", conflict=True),
+        _invocation("test_bulk_failing", fail=True),
+        _invocation("test_bulk_fast")
+    ]
+    response = TestClient(app).post(
+        "/stack_instances/bulk",
+        json=[invocation.dict() for invocation in invocations])
+    assert response.status_code == 200
+    assert [result["created"] for result in response.json()
+            ] == [False, False, True]
+    assert [result["stack_instance_name"] for result in response.json()
+            ] == [invocation.stack_instance_name for invocation in invocations]
+    assert response.json()[0][
+        "result"] == "Stack instance 'test_bulk_conflicting' already exists"
+    assert submitted == [("test_bulk_fast", "create")]
+    assert document_manager.get_stack_instance("test_bulk_fast")
+    assert not document_manager.get_stack_instance("test_bulk_failing")
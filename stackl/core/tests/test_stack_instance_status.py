@@ -0,0 +1,245 @@
+import json
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+from fastapi.testclient import TestClient
+from pydantic import ValidationError
+
+from core import config
+from core.datastore.local_file_system_store import LocalFileSystemStore
+from core.enums.stackl_codes import StatusCode
+from core.main import app
+from core.manager.document_manager import DocumentManager
+from core.models.items.stack_instance_model import StackInstance
+from core.models.items.stack_instance_service_model import StackInstanceService
+from core.models.items.stack_instance_status_model import StackInstanceStatus
+
+document_manager = DocumentManager()
+
+
+def _stack_instance(statuses):
+    return StackInstance(name="test_status",
+                         stack_infrastructure_template="sit",
+                         stack_application_template="sat",
+                         status=statuses)
+
+
+def _status(service, target, status="in_progress"):
+    return {
+        "service": service,
+        "functional_requirement": "fr",
+        "infrastructure_target": target,
+        "status": status,
+        "error_message": ""
+    }
+
+
+def test_concurrent_status_updates_are_not_lost():
+    statuses = [
+        StackInstanceStatus(**_status(f"service{i}", "target"))
+        for i in range(20)
+    ]
+    document_manager.write_stack_instance(_stack_instance(statuses))
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        for i in range(20):
+            executor.submit(document_manager.update_stack_instance_status,
+                            "test_status",
+                            _status(f"service{i}", "target", "READY"))
+    stack_instance = document_manager.get_stack_instance("test_status")
+    assert [status.service for status in stack_instance.status
+            ] == [f"service{i}" for i in range(20)]
+    assert {status.status for status in stack_instance.status} == {"READY"}
+    document_manager.delete_stack_instance("test_status")
+
+
+def _update_lfs_status(root, index):
+    LocalFileSystemStore(root).update_status(
+        "test_status", _status(f"service{index}", "target", "READY"))
+
+
+def test_lfs_status_updates_of_other_processes_are_not_lost(tmp_path):
+    store = LocalFileSystemStore(str(tmp_path))
+    store.set_statuses("test_status",
+                       [_status(f"service{i}", "target") for i in range(20)])
+    processes = [
+        multiprocessing.get_context("fork").Process(target=_update_lfs_status,
+                                                    args=(str(tmp_path), i))
+        for i in range(20)
+    ]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    assert {
+        status["status"]
+        for status in store.get_statuses(["test_status"])["test_status"]
+    } == {"READY"}
+
+
+def test_group_status_matches_any_of_its_targets():
+    document_manager.write_stack_instance(
+        _stack_instance(
+            [StackInstanceStatus(**_status("service", "first,second"))]))
+    assert document_manager.update_stack_instance_status(
+        "test_status", _status("service", "second", "FAILED"))
+    stack_instance = document_manager.get_stack_instance("test_status")
+    assert stack_instance.status[0].status == "FAILED"
+    assert document_manager.update_stack_instance_status(
+        "test_status", _status("service", "first", "READY"), remove=True)
+    assert document_manager.get_stack_instance("test_status").status == []
+    document_manager.delete_stack_instance("test_status")
+
+
+def test_concurrent_updates_are_not_lost(monkeypatch):
+    monkeypatch.setattr(config.settings, "stackl_write_retries", 100)
+    document_manager.write_stack_instance(_stack_instance([]))
+
+    def add_tag(index):
+        document_manager.update_stack_instance(
+            "test_status",
+            lambda stack_instance: stack_instance.instance_params.update(
+                {f"param{index}": index}))
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        for i in range(20):
+            executor.submit(add_tag, i)
+    stack_instance = document_manager.get_stack_instance("test_status")
+    assert stack_instance.instance_params == {
+        f"param{i}": i
+        for i in range(20)
+    }
+    assert stack_instance.version == 21
+    document_manager.delete_stack_instance("test_status")
+
+
+def test_writes_are_attempted_at_least_once():
+    with pytest.raises(ValidationError):
+        config.Settings(stackl_write_retries=0)
+
+
+def test_write_with_outdated_version_conflicts():
+    stack_instance = _stack_instance([])
+    assert document_manager.write_stack_instance(
+        stack_instance, expected_version=0) == StatusCode.CREATED
+    assert document_manager.write_stack_instance(
+        _stack_instance([]), expected_version=0) == StatusCode.CONFLICT
+    assert document_manager.write_stack_instance(
+        stack_instance,
+        expected_version=stack_instance.version) == StatusCode.CREATED
+    document_manager.delete_stack_instance("test_status")
+
+
+def test_write_stack_instances_keeps_stored_ones():
+    document_manager.write_stack_instance(
+        _stack_instance([StackInstanceStatus(**_status("stored", "target"))]))
+    new_stack_instance = _stack_instance(
+        [StackInstanceStatus(**_status("new", "target"))])
+    new_stack_instance.name = "test_status_new"
+    assert document_manager.write_stack_instances(
+        [_stack_instance([]), new_stack_instance]) == [
+            StatusCode.CONFLICT, StatusCode.CREATED
+        ]
+    assert new_stack_instance.version == 1
+    assert document_manager.get_stack_instance(
+        "test_status").status[0].service == "stored"
+    assert document_manager.get_stack_instance(
+        "test_status_new").status[0].service == "new"
+    document_manager.delete_stack_instance("test_status")
+    document_manager.delete_stack_instance("test_status_new")
+
+
+def test_iter_stack_instances_pages_by_name(monkeypatch):
+    monkeypatch.setattr(config.settings, "stackl_redis_batch_size", 2)
+    names = ["test_iter_a", "test_other", "test_iter_b", "test_iter_c"]
+    for name in names:
+        stack_instance = _stack_instance(
+            [StackInstanceStatus(**_status("service", "target"))])
+        stack_instance.name = name
+        document_manager.write_stack_instance(stack_instance)
+    first_page = list(
+        document_manager.iter_stack_instances("iter",
+                                              limit=2,
+                                              fields=["status"]))
+    assert [document["name"] for document in first_page
+            ] == ["test_iter_a", "test_iter_b"]
+    assert set(first_page[0]) == {"name", "status"}
+    assert first_page[0]["status"][0]["service"] == "service"
+    assert [
+        document["name"] for document in document_manager.
+        iter_stack_instances("iter", after=first_page[-1]["name"], limit=2)
+    ] == ["test_iter_c"]
+    for name in names:
+        document_manager.delete_stack_instance(name)
+
+
+def test_lazy_stack_instance_only_validates_accessed_services():
+    stack_instance = _stack_instance([])
+    stack_instance.services = {
+        "first": [StackInstanceService(infrastructure_target="target")],
+        "second": [StackInstanceService(infrastructure_target="target")]
+    }
+    document_manager.write_stack_instance(stack_instance)
+
+    def add_output(stack_instance):
+        stack_instance.services["first"][0].outputs = {"ip": "10.0.0.1"}
+
+    updated = document_manager.update_stack_instance("test_status",
+                                                     add_output)
+    assert isinstance(dict.get(updated.services, "first")[0],
+                      StackInstanceService)
+    assert isinstance(dict.get(updated.services, "second")[0], dict)
+    stored = document_manager.get_stack_instance("test_status")
+    assert stored.services["first"][0].outputs == {"ip": "10.0.0.1"}
+    assert stored.services["second"] == stack_instance.services["second"]
+    assert stored.version == 2
+    document_manager.delete_stack_instance("test_status")
+
+
+def test_lazy_stack_instance_parses_statuses_and_stages():
+    stack_instance = _stack_instance(
+        [StackInstanceStatus(**_status("service", "target"))])
+    stack_instance.stages = [{"name": "first", "services": ["service"]}]
+    document_manager.write_stack_instance(stack_instance)
+    lazy = document_manager.get_stack_instance("test_status", lazy=True)
+    assert lazy.status[0].service == "service"
+    assert lazy.stages[0].services == ["service"]
+    assert lazy.to_stored()["status"] == stack_instance.dict()["status"]
+    document_manager.delete_stack_instance("test_status")
+
+
+def test_api_returns_only_the_fields_of_the_model():
+    document_manager.write_stack_instance(_stack_instance([]))
+    document_manager.store.put({
+        **document_manager.get_stack_instance_document("test_status"), "legacy":
+        True
+    })
+    client = TestClient(app)
+    stack_instance = client.get("/stack_instances/test_status").json()
+    assert "legacy" not in stack_instance
+    assert stack_instance["name"] == "test_status"
+    listed = client.get("/stack_instances?name=test_status").json()
+    assert listed == [stack_instance]
+    document_manager.delete_stack_instance("test_status")
+
+
+def test_api_streams_the_listed_stack_instances():
+    names = ["test_list_a", "test_list_b", "test_list_c"]
+    for name in names:
+        stack_instance = _stack_instance(
+            [StackInstanceStatus(**_status("service", "target"))])
+        stack_instance.name = name
+        document_manager.write_stack_instance(stack_instance)
+    client = TestClient(app)
+    response = client.get("/stack_instances?name=test_list&fields=status")
+    assert response.headers["content-type"] == "application/json"
+    assert [set(stack_instance) for stack_instance in response.json()
+            ] == [{"name", "status"}] * 3
+    response = client.get("/stack_instances?name=test_list&limit=2",
+                          headers={"accept": "application/x-ndjson"})
+    assert [
+        json.loads(line)["name"] for line in response.text.splitlines()
+    ] == names[:2]
+    assert response.headers["x-next-cursor"] == "test_list_b"
+    for name in names:
+        document_manager.delete_stack_instance(name)
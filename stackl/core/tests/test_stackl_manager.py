@@ -0,0 +1,44 @@
+import asyncio
+
+from arq.connections import RedisSettings
+
+from core.manager import stackl_manager
+
+
+def _fake_create_pool(monkeypatch, failures):
+    """Replaces creating aioredis pools, the first attempts fail"""
+    attempts = []
+
+    async def create_pool(*args, **kwargs):
+        attempts.append(kwargs)
+        await asyncio.sleep(0.01)
+        if len(attempts) <= failures:
+            raise ConnectionRefusedError("Redis is not ready yet")
+        return object()
+
+    monkeypatch.setattr(stackl_manager.aioredis, "create_pool", create_pool)
+    monkeypatch.setattr(stackl_manager, "RedisSettings",
+                        lambda: RedisSettings(conn_retry_delay=0))
+    monkeypatch.setattr(stackl_manager, "redis_pool_holder",
+                        stackl_manager.RedisPoolHolder())
+    return attempts
+
+
+def test_concurrent_requests_share_one_pool(monkeypatch):
+    attempts = _fake_create_pool(monkeypatch, failures=0)
+
+    async def get_pools():
+        return await asyncio.gather(
+            *[stackl_manager.get_redis() for _ in range(5)])
+
+    pools = asyncio.run(get_pools())
+    assert len(attempts) == 1
+    assert all(pool is pools[0] for pool in pools)
+
+
+def test_creating_the_pool_retries_connecting(monkeypatch):
+    attempts = _fake_create_pool(monkeypatch, failures=2)
+    assert asyncio.run(stackl_manager.create_redis_pool())
+    assert len(attempts) == 3
+    assert attempts[0]["create_connection_timeout"] == RedisSettings(
+    ).conn_timeout